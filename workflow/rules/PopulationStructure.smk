@@ -8,9 +8,13 @@ rule pca:
         genotypes = getZarrArray(type_="Genotypes", cloud=cloud),
         positions = getZarrArray(type_='Positions', cloud=cloud),
         siteFilters = getZarrArray(type_ = "SiteFilters", cloud=cloud),
+        cohorts = getCohortManifest('PCA'),
+        rechunked = getRechunkedGenotypes(),
     output:
         htmlAll = expand("results/PCA/{dataset}.{{contig}}.html", dataset = dataset),
         pngAll = expand("results/PCA/{dataset}.{{contig}}.png", dataset = dataset),
+        tsvAll = expand("results/PCA/{dataset}.{{contig}}.tsv", dataset = dataset),
+        gram = expand("results/PCA/data/{dataset}.{{contig}}.gram.npy", dataset = dataset),
         html = expand("results/PCA/{cohort}.{{contig}}.html", cohort=PCAcohorts['cohortNoSpaceText']),
         png = expand("results/PCA/{cohort}.{{contig}}.png", cohort=PCAcohorts['cohortNoSpaceText']),
     log:
@@ -28,6 +32,29 @@ rule pca:
         "../scripts/pca.py"
 
 
+rule pcaWholeGenome:
+    """
+    Perform principal components analysis across all contigs, by combining the Gram matrices of each contig's PCA
+    """
+    input:
+        grams = expand("results/PCA/data/{dataset}.{contig}.gram.npy", dataset = dataset, contig = contigs),
+    output:
+        html = expand("results/PCA/{dataset}.wholegenome.html", dataset = dataset),
+        png = expand("results/PCA/{dataset}.wholegenome.png", dataset = dataset),
+        tsv = expand("results/PCA/{dataset}.wholegenome.tsv", dataset = dataset),
+    log:
+        log = "logs/pca/wholegenome.log"
+    conda:
+        "../envs/pythonGenomics.yaml"
+    params:
+        metadata = config['metadata'],
+        dataset = config['dataset'],
+        cloud = cloud,
+        ag3_sample_sets = ag3_sample_sets
+    script:
+        "../scripts/pcaWholeGenome.py"
+
+
 
 #rule haploNet_Zarr2npy:#
 #
@@ -49,9 +76,10 @@ rule f2VariantLocate:
     Find lengths of haplotypes
     """
     input:
-        genotypes = getZarrArray(type_="Genotypes", cloud=cloud),
-        positions = getZarrArray(type_='Positions', cloud=cloud),
-        sitefilters = getZarrArray(type_='SiteFilters', cloud=cloud),
+        genotypes = expand(getZarrArray(type_="Genotypes", cloud=cloud), contig=contigs),
+        positions = expand(getZarrArray(type_='Positions', cloud=cloud), contig=contigs),
+        sitefilters = expand(getZarrArray(type_='SiteFilters', cloud=cloud), contig=contigs),
+        rechunked = getRechunkedGenotypes(all_contigs=True),
     output:
         f2variantPairs = "results/f2variantPairs.tsv"
     log:
@@ -62,6 +90,7 @@ rule f2VariantLocate:
         metadata = config['metadata'],
         genotypes = getZarrArray(type_="Genotypes", cloud=cloud),
         positions = getZarrArray(type_='Positions', cloud=cloud),
+        sitefilters = getZarrArray(type_='SiteFilters', cloud=cloud),
         cloud = cloud,
         contigs = contigs,
         ag3_sample_sets = ag3_sample_sets
@@ -77,7 +106,8 @@ rule f2HapLength:
     input:
         genotypes = getZarrArray(type_="Genotypes", cloud=cloud),
         positions = getZarrArray(type_='Positions', cloud=cloud),
-        f2variantPairs = "results/f2variantPairs.tsv"
+        f2variantPairs = "results/f2variantPairs.tsv",
+        rechunked = getRechunkedGenotypes()
     output:
         "results/f2HapLengths_{contig}.tsv"
     log:
@@ -1,4 +1,9 @@
 
+import hashlib
+import json
+import os
+from functools import lru_cache
+
 #from tools import get_colour_dict
 #from tools import getCohorts
 #import matplotlib.pyplot as plt
@@ -20,26 +25,21 @@ rule set_kernel:
 
 def getCohorts(metadata, columns=['species_gambiae_coluzzii', 'location'], comparatorColumn=None, minPopSize=15):
     
-    # subset metadata dataFrame and find combinations of variables with more than minPopSize individuals
-    cohorts = metadata[columns]
-    cohorts = cohorts.groupby(columns).size().reset_index().rename(columns={0:'size'})
-    cohorts = cohorts[cohorts['size'] > minPopSize][columns]
-    
+    # find combinations of variables with more than minPopSize individuals, and their positions, in one groupby pass
+    groups = metadata.groupby(columns).indices
+    keys = [key if isinstance(key, tuple) else (key,) for key in groups.keys()]
+    cohorts = pd.DataFrame(keys, columns=columns)
+    sizes = np.array([len(loc) for loc in groups.values()])
+    idxs = [loc.astype(np.int32) for loc, size in zip(groups.values(), sizes) if size > minPopSize]
+    cohorts = cohorts[sizes > minPopSize].reset_index(drop=True)
     
     if comparatorColumn != None:
         cols = [i for i in columns if i != comparatorColumn]
     else:
         cols = columns
-
-    idxs = []
-    for _, row in cohorts.iterrows():   
-        # create the pandas metadata query for each cohort
-        mycohortQuery = " & ".join([col + " == " + "'" + row.astype(str)[col] + "'" for col in cohorts.columns])
-        # get indices of individuals in each cohort
-        idxs.append(metadata.query(mycohortQuery).index.tolist())
     
     cohorts['indices'] = idxs
-    cohorts['cohortText'] = cohorts[cols].agg(' | '.join, axis=1)
+    cohorts['cohortText'] = cohorts[cols].astype(str).agg(' | '.join, axis=1)
     cohorts['cohortNoSpaceText'] = cohorts['cohortText'].str.replace("|", ".", regex=False).str.replace(" ", "",regex=False)
     #colours = get_colour_dict(cohorts['species_gambiae_coluzzii'], palette="Set1")
     #cohorts['colour'] = cohorts['species_gambiae_coluzzii'].map(colours)
@@ -51,6 +51,115 @@ def getCohorts(metadata, columns=['species_gambiae_coluzzii', 'location'], compa
     return(cohorts.reset_index(drop=True))
 
 
+def getCohortParams(analysis):
+
+    """
+    Returns the getCohorts() arguments for each set of cohorts used in the workflow
+    """
+
+    if analysis == 'selection':
+        params = dict(columns=config['metadataCohortColumns'], comparatorColumn=None, minPopSize=15, excludepath="resources/sib_group_table.csv")
+    elif analysis == 'PBS':
+        params = dict(columns=config['metadataCohortColumns'], comparatorColumn=config['Selection']['PBS']['metadataComparatorColumn'], minPopSize=15, excludepath="resources/sib_group_table.csv")
+    elif analysis == 'PCA':
+        params = dict(columns=config['PopulationStructure']['PCA']['colourColumns'], comparatorColumn=None, minPopSize=15, excludepath=None)
+    elif analysis == 'VOI':
+        params = dict(columns=config['metadataCohortColumns'], comparatorColumn=None, minPopSize=config['Selection']['VariantsOfInterest']['minPopSize'], excludepath=None)
+    else:
+        raise ValueError(f"No cohort parameters for analysis {analysis}")
+
+    return(params)
+
+
+def md5File(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            md5.update(block)
+    return(md5.hexdigest())
+
+
+@lru_cache(maxsize=None)
+def getCohortManifest(analysis):
+
+    """
+    Returns the paths of the cohort manifest (table and indices) for an analysis. The manifest is keyed by a 
+    hash of the metadata file (or the cloud sample sets) and the cohort parameters, so it is rewritten when either changes.
+    """
+
+    params = getCohortParams(analysis)
+    if config['VObsCloud']['activate']:
+        source = config['VObsCloud']['sample_sets']
+    else:
+        source = md5File(config['metadata'])
+    excluded = md5File(params['excludepath']) if params['excludepath'] and os.path.isfile(params['excludepath']) else None
+    key = hashlib.md5(json.dumps({'metadata':source, 'exclude':excluded, **params}, sort_keys=True).encode()).hexdigest()[:12]
+
+    return([f"resources/cohorts/{analysis}.{key}.cohorts.tsv", f"resources/cohorts/{analysis}.{key}.indices.npy"])
+
+
+def loadCohorts(analysis, metadata):
+
+    """
+    Returns the cohorts table from the cohort manifest if it has already been written, 
+    otherwise determines the cohorts from the metadata.
+    """
+
+    params = getCohortParams(analysis)
+    tablePath = getCohortManifest(analysis)[0]
+    comparatorColumn = params['comparatorColumn']
+
+    if not os.path.isfile(tablePath):
+        return(getCohorts(metadata, columns=params['columns'], comparatorColumn=comparatorColumn, minPopSize=params['minPopSize']))
+
+    cohorts = pd.read_csv(tablePath, sep="\t", keep_default_na=False)
+    if comparatorColumn != None:
+        cols = [col for col in cohorts.columns if col not in ['start', 'stop', 'colour', comparatorColumn]]
+        cohorts = cohorts.drop(columns='colour').pivot(index=cols, columns=comparatorColumn).reset_index()
+    return(cohorts)
+
+
+vcfZarrFields = {'Genotypes':'calldata/GT', 'Haplotypes':'calldata/GT', 'Positions':'variants/POS', 'HaplotypePositions':'variants/POS', 
+                 'SiteFilters':'variants/FILTER_PASS', 'REFPath':'variants/REF', 'ALTPath':'variants/ALT'}
+
+def getRechunkCohortManifests(wildcards):
+
+    """
+    Returns the cohort manifests of the activated analyses, whose cohorts the sample chunks of the rechunked genotypes are aligned to
+    """
+
+    analyses = ['selection']
+    if config['PopulationStructure']['PCA']['activate']:
+        analyses.append('PCA')
+    if config['Selection']['PBS']['activate']:
+        analyses.append('PBS')
+    if config['Selection']['VariantsOfInterest']['activate']:
+        analyses.append('VOI')
+    return([path for analysis in analyses for path in getCohortManifest(analysis)])
+
+
+def getCohortChunking():
+
+    """
+    Returns the CohortChunking config, with defaults for configs written before it was added
+    """
+
+    return({'activate':False, 'variantChunk':65536, 'minSampleBlock':32, 'maxSampleBlock':256, **config.get('CohortChunking', {})})
+
+
+def getRechunkedGenotypes(all_contigs=False):
+
+    """
+    Returns the cohort-chunked copy of the genotypes if CohortChunking is activated, as an input of the rules 
+    whose scripts read genotypes with loadZarrArrays(), so they wait for it and always read the same source
+    """
+
+    if not getCohortChunking()['activate'] or config['VObsCloud']['activate']:
+        return([])
+    path = "resources/Zarr/rechunked/{contig}/GT"
+    return(expand(path, contig=config['contigs']) if all_contigs else path)
+
+
 def getZarrArray(type_="Genotype", all_contigs=False, cloud=False):
 
     if cloud is False:
@@ -59,14 +168,8 @@ def getZarrArray(type_="Genotype", all_contigs=False, cloud=False):
             if all_contigs == True:
                 Array = Array.replace("{contig}", "{{contig}}")
         elif config['Zarr']['activate'] == False:
-            if type_ == "Genotype":
-                Array = "resources/Zarr/{dataset}/{contig}/calldata/GT" 
-            if type_ == 'Haplotype':
-                Array == "resources/Zarr/{dataset}/{contig}/calldata/GT" 
-            elif type_ == "Positions":
-                Array = "resources/Zarr/{dataset}/{contig}/variants/POS"
-            elif type_ == 'SiteFilters' and siteFilters is not None:
-                Array = "resources/Zarr/{dataset}/{contig}/variants/siteFilter"
+            # Zarr arrays written from the input VCF by the VCFToZarr rule
+            Array = "resources/Zarr/" + config['dataset'] + "/{contig}/" + vcfZarrFields[type_]
 
             if all_contigs == True:
                 Array = Array.replace("{contig}", "{{contig}}")
@@ -111,6 +214,9 @@ def getSelectedOutputs(wildcards):
 
     selected_input = []
    
+    if getCohortChunking()['activate'] and not config['VObsCloud']['activate']:
+        selected_input.extend(expand("resources/Zarr/rechunked/{contig}/GT", contig=config['contigs']))
+
    # selected_input.extend(expand("resources/vcfs/{dataset}_{contig}.{allelism}.vcf.gz", dataset=config['dataset'], contig=config['contigs'], allelism=['biallelic']))
 
     if config['PopulationStructure']['Relatedness']['activate']:
@@ -131,6 +237,12 @@ def getSelectedOutputs(wildcards):
                 cohort=PCAcohorts['cohortNoSpaceText'],
             )
         )
+        selected_input.extend(
+            expand(
+                "results/PCA/{dataset}.wholegenome.html",
+                dataset=config['dataset'],
+            )
+        )
 
     if config['Selection']['VariantsOfInterest']['activate']:
         selected_input.extend(
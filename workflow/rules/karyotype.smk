@@ -6,6 +6,7 @@ rule karyotype:
     input:
         genotypes = getZarrArray(type_="Genotypes", cloud=cloud),
         positions = getZarrArray(type_='Positions', cloud=cloud),
+        rechunked = getRechunkedGenotypes(),
     output:
         "results/{dataset}_karyotypes.tsv",
     log:
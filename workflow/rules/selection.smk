@@ -7,7 +7,9 @@ rule VariantsOfInterest:
         #positions = getZarrArray(type_='Positions', all_contigs=True),
         genotypes = expand(config['Zarr']['Genotypes'], contig = contigs) if not cloud else [],
         positions = expand(config['Zarr']['Positions'], contig = contigs) if not cloud else [],
-        variants = config['Selection']['VariantsOfInterest']['path']
+        variants = config['Selection']['VariantsOfInterest']['path'],
+        cohorts = getCohortManifest('VOI'),
+        rechunked = getRechunkedGenotypes(all_contigs=True)
     output:
         "results/variantsOfInterest/VOI.{dataset}.heatmap.png",
         "results/variantsOfInterest/VOI.{dataset}.frequencies.tsv"
@@ -38,7 +40,8 @@ rule G12:
         nb = "workflow/notebooks/GarudsStatistics.ipynb",
         genotypes = getZarrArray(type_="Genotypes", cloud=cloud),
         positions = getZarrArray(type_='Positions', cloud=cloud),
-        siteFilters = getZarrArray(type_ = "SiteFilters", cloud=cloud)
+        siteFilters = getZarrArray(type_ = "SiteFilters", cloud=cloud),
+        rechunked = getRechunkedGenotypes()
     output:
         nb = "results/notebooks/GarudsStatistics_G12_{contig}.ipynb",
         html = "results/notebooks/GarudsStatistics_G12_{contig}.html",
@@ -75,12 +78,15 @@ rule G123:
     input:
         genotypes = getZarrArray(type_="Genotypes", cloud=cloud),
         positions = getZarrArray(type_='Positions', cloud=cloud),
-        siteFilters = getZarrArray(type_ = "SiteFilters", cloud=cloud)
+        siteFilters = getZarrArray(type_ = "SiteFilters", cloud=cloud),
+        cohorts = getCohortManifest('selection'),
+        rechunked = getRechunkedGenotypes()
     output:
         plot = expand("results/selection/G123/G123_{cohort}.{{contig}}.png", cohort=cohorts['cohortNoSpaceText']),
         tsv = expand("results/selection/G123/G123_{cohort}.{{contig}}.tsv", cohort=cohorts['cohortNoSpaceText'])
     log:
         "logs/selection/G123.{contig}.log"
+    threads: 8
     conda:
         "../envs/pythonGenomics.yaml"
     params:
@@ -173,12 +179,15 @@ rule PopulationBranchStatistic:
         positions = getZarrArray(type_='Positions', cloud=cloud),
         siteFilters = getZarrArray(type_ = "SiteFilters", cloud=cloud),
         outgroupPath = "resources/AG1000G-ML-B/{contig}/calldata/GT/",
-        outgroupMetaPath = "resources/AG1000G-ML-B/samples.meta.csv"
+        outgroupMetaPath = "resources/AG1000G-ML-B/samples.meta.csv",
+        cohorts = getCohortManifest('PBS') if config['Selection']['PBS']['activate'] else [],
+        rechunked = getRechunkedGenotypes()
     output:
         plot = expand("results/selection/PBS/PBS_{cohort}.{{contig}}.png", cohort=PBScohorts['cohortNoSpaceText']),
         tsv = expand("results/selection/PBS/PBS_{cohort}.{{contig}}.tsv", cohort=PBScohorts['cohortNoSpaceText'])
     log:
         "logs/selection/PBS.{contig}.log"
+    threads: 8
     conda:
         "../envs/pythonGenomics.yaml"
     params:
@@ -1,3 +1,30 @@
+rule CohortManifest:
+    """
+    Determine the cohorts for an analysis once, and write them to a cohort manifest that all scripts memory-map
+    """
+    input:
+        metadata = config['metadata'] if not cloud else []
+    output:
+        table = "resources/cohorts/{analysis}.{key}.cohorts.tsv",
+        indices = "resources/cohorts/{analysis}.{key}.indices.npy"
+    log:
+        "logs/cohorts/{analysis}.{key}.log"
+    wildcard_constraints:
+        analysis = "[^.]+"
+    conda:
+        "../envs/pythonGenomics.yaml"
+    params:
+        cloud = cloud,
+        ag3_sample_sets = ag3_sample_sets,
+        metadata = config['metadata'],
+        columns = lambda wildcards: getCohortParams(wildcards.analysis)['columns'],
+        comparatorColumn = lambda wildcards: getCohortParams(wildcards.analysis)['comparatorColumn'],
+        minPopSize = lambda wildcards: getCohortParams(wildcards.analysis)['minPopSize'],
+        excludepath = lambda wildcards: getCohortParams(wildcards.analysis)['excludepath'],
+    script:
+        "../scripts/CohortManifest.py"
+
+
 
 
 rule GenomeIndex:
@@ -14,19 +41,71 @@ rule GenomeIndex:
         "v0.69.0/bio/samtools/faidx"
 
 
+if config['VCF']['activate']:
+    rule VCFToZarr:
+        """
+        Convert the input VCF to Zarr arrays for the python analyses, parsing regions of the VCF in parallel.
+        Interrupted conversions resume from the regions already written.
+        """
+        input:
+            vcf = getVCFs(gz=True, allelism='multiallelic') if config['VCF']['multiallelic'] else getVCFs(gz=True, allelism='biallelic')
+        output:
+            genotypes = directory(getZarrArray(type_="Genotypes")),
+            positions = directory(getZarrArray(type_="Positions")),
+            siteFilters = directory(getZarrArray(type_="SiteFilters")),
+            refs = directory(getZarrArray(type_="REFPath")),
+            alts = directory(getZarrArray(type_="ALTPath")),
+        log:
+            "logs/VCFToZarr/{contig}.log"
+        threads: 8
+        conda:
+            "../envs/pythonGenomics.yaml"
+        params:
+            out = lambda wildcards: f"resources/Zarr/{dataset}/{wildcards.contig}",
+            chunks = [65536, 64]
+        script:
+            "../scripts/VCFToZarr.py"
+
+
+rule RechunkGenotypes:
+    """
+    Write a copy of the genotypes with sample chunks aligned to the cohorts of the activated analyses, 
+    which the python analyses read in place of the input Zarr
+    """
+    input:
+        genotypes = getZarrArray(type_="Genotypes"),
+        cohorts = getRechunkCohortManifests
+    output:
+        genotypes = directory("resources/Zarr/rechunked/{contig}/GT")
+    log:
+        "logs/RechunkGenotypes/{contig}.log"
+    conda:
+        "../envs/pythonGenomics.yaml"
+    params:
+        variantChunk = getCohortChunking()['variantChunk'],
+        minSampleBlock = getCohortChunking()['minSampleBlock'],
+        maxSampleBlock = getCohortChunking()['maxSampleBlock']
+    script:
+        "../scripts/RechunkGenotypes.py"
+
+
 rule ZarrToVCF:
     """
-    Write out biallelic and multiallelic VCF files from provided Zarr files 
+    Write out biallelic and multiallelic VCF files from provided Zarr files, bgzipped and indexed in one pass
     """
     input:
         genotypes = getZarrArray(type_="Genotypes") if not cloud else [],
         positions = getZarrArray(type_='Positions') if not cloud else [],
         siteFilters = getZarrArray(type_ = "SiteFilters") if not cloud else [],
         refPath = config['Zarr']['REFPath'] if not cloud else [],
-        altPath = config['Zarr']['ALTPath'] if not cloud else []
+        altPath = config['Zarr']['ALTPath'] if not cloud else [],
+        rechunked = getRechunkedGenotypes()
     output:
       #  multiallelicVCF = expand("resources/vcfs/{dataset}_{{contig}}.multiallelic.vcf", dataset=dataset),
-        biallelicVCF = expand("resources/vcfs/{dataset}_{{contig}}.biallelic.vcf", dataset=dataset)
+        biallelicVCF = expand("resources/vcfs/{dataset}_{{contig}}.biallelic.vcf.gz", dataset=dataset),
+        tbi = expand("resources/vcfs/{dataset}_{{contig}}.biallelic.vcf.gz.tbi", dataset=dataset),
+        csi = expand("resources/vcfs/{dataset}_{{contig}}.biallelic.vcf.gz.csi", dataset=dataset)
+    threads: 4
     conda:
         "../envs/pythonGenomics.yaml"
     log:
@@ -42,10 +121,13 @@ rule ZarrToVCF:
 
 rule ZarrToHaplotypesVCF:
     """
-    Write out haplotypes VCF files from provided malariagen_data
+    Write out haplotypes VCF files from provided malariagen_data, bgzipped and indexed in one pass
     """
     output:
-        haplotypeVCF = expand("resources/vcfs/{dataset}_{{contig}}.haplotypes.vcf", dataset=dataset)
+        haplotypeVCF = expand("resources/vcfs/{dataset}_{{contig}}.haplotypes.vcf.gz", dataset=dataset),
+        tbi = expand("resources/vcfs/{dataset}_{{contig}}.haplotypes.vcf.gz.tbi", dataset=dataset),
+        csi = expand("resources/vcfs/{dataset}_{{contig}}.haplotypes.vcf.gz.csi", dataset=dataset)
+    threads: 8
     conda:
         "../envs/pythonGenomics.yaml"
     log:
@@ -58,6 +140,11 @@ rule ZarrToHaplotypesVCF:
         "../scripts/ZarrToVCF_haplotypes.py"
 
 
+# ZarrToVCF and ZarrToHaplotypesVCF write the VCFs bgzipped and indexed already
+ruleorder: ZarrToVCF > ZarrToHaplotypesVCF > BGZip
+ruleorder: ZarrToVCF > ZarrToHaplotypesVCF > BcftoolsIndex
+ruleorder: ZarrToVCF > ZarrToHaplotypesVCF > Tabix
+
 gzippedVCF = getVCFs(gz=True, bothAllelisms=True)
 rule BGZip:
     """
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Determine cohorts once and write them to a cohort manifest, which is memory-mapped by the analysis scripts
+"""
+
+import sys
+sys.stderr = open(snakemake.log[0], "w")
+
+import probetools as probe
+import pandas as pd
+
+
+cloud = snakemake.params['cloud']
+ag3_sample_sets = snakemake.params['ag3_sample_sets']
+
+# Load metadata
+if cloud:
+    ag3 = probe.connectAg3(snakemake.config['VObsCloud'])
+    metadata = ag3.sample_metadata(sample_sets=ag3_sample_sets)
+else:
+    metadata = pd.read_csv(snakemake.params['metadata'], sep="\t")
+
+probe.log(f"Determining {snakemake.wildcards['analysis']} cohorts")
+cohorts = probe.getCohorts(metadata=metadata,
+                    columns=snakemake.params.columns,
+                    comparatorColumn=snakemake.params.comparatorColumn,
+                    minPopSize=snakemake.params.minPopSize,
+                    excludepath=snakemake.params.excludepath,
+                    pivot=False)
+
+probe.writeCohortManifest(cohorts, tablePath=snakemake.output['table'], indicesPath=snakemake.output['indices'])
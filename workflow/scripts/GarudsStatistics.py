@@ -12,7 +12,6 @@ import numpy as np
 import pandas as pd
 import allel
 import dask.array as da
-import scipy
 import seaborn as sns
 import matplotlib.pyplot as plt
 
@@ -30,26 +29,21 @@ if not cloud:
     genotypePath = snakemake.input['genotypes'] if stat in ['G12', 'G123'] else []
     haplotypePath = snakemake.input['haplotypes'] if stat in ['H1', 'H12', 'H2/1'] else []
     positionsPath = snakemake.input['positions']
-    siteFilterPath = snakemake.input['siteFilters'] if stat in ['H1', 'H12', 'H2/1'] else []
+    # the haplotypes are read unfiltered, the genotypes through the site filter
+    siteFilterPath = snakemake.input['siteFilters'] if stat in ['G12', 'G123'] else None
 else:
     genotypePath = []
     haplotypePath = []
     positionsPath = []
-    siteFilterPath = []
-
-# Load metadata 
-if cloud:
-    import malariagen_data
-    ag3 = malariagen_data.Ag3(pre=True)
-    metadata = ag3.sample_metadata(sample_sets=ag3_sample_sets)
-else:
-    metadata = pd.read_csv(snakemake.params['metadata'], sep="\t")
+    siteFilterPath = None
+ag3 = probe.connectAg3(snakemake.config['VObsCloud']) if cloud else None
+probe.configureResultsCache(snakemake.config.get('ResultsCache'))
 
 # Load arrays 
 if stat in ['H1', 'H12', 'H2/1']:
-    haps, pos = probe.loadZarrArrays(haplotypePath, positionsPath, siteFilterPath=None, haplotypes=True, cloud=cloud, contig=contig)
+    haps, pos = probe.loadZarrArrays(haplotypePath, positionsPath, siteFilterPath=siteFilterPath, haplotypes=True, cloud=cloud, contig=contig, ag3=ag3)
 elif stat in ['G12', 'G123']:
-    snps, pos = probe.loadZarrArrays(genotypePath, positionsPath, siteFilterPath=siteFilterPath, haplotypes=False, cloud=cloud, contig=contig)
+    snps, pos = probe.loadZarrArrays(genotypePath, positionsPath, siteFilterPath=siteFilterPath, haplotypes=False, cloud=cloud, contig=contig, ag3=ag3)
 else:
     raise AssertionError("The statistic selected is not 'G12, G123, or H12")
 
@@ -58,42 +52,26 @@ else:
 # Define functions
 def clusterMultiLocusGenotypes(gnalt, cut_height=0.1, metric='euclidean', g=2):
     """
-    Hierarchically clusters genotypes and calculates G12 statistic. 
+    Clusters genotypes (single-linkage, via union-find) and calculates G12 statistic. 
     """
-    # cluster the genotypes in the window
-    dist = scipy.spatial.distance.pdist(gnalt.T, metric=metric)
-    if metric in {'hamming', 'jaccard'}:
-        # convert distance to number of SNPs, easier to interpret
-        dist *= gnalt.shape[0]
-
-    Z = scipy.cluster.hierarchy.linkage(dist, method='single')
-    cut = scipy.cluster.hierarchy.cut_tree(Z, height=cut_height)[:, 0]
-    cluster_sizes = np.bincount(cut)
-    #clusters = [np.nonzero(cut == i)[0] for i in range(cut.max() + 1)] #returns indices of individuals in each cluster
-    
-    # get freq of clusters and sort by largest freq
-    freqs = cluster_sizes/gnalt.shape[1]
-    freqs = np.sort(freqs)[::-1]
-    
-    # calculate garuds statistic
-    gStat = np.sum(freqs[:g])**2 + np.sum(freqs[g:]**2)
-    
-    return(gStat)
+    return(probe.garudsG(gnalt, cut_height=cut_height, metric=metric, g=g))
 
 
-def garudsStat(stat, geno, pos, cut_height=None, metric='euclidean', window_size=1200, step_size=600):
+@probe.resultsCache("garudsStat", ignore=['geno', 'threads'])
+def garudsStat(stat, geno, pos, cut_height=None, metric='euclidean', window_size=1200, step_size=600, threads=1):
     
     """
-    Calculates G12/G123/H12
+    Calculates G12/G123/H12, with windows split across threads worker processes. Results are cached, 
+    keyed by the cohort and input arrays given as cacheParams
     """
         
     # Do we want to cluster the Multi-locus genotypes (MLGs), or just group MLGs if they are identical
     if stat == "G12":
-        garudsStat = allel.moving_statistic(geno, clusterMultiLocusGenotypes, size=window_size, step=step_size, metric=metric, cut_height=cut_height, g=2)
+        garudsStat = probe.parallelMovingStatistic(probe.movingGarudsG, geno, size=window_size, step=step_size, threads=threads, metric=metric, cut_height=cut_height, g=2)
     elif stat == "G123":
-        garudsStat = allel.moving_statistic(geno, clusterMultiLocusGenotypes, size=window_size, step=step_size, metric=metric, cut_height=cut_height, g=3)
+        garudsStat = probe.parallelMovingStatistic(probe.movingGarudsG, geno, size=window_size, step=step_size, threads=threads, metric=metric, cut_height=cut_height, g=3)
     elif stat == "H12":
-        garudsStat,_,_,_ = allel.moving_garud_h(geno, size=window_size, step=step_size)
+        _,garudsStat,_,_ = probe.parallelMovingStatistic(probe.movingGarudH, probe.packHaplotypes(geno), size=window_size, step=step_size, threads=threads, n_variants=geno.shape[0])
     else:
         raise ValueError("Statistic is not G12/G123/H12")
 
@@ -106,10 +84,44 @@ def garudsStat(stat, geno, pos, cut_height=None, metric='euclidean', window_size
 #### Load cohort data and their indices in genotype data
 ### run garudStat for that query. already loaded contigs 
 
-cohorts = probe.getCohorts(metadata=metadata, 
-                    columns=snakemake.params.columns, 
-                    minPopSize=snakemake.params.minPopSize, excludepath="resources/sib_group_table.csv")
+cohorts = probe.loadCohortManifest(*snakemake.input['cohorts'])
 
+def countAlleles():
+    # count alleles for every cohort in a single pass over the genotypes
+    probe.log(f"count alleles in {cohorts.shape[0]} cohorts | Chromosome {contig}")
+    if stat in ['H1', 'H12', 'H123']:
+        labels = probe.cohortLabels(cohorts['indices'], n_samples=haps.shape[1] // 2)
+        return(probe.countAllelesCohorts(haps, np.repeat(labels, 2), max_allele=3))
+    else:
+        labels = probe.cohortLabels(cohorts['indices'], n_samples=snps.shape[1])
+        return(probe.countAllelesCohorts(snps, labels, max_allele=3))
+
+def biallelicMask(idx):
+    # only count alleles if a cohort's mask is not already in the mask store
+    global ac_cohorts
+    if ac_cohorts is None:
+        ac_cohorts = countAlleles()
+    ac_cohort = allel.AlleleCountsArray(ac_cohorts[:, idx])
+    # N.B., if going to use to_n_alt later, need to make sure sites are 
+    # biallelic and one of the alleles is the reference allele
+    ref_ac = ac_cohort[:, 0]
+    return(ac_cohort.is_biallelic() & (ref_ac > 0))
+
+ac_cohorts = None
+maskParams = dict(contig=contig, 
+                  genotypes=probe.dataIdentity(genotypePath or haplotypePath), 
+                  siteFilter=probe.dataIdentity(siteFilterPath),
+                  sample_sets=ag3_sample_sets if cloud else None)
+
+# identifies the input data in the results cache, chunk by chunk
+scanParams = dict(contig=contig,
+                  genotypes=probe.zarrIdentity(genotypePath or haplotypePath),
+                  siteFilter=probe.zarrIdentity(siteFilterPath),
+                  sample_sets=ag3_sample_sets if cloud else None)
+
+if stat in ['G12', 'G123']:
+    # alt counts of every sample, 2-bit packed and memory-mapped, written on the first run over this contig
+    altCounts, _, n_samples = probe.cachedAltCounts(snps, pos, **maskParams)
 
 # Loop through each cohort, manipulate genotype arrays and calculate chosen Garuds Statistic
 for idx, cohort in cohorts.iterrows():
@@ -118,28 +130,21 @@ for idx, cohort in cohorts.iterrows():
         # get indices for haplotype Array and filter
         hapInds = np.sort(np.concatenate([np.array(cohort['indices'])*2, np.array(cohort['indices']*2)+1]))
         gt_cohort = haps.take(hapInds, axis=1)
-    elif stat in ['G12', 'G123']:
-        # filter to correct loc, year, species individuals
-        gt_cohort = snps.take(cohort['indices'], axis=1)
-    else:
+    elif stat not in ['G12', 'G123']:
         raise ValueError("Statistic is not G12/G123/H1/H12")
 
     probe.log(f"--------- Running {stat} on {cohort['cohortText']} | Chromosome {contig} ----------")
     probe.log("filter to biallelic segregating sites")
 
-    ac_cohort = gt_cohort.count_alleles(max_allele=3).compute()
-    # N.B., if going to use to_n_alt later, need to make sure sites are 
-    # biallelic and one of the alleles is the reference allele
-    ref_ac = ac_cohort[:, 0]
-    loc_sites = ac_cohort.is_biallelic() & (ref_ac > 0)
-    gt_seg = da.compress(loc_sites, gt_cohort, axis=0)
-    pos_seg = da.compress(loc_sites, pos, axis=0)
+    loc_sites = probe.cachedMask('biallelic', lambda: biallelicMask(idx), cohort=probe.sampleSetHash(cohort['indices']), **maskParams)
+    pos_seg = np.asarray(pos)[loc_sites]
 
     probe.log(f"compute input data for {stat}")
-    pos_seg = pos_seg.compute()
-
     if stat in ['G12', 'G123']:
-        gt_seg = allel.GenotypeDaskArray(gt_seg).to_n_alt().compute()
+        # filter to correct loc, year, species individuals, reading only their bytes of the cache
+        gt_seg = probe.unpackAltCounts(altCounts, n_samples, samples=cohort['indices'], rows=loc_sites)
+    else:
+        gt_seg = da.compress(loc_sites, gt_cohort, axis=0)
 
     # calculate G12/G123/H12 and plot figs 
     gStat, midpoint = garudsStat(stat=stat,
@@ -148,7 +153,9 @@ for idx, cohort in cohorts.iterrows():
                                 cut_height=cutHeight,
                                 metric='euclidean',
                                 window_size=windowSize,
-                                step_size=windowStep)
+                                step_size=windowStep,
+                                threads=snakemake.threads,
+                                cacheParams=dict(cohort=probe.sampleSetHash(cohort['indices']), **scanParams))
 
     probe.windowedPlot(statName=stat, 
                 cohortText = cohort['cohortText'],
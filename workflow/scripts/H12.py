@@ -7,7 +7,7 @@ import numpy as np
 import pandas as pd
 import malariagen_data
 import allel
-from malariagen_data.util import CacheMiss
+import probetools as probe
 
 def h12_gwss(
         contig,
@@ -52,10 +52,6 @@ def h12_gwss(
             An array with h12 statistic values for each window.
 
         """
-        # change this name if you ever change the behaviour of this function, to
-        # invalidate any previously cached data
-        name = "ag3_h12_gwss_v1"
-
         params = dict(
             contig=contig,
             analysis=analysis,
@@ -67,18 +63,16 @@ def h12_gwss(
             random_seed=random_seed,
         )
 
-        try:
-            results = ag3.results_cache_get(name=name, params=params)
-
-        except CacheMiss:
-            results = _h12_gwss(**params)
-            ag3.results_cache_set(name=name, params=params, results=results)
+        results = _h12_gwss(**params, cacheParams=dict(release=snakemake.config['VObsCloud'].get('url')))
 
         x = results["x"]
         h12 = results["h12"]
 
         return x, h12
 
+# bump the version if you ever change the behaviour of this function in a way 
+# its source does not show, to invalidate any previously cached data
+@probe.resultsCache("ag3_h12_gwss")
 def _h12_gwss(
         contig,
         biallelic_mask,
@@ -104,12 +98,13 @@ def _h12_gwss(
         print(f"after, array is shape: {ds_haps['call_genotype'].shape}")
  
         gt = allel.GenotypeDaskArray(ds_haps["call_genotype"].data)
+        ht = gt.to_haplotypes()
 
         with ag3._dask_progress(desc="Load haplotypes"):
-            ht = gt.to_haplotypes().compute()
+            packed = probe.packHaplotypes(ht)
         pos = ds_haps["variant_position"].values
 
-        h1, h12, h123, h2_h1 = allel.moving_garud_h(ht, size=window_size)
+        h1, h12, h123, h2_h1 = probe.movingGarudH(packed, n_variants=ht.shape[0], size=window_size)
 
         x = allel.moving_statistic(pos, statistic=np.mean, size=window_size)
 
@@ -145,7 +140,8 @@ contig = snakemake.wildcards['contig']
 cohort = snakemake.wildcards['cohort']
 stat = "H12"
 
-ag3 = malariagen_data.Ag3(pre=True)
+ag3 = probe.connectAg3(snakemake.config['VObsCloud'])
+probe.configureResultsCache(snakemake.config.get('ResultsCache'))
 metadata = ag3.sample_metadata("3.2")
 meta = metadata.query("sex_call == 'F'")
 sibs = pd.read_csv("resources/sib_group_table.csv", sep="\t")
@@ -161,7 +157,9 @@ random = randomisations.query("specimen in @ids")
 
 
 cohort_ids = random.query(f"population == @cohort")['specimen'].to_list()
-biallelic_mask = get_biallelic_mask(cohort_ids, contig, cohort=cohort, analysis='gamb_colu')
+biallelic_mask = probe.cachedMask('biallelicHaplotypes', 
+                                  lambda: get_biallelic_mask(cohort_ids, cohort=cohort, contig=contig, analysis='gamb_colu'), 
+                                  contig=contig, analysis='gamb_colu', samples=sorted(cohort_ids))
 
 
 alive_dead_dict = {}
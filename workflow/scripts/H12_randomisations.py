@@ -4,129 +4,21 @@
 """
 """
 
+import sys
 import numpy as np
 import pandas as pd
 from pathlib import Path
 import malariagen_data
 import allel
-from malariagen_data.util import CacheMiss
+import probetools as probe
 
-def h12_gwss(
-        contig,
-        analysis,
-        biallelic_mask,
-        window_size,
-        sample_sets=None,
-        sample_query=None,
-        cohort_size=30,
-        random_seed=42,
-    ):
-        """Run h12 GWSS.
-
-        Parameters
-        ----------
-        contig: str
-            Chromosome arm (e.g., "2L")
-        analysis : {"arab", "gamb_colu", "gamb_colu_arab"}
-            Which phasing analysis to use. If analysing only An. arabiensis, the
-            "arab" analysis is best. If analysing only An. gambiae and An.
-            coluzzii, the "gamb_colu" analysis is best. Otherwise, use the
-            "gamb_colu_arab" analysis.
-        window_size : int
-            The size of windows used to calculate h12 over.
-        sample_sets : str or list of str, optional
-            Can be a sample set identifier (e.g., "AG1000G-AO") or a list of
-            sample set identifiers (e.g., ["AG1000G-BF-A", "AG1000G-BF-B"]) or a
-            release identifier (e.g., "3.0") or a list of release identifiers.
-        sample_query : str, optional
-            A pandas query string which will be evaluated against the sample
-            metadata e.g., "taxon == 'coluzzii' and country == 'Burkina Faso'".
-        cohort_size : int, optional
-            If provided, randomly down-sample to the given cohort size.
-        random_seed : int, optional
-            Random seed used for down-sampling.
-
-        Returns
-        -------
-        x : numpy.ndarray
-            An array containing the window centre point genomic positions.
-        h12 : numpy.ndarray
-            An array with h12 statistic values for each window.
-
-        """
-        # change this name if you ever change the behaviour of this function, to
-        # invalidate any previously cached data
-        name = "ag3_h12_gwss_v1"
-
-        params = dict(
-            contig=contig,
-            analysis=analysis,
-            biallelic_mask=biallelic_mask,
-            window_size=window_size,
-            sample_sets=ag3._prep_sample_sets_arg(sample_sets=sample_sets),
-            sample_query=sample_query,
-            cohort_size=cohort_size,
-            random_seed=random_seed,
-        )
-
-        try:
-            results = ag3.results_cache_get(name=name, params=params)
-
-        except CacheMiss:
-            results = _h12_gwss(**params)
-            ag3.results_cache_set(name=name, params=params, results=results)
-
-        x = results["x"]
-        h12 = results["h12"]
-
-        return x, h12
-
-def _h12_gwss(
-        contig,
-        biallelic_mask,
-        analysis,
-        window_size,
-        sample_sets,
-        sample_query,
-        cohort_size,
-        random_seed,
-    ):
-
-        ds_haps = ag3.haplotypes(
-            region=contig,
-            analysis=analysis,
-            sample_query=sample_query,
-            sample_sets=sample_sets,
-            cohort_size=cohort_size,
-            random_seed=random_seed,
-        )
-
-        print(f"removing biallelics, {biallelic_mask.sum()} snps, array is shape: {ds_haps['call_genotype'].shape}")
-        ds_haps = ds_haps.isel(variants=biallelic_mask)
-        print(f"after, array is shape: {ds_haps['call_genotype'].shape}")
-
-        gt = allel.GenotypeDaskArray(ds_haps["call_genotype"].data)
-
-        with ag3._dask_progress(desc="Load haplotypes"):
-            ht = gt.to_haplotypes().compute()
-        pos = ds_haps["variant_position"].values
-
-        h1, h12, h123, h2_h1 = allel.moving_garud_h(ht, size=window_size)
-
-        x = allel.moving_statistic(pos, statistic=np.mean, size=window_size)
-
-        results = dict(x=x, h12=h12)
-
-        return results
-
-
-def get_biallelic_mask(partner_sample_ids, cohort, contig, analysis):
+def load_packed_haplotypes(partner_sample_ids, contig, analysis):
     """
-    Get a biallelic boolean mask which we will pass to H12_gwss() and apply to each phenotype/randomisation.
-    Different boolean mask for each cohort.
+    Load the cohort's haplotypes once, restrict them to biallelic sites and bit-pack them, 
+    so that every phenotype randomisation can be computed from the same array.
     """
 
-    print(f"Getting biallelic mask for {cohort}")
+    print(f"Loading haplotypes for {cohort}")
     ds_haps = ag3.haplotypes(
         region=contig,
         analysis=analysis,
@@ -137,18 +29,27 @@ def get_biallelic_mask(partner_sample_ids, cohort, contig, analysis):
     )
 
     gt = allel.GenotypeDaskArray(ds_haps["call_genotype"].data)
+    biallelic_mask = probe.cachedMask('biallelicHaplotypes', 
+                                      lambda: gt.count_alleles().is_biallelic().compute(), 
+                                      contig=contig, analysis=analysis, samples=sorted(partner_sample_ids))
+    print(f"removing non-biallelic sites, {biallelic_mask.sum()} snps, array is shape: {gt.shape}")
+
+    ht = gt.compress(biallelic_mask, axis=0).to_haplotypes()
+    with ag3._dask_progress(desc="Load haplotypes"):
+        packed = probe.packHaplotypes(ht)
+    pos = ds_haps["variant_position"].values[biallelic_mask]
+    sample_ids = ds_haps["sample_id"].values
 
-    ac = gt.count_alleles()
-    bial_bool = ac.is_biallelic()
-    return(bial_bool)
+    return(packed, pos, sample_ids)
 
 
 
 stat = 'H12' 
 contig = snakemake.params['contig']
 cohort = snakemake.params['cohort']
+window_size = 1000
 
-ag3 = malariagen_data.Ag3(pre=True)
+ag3 = probe.connectAg3(snakemake.config['VObsCloud'])
 metadata = ag3.sample_metadata("3.2")
 meta = metadata.query("sex_call == 'F'")
 sibs = pd.read_csv("resources/sib_group_table.csv", sep="\t")
@@ -162,33 +63,29 @@ ids = metadata['partner_sample_id']
 # make sure randomisations have only samples in the metadata, so exclusing sibs and females
 random = randomisations.query("specimen in @ids")
 
-cohort_ids = random.query(f"population == @cohort")['specimen'].to_list()
-biallelic_mask = get_biallelic_mask(cohort_ids, contig, analysis='gamb_colu')
-
-
-alive_dead_dict = {}
-for i in np.arange(1, 201):
-    i = '%0.4d' % i
+outpath = f"randomisations/H12/{cohort}.{contig}.tsv"
+if Path(outpath).exists():
+    print(f"skipping {cohort} {contig}")
+    sys.exit(0)
 
-    alive_dead_dict['alive'] = random.query(f"r{i} == 'alive' & population == @cohort")['specimen']
-    alive_dead_dict['dead']  = random.query(f"r{i} == 'dead' & population == @cohort")['specimen']
-
-    for pheno, sample_names in alive_dead_dict.items():
-# Loop through each cohort, manipulate genotype arrays and calculate chosen Garuds Statistic
-
-        if Path(f"randomisations/H12/H12_{cohort}_{pheno}{i}.{contig}.tsv").exists():
-            print(f"skipping {cohort} {pheno} {i} {contig}")
-            continue
-
-        print(f"--------- Running {stat} on {cohort} {i} | Chromosome {contig} ----------")
-        x, h12 = h12_gwss(
-            contig=contig, 
-            analysis='gamb_colu',
-            biallelic_mask = biallelic_mask,
-            window_size=1000,
-            sample_query=f"partner_sample_id in {alive_dead_dict[pheno].to_list()}",
-            cohort_size=None
-        )
-
-        h12_df = pd.DataFrame({'x':x, 'h12':h12})
-        h12_df.to_csv(f"randomisations/H12/{cohort}_{pheno}{str(i)}.{contig}.tsv", sep="\t")
\ No newline at end of file
+cohort_ids = random.query(f"population == @cohort")['specimen'].to_list()
+packed, pos, sample_ids = load_packed_haplotypes(cohort_ids, contig, analysis='gamb_colu')
+
+# label each haplotype alive (0) or dead (1) in each randomisation, in the order of the haplotype array
+phenos = ['alive', 'dead']
+randoms = ['%0.4d' % i for i in np.arange(1, 201)]
+specimens = metadata.set_index('sample_id').loc[sample_ids, 'partner_sample_id']
+assignments = random.query("population == @cohort").set_index('specimen').loc[specimens, [f"r{i}" for i in randoms]]
+partitions = np.full(assignments.T.shape, -1, dtype=np.int32)
+for p, pheno in enumerate(phenos):
+    partitions[(assignments.T == pheno).to_numpy()] = p
+partitions = np.repeat(partitions, 2, axis=1)
+
+print(f"--------- Running {stat} on {cohort} for {len(randoms)} randomisations | Chromosome {contig} ----------")
+h12 = probe.movingGarudH12Partitions(packed, n_variants=pos.shape[0], partitions=partitions, size=window_size)
+x = allel.moving_statistic(pos, statistic=np.mean, size=window_size)
+
+# write all randomisations to one table, with one column per randomisation and phenotype
+h12_df = pd.DataFrame({f"{pheno}{i}":h12[r, p] for r, i in enumerate(randoms) for p, pheno in enumerate(phenos)})
+h12_df.insert(0, 'x', x)
+h12_df.to_csv(outpath, sep="\t")
@@ -11,16 +11,17 @@ sys.stderr = open(snakemake.log[0], "w")
 import probetools as probe
 import numpy as np
 import pandas as pd
+import allel
 
 
 cloud = snakemake.params['cloud']
 dataset = snakemake.params['dataset']
 ag3_sample_sets = snakemake.params['ag3_sample_sets']
+probe.configureResultsCache(snakemake.config.get('ResultsCache'))
 
 # Load metadata 
 if cloud:
-    import malariagen_data
-    ag3 = malariagen_data..Ag3(pre=True)
+    ag3 = probe.connectAg3(snakemake.config['VObsCloud'])
     metadata = ag3.sample_metadata(sample_sets=ag3_sample_sets)
 
     genotypePath = []
@@ -35,21 +36,27 @@ else:
     siteFilterPath = snakemake.input['siteFilters']
 
 
+@probe.resultsCache("karyotype", ignore=['snps', 'pos'])
+def karyotype(inversion, chrom, snps, pos):
+    callset = {'geno':snps, 'pos':pos, 'chrom':chrom}
+    av_gts, total_sites, num_0, num_1, num_2 = probe.compkaryo(callset, inversion)
+    return(np.asarray(av_gts), np.asarray(total_sites.compute()))
+
 invDict = {}
 
 for inversion in probe.inversionDict.keys():
     chrom = probe.inversionDict[inversion][0]
 
     if cloud:
-        snps = allel.GenotypeDaskArray(ag3.snp_genotypes(region=chrom, sample_sets=my_sample_set))
+        snps = allel.GenotypeDaskArray(ag3.snp_genotypes(region=chrom, sample_sets=ag3_sample_sets))
         pos = allel.SortedIndex(ag3.snp_sites(region=chrom, field='POS'))
+        dataParams = dict(sample_sets=ag3_sample_sets)
     else:
-        snps, pos = probe.loadZarrArrays(genotypePath, positionsPath, siteFilterPath=siteFilterPath, haplotypes=False, cloud=cloud, contig=contig)
+        snps, pos = probe.loadZarrArrays(genotypePath, positionsPath, siteFilterPath=siteFilterPath, haplotypes=False, cloud=cloud, contig=chrom)
+        dataParams = dict(genotypes=probe.zarrIdentity(genotypePath), positions=probe.zarrIdentity(positionsPath), siteFilter=probe.zarrIdentity(siteFilterPath))
 
-    callset = {'geno':snps, 'pos':pos, 'chrom':chrom}
     print(f"--- Running CompKaryo {inversion}--- ")
-    av_gts, total_sites, num_0, num_1, num_2 = probe.compkaryo(callset, inversion)
-    total_sites = total_sites.compute()
+    av_gts, total_sites = karyotype(inversion, chrom, snps, pos, cacheParams=dataParams)
     invDict[inversion] = pd.DataFrame({'partner_sample_id': metadata['sample_id'], 
                            'inversion':inversion, 
                            'mean_genotype': av_gts, 
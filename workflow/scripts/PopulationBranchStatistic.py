@@ -12,7 +12,6 @@ import probetools as probe
 import numpy as np
 import pandas as pd
 import allel
-import dask.array as da
 import seaborn as sns
 import matplotlib.pyplot as plt
 
@@ -25,6 +24,7 @@ windowStep = snakemake.params['windowStep']
 genotypePath = snakemake.input['genotypes']
 positionsPath = snakemake.input['positions']
 siteFilterPath = snakemake.input['siteFilters']
+probe.configureResultsCache(snakemake.config.get('ResultsCache'))
 
 # Outgroup data
 outgroupPath = snakemake.input['outgroupPath']
@@ -33,71 +33,72 @@ Mali2004Meta = pd.read_csv(outgroupMetaPath)
 species = pd.read_csv("resources/AG1000G-ML-B/samples.species_aim.csv")
 Mali2004Meta = Mali2004Meta.merge(species)
 
-# Read metadata 
-metadata = pd.read_csv(snakemake.params['metadata'], sep="\t")
-
 # Load arrays
 snps, pos = probe.loadZarrArrays(genotypePath, positionsPath, siteFilterPath=siteFilterPath)
 
-### Load outgroup Arrays and subset to each species, storing
+### Load outgroup Arrays, and label outgroup samples by species
 snpsOutgroup, pos = probe.loadZarrArrays(outgroupPath, positionsPath, siteFilterPath=siteFilterPath)
-snpsOutgroupDict = {}
+outgroupSpecies = ['gambiae', 'coluzzii']
+outgroupLabels = np.full(snpsOutgroup.shape[1], -1, dtype=np.int32)
+for i, sp in enumerate(outgroupSpecies):
+    outgroupLabels[(Mali2004Meta['species_gambiae_coluzzii'] == sp).to_numpy()] = i
+
+@probe.resultsCache("groupAlleleCounts", ignore=['gt'])
+def groupAlleleCounts(gt, labels):
+    # allele counts of every group, cached so that changing the windows does not recount them
+    return(probe.countAllelesCohorts(gt, labels, max_allele=3))
 
-for sp in ['gambiae', 'coluzzii']:
-    sp_bool = Mali2004Meta['species_gambiae_coluzzii'] == sp
-    snpsOutgroupDict[sp] =  snpsOutgroup.compress(sp_bool, axis=1)
+@probe.resultsCache("movingPBS", ignore=['threads'])
+def pbsScan(ac_pheno1, ac_pheno2, ac_out, size, step, threads=1):
+    return(probe.parallelMovingStatistic(probe.movingPBS, [ac_pheno1, ac_pheno2, ac_out], 
+                size=size, step=step, threads=threads, normed=True))
 
 #### Load cohort data and their indices in genotype data
-### run garudStat for that query. already loaded contigs
-cohorts = probe.getCohorts(metadata=metadata,
-                    columns=snakemake.params.columns,
-                    comparatorColumn=snakemake.params.comparatorColumn,
-                    minPopSize=snakemake.params.minPopSize,
-                    excludepath="resources/sib_group_table.csv")
+cohorts = probe.loadCohortManifest(*snakemake.input['cohorts'], comparatorColumn=snakemake.params.comparatorColumn)
 cohorts = cohorts.dropna()
 
 # Get name for phenotype of interest
 pheno1, pheno2 = cohorts['indices'].columns.to_list()
-
-# Loop through each cohort, manipulate genotype arrays and calculate chosen Garuds Statistic
+minPopSize = snakemake.params.minPopSize
+cohorts = cohorts[(cohorts['indices'][pheno1].apply(len) >= minPopSize) & (cohorts['indices'][pheno2].apply(len) >= minPopSize)].reset_index(drop=True)
+
+# Label each cohort's phenotype groups (cohort i -> 2i and 2i+1), with all remaining 
+# samples as a final group so the segregating-site mask can be taken over every sample
+groups = [idx for i, cohort in cohorts.iterrows() for idx in (cohort['indices'][pheno1], cohort['indices'][pheno2])]
+labels = probe.cohortLabels(groups, n_samples=snps.shape[1])
+labels[labels == -1] = len(groups)
+
+probe.log(f"--------- Counting alleles for {cohorts.shape[0]} {stat} cohorts and the outgroup | Chromosome {contig} ----------")
+siteFilter = probe.zarrIdentity(siteFilterPath)
+ac_groups = groupAlleleCounts(snps, labels, cacheParams=dict(contig=contig, genotypes=probe.zarrIdentity(genotypePath), siteFilter=siteFilter))
+ac_outgroup = groupAlleleCounts(snpsOutgroup, outgroupLabels, cacheParams=dict(contig=contig, genotypes=probe.zarrIdentity(outgroupPath), siteFilter=siteFilter))
+
+probe.log("filter to biallelic segregating sites")
+# N.B., if going to use to_n_alt later, need to make sure sites are 
+# biallelic and one of the alleles is the reference allele
+ac_all = allel.AlleleCountsArray(ac_groups.sum(axis=1))
+ref_ac = ac_all[:, 0]
+loc_sites = ac_all.is_biallelic() & (ref_ac > 0)
+
+ac_groups = ac_groups.compress(loc_sites, axis=0)
+ac_outgroup = ac_outgroup.compress(loc_sites, axis=0)
+pos_seg = np.asarray(pos).compress(loc_sites, axis=0)
+midpoint = probe.parallelMovingStatistic(allel.moving_statistic, pos_seg, size=windowSize, step=windowStep, threads=snakemake.threads, statistic=np.mean)
+
+assert ac_groups.shape[0] == pos_seg.shape[0], "Array phenotypes/POS are the wrong length"
+assert ac_outgroup.shape[0] == pos_seg.shape[0], "Array Outgroup/POS are the wrong length"
+
+# Calculate windowed PBS for each cohort from the allele counts, and plot figs
 for idx, cohort in cohorts.iterrows():
 
     probe.log(f"--------- Running {stat} on {cohort['cohortText'].to_list()} | Chromosome {contig} ----------")
-    probe.log("filter to biallelic segregating sites")    
     species = cohort['species'].to_list()[0]
-    if len(cohort['indices'][pheno1]) < snakemake.params.minPopSize:
-        continue
-    elif len(cohort['indices'][pheno2]) < snakemake.params.minPopSize:
-        continue
-    elif cohort['indices'][pheno1] == 'NaN':
-        continue
-    elif cohort['indices'][pheno2] == 'NaN':
-        continue
-
-    ac_cohort = snps.count_alleles(max_allele=3).compute()
-    # N.B., if going to use to_n_alt later, need to make sure sites are 
-    # biallelic and one of the alleles is the reference allele
-    ref_ac = ac_cohort[:, 0]
-    loc_sites = ac_cohort.is_biallelic() & (ref_ac > 0)
-    gt_seg = da.compress(loc_sites, snps, axis=0)
-    pos_seg = da.compress(loc_sites, pos, axis=0)
     
-    probe.log(f"compute input data for {stat}")
-    pos_seg = pos_seg.compute()
-    
-    ac_out = allel.GenotypeArray(da.compress(loc_sites, snpsOutgroupDict[species], axis=0)).count_alleles()
-    ac_pheno1 = allel.GenotypeArray(gt_seg).take(cohort['indices'][pheno1], axis=1).count_alleles()
-    ac_pheno2 = allel.GenotypeArray(gt_seg).take(cohort['indices'][pheno2], axis=1).count_alleles()
-        
-    assert ac_out.shape[0] == pos_seg.shape[0], "Array Outgroup/POS are the wrong length"
-    assert ac_pheno1.shape[0] == pos_seg.shape[0], "Array phenotype1/POS are the wrong length"
-    assert ac_pheno2.shape[0] == pos_seg.shape[0], "Arrays phenotype2/POS the wrong length"
-
-    probe.log("calculate PBS and plot figs")
-    # calculate PBS and plot figs 
-    pbsArray = allel.pbs(ac_pheno1, ac_pheno2, ac_out, 
-                window_size=windowSize, window_step=windowStep, normed=True)
-    midpoint = allel.moving_statistic(pos_seg, np.mean, size=windowSize, step=windowStep)
+    ac_out = allel.AlleleCountsArray(ac_outgroup[:, outgroupSpecies.index(species)])
+    ac_pheno1 = allel.AlleleCountsArray(ac_groups[:, 2*idx])
+    ac_pheno2 = allel.AlleleCountsArray(ac_groups[:, 2*idx + 1])
+
+    pbsArray = pbsScan(ac_pheno1, ac_pheno2, ac_out, size=windowSize, step=windowStep, threads=snakemake.threads)
     
     probe.windowedPlot(statName=stat, 
                 cohortText = cohort['cohortText'].to_numpy()[0],
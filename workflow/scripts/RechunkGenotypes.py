@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Rechunk genotypes. Writes a copy of a contig's genotypes with sample chunks aligned to the cohorts of every analysis, 
+which probe.loadZarrArrays() then reads in place of the input Zarr
+"""
+
+import sys
+sys.stderr = open(snakemake.log[0], "w")
+
+import probetools as probe
+
+contig = snakemake.wildcards['contig']
+genotypePath = snakemake.input['genotypes']
+manifests = snakemake.input['cohorts']
+
+# cohorts of every analysis, from the cohort manifests (table, indices pairs)
+indices = []
+for tablePath, indicesPath in zip(manifests[::2], manifests[1::2]):
+    indices.extend(probe.loadCohortManifest(tablePath, indicesPath)['indices'])
+
+probe.log(f"Rechunking {contig} genotypes for {len(indices)} cohorts")
+probe.rechunkGenotypes(genotypePath, 
+                       out=snakemake.output['genotypes'], 
+                       indices=indices, 
+                       variant_chunk=snakemake.params['variantChunk'], 
+                       min_block=snakemake.params['minSampleBlock'], 
+                       max_block=snakemake.params['maxSampleBlock'])
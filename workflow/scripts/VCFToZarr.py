@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+VCF to Zarr. Converts one contig of a bgzipped VCF to the Zarr arrays read by probe.loadZarrArrays()
+"""
+
+import sys
+sys.stderr = open(snakemake.log[0], "w")
+
+import probetools as probe
+
+contig = snakemake.wildcards['contig']
+
+probe.log(f"Converting {contig} of {snakemake.input['vcf']} to Zarr...")
+probe.vcfToZarr(snakemake.input['vcf'], 
+                out=snakemake.params['out'], 
+                contig=contig, 
+                threads=snakemake.threads, 
+                chunks=tuple(snakemake.params['chunks']))
@@ -18,10 +18,11 @@ import seaborn as sns
 #Selection Scans #
 cloud = snakemake.params['cloud']
 ag3_sample_sets = snakemake.params['ag3_sample_sets']
-contigs = ['2L', '2R', '3R', '3L', 'X']
 genotypePath = snakemake.params['genotypePath'] if not cloud else "placeholder_{contig}"
 positionsPath = snakemake.params['positionPath'] if not cloud else "placeholder2_{contig}"
 dataset = snakemake.params['dataset']
+ag3 = probe.connectAg3(snakemake.config['VObsCloud']) if cloud else None
+probe.configureResultsCache(snakemake.config.get('ResultsCache'))
 
 ## Read VOI data
 vois = pd.read_csv(snakemake.input['variants'], sep="\t")
@@ -32,24 +33,14 @@ vois['pos'] = vois['Location'].str.split(":").str.get(1).str.split("-").str.get(
 vois = vois.sort_values(['contig', 'pos'])
 
 
-# Load metadata 
-if cloud:
-    import malariagen_data
-    ag3 = malariagen_data.Ag3(pre=True)
-    metadata = ag3.sample_metadata(sample_sets=ag3_sample_sets)
-else:
-    metadata = pd.read_csv(snakemake.params['metadata'], sep="\t")
-
 # Load cohorts
-cohorts = probe.getCohorts(metadata=metadata, 
-                    columns=snakemake.params.columns, 
-                    minPopSize=snakemake.params.minPopSize)
+cohorts = probe.loadCohortManifest(*snakemake.input['cohorts'])
 
 
 
 snps = {}
 pos = {}
-for contig in contigs:
+for contig in vois['contig'].unique():
 
     probe.log(f"Loading arrays for {contig}")
     # Load Arrays
@@ -59,41 +50,49 @@ for contig in contigs:
                                              sample_sets=ag3_sample_sets,
                                              cloud=cloud,
                                              contig=contig,
-                                             haplotypes=False)
+                                             haplotypes=False,
+                                             ag3=ag3)
+
+
+@probe.resultsCache("voiAlleleCounts", ignore=['geno', 'pos'])
+def voiAlleleCounts(geno, pos, voiPos, labels):
+    # Locate all VOIs on a contig at once, read just their rows of the genotypes in one go, 
+    # and count alleles for every cohort together
+    rows = np.flatnonzero(pos.locate_keys(np.unique(voiPos), strict=False))
+    ac = probe.countAllelesCohorts(geno.take(rows, axis=0).compute(), labels, max_allele=3)
+    return(np.asarray(pos)[rows], ac)
+
+vois = vois.reset_index(drop=True)
+labels = probe.cohortLabels(cohorts['indices'], n_samples=snps[vois['contig'].iloc[0]].shape[1]) if len(vois) else None
+freqs = np.full((len(vois), len(cohorts)), np.nan)
+
+for contig, contigVois in vois.groupby('contig', sort=False):
+    voiPos = contigVois['pos'].astype(int).to_numpy()
+    foundPos, ac = voiAlleleCounts(snps[contig], pos[contig], voiPos, labels,
+                                   cacheParams=dict(contig=contig, 
+                                                    genotypes=probe.zarrIdentity(genotypePath.format(contig = contig)) if not cloud else None,
+                                                    positions=probe.zarrIdentity(positionsPath.format(contig = contig)) if not cloud else None,
+                                                    sample_sets=ag3_sample_sets if cloud else None))
+    probe.log(f"Found {len(foundPos)} of {len(voiPos)} variants of interest on {contig}")
     
+    # match each VOI to its row, VOIs missing from the Zarr are left as NaN
+    match = np.minimum(np.searchsorted(foundPos, voiPos), max(len(foundPos) - 1, 0))
+    found = (foundPos[match] == voiPos) if len(foundPos) else np.zeros(len(voiPos), dtype=bool)
+    ac = ac[match[found]]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        freqs[contigVois.index[found]] = (ac[:, :, 1:].sum(axis=2) / ac.sum(axis=2)).round(2)
 
 Dict = {}
-allCohorts = {}
+for i, row in vois.iterrows():
+    name = row['Name']
+    contig = row['contig']
+    voiPos = int(row['pos'])
+    longName = contig + ":"+ str(voiPos) + "  " + row['Gene'] + " | " + row['Name']
 
-for idx, cohort in cohorts.iterrows():
-    
-    for i, row in vois.iterrows():
-        name = row['Name']
-        contig = row['contig']
-        voiPos = int(row['pos'])
-        longName = contig + ":"+ str(voiPos) + "  " + row['Gene'] + " | " + row['Name']
-
-        VariantsOfInterest = pd.DataFrame([{'contig':contig, 'pos':voiPos, 'variant':name, 'name':longName}])
-
-        bool_ = pos[contig][:] == voiPos
-        
-        geno = snps[contig].compress(bool_, axis=0).take(cohort['indices'], axis=1)
-        ac = geno.count_alleles().compute()
-        # if there are no ALTs lets add the zeros for the ALTs otherwise only REF count returned 
-        aclength = ac.shape[1]
-        acneeded = 4-aclength
-        ac = np.append(ac, np.repeat(0, acneeded))
-        #get frequency and round
-        freqs = pd.DataFrame([ac/ac.sum().round(2)])
-        df2 = freqs.apply(pd.Series).rename(columns={0:'REF', 1:'ALT1', 2:'ALT2', 3:'ALT3'})
-        VariantsOfInterest[cohort['cohortText']] = df2.drop(columns=['REF']).sum(axis=1).round(2)
-        
-        Dict[name] = VariantsOfInterest
-    
-    allCohorts[idx] = pd.concat(Dict)
+    Dict[name] = pd.DataFrame([{'contig':contig, 'pos':voiPos, 'variant':name, 'name':longName, **dict(zip(cohorts['cohortText'], freqs[i]))}])
 
-# Concatenated the table and write table to TSV
-VariantsOfInterest = pd.concat(allCohorts, axis=1).T.drop_duplicates().T.droplevel(level=0, axis=1)
+# Concatenate the table and write table to TSV
+VariantsOfInterest = pd.concat(Dict)
 VariantsOfInterest.to_csv(f"results/variantsOfInterest/VOI.{dataset}.frequencies.tsv", sep="\t")
 
 #Drop unnecessary columns for plotting as heatmap
@@ -14,6 +14,7 @@ import zarr
 import pandas as pd
 import allel
 import dask.array as da
+import io
 from datetime import date
 from pathlib import Path
 
@@ -33,8 +34,7 @@ sampleNameColumn = 'partner_sample_id'
 
 # Load metadata 
 if cloud:
-    import malariagen_data
-    ag3 = malariagen_data.Ag3(pre=True)
+    ag3 = probe.connectAg3(snakemake.config['VObsCloud'])
     metadata = ag3.sample_metadata(sample_sets=ag3_sample_sets)
 else:
     metadata = pd.read_csv(snakemake.params['metadata'], sep="\t")
@@ -60,22 +60,22 @@ def write_vcf_header(vcf_file, contig):
     print('##contig=<ID=X,length=24393108>', file=vcf_file) if contig == 'X' else None
     print('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">', file=vcf_file)
 
-def ZarrToPandasToVCF(vcf_file, genotypePath, positionsPath, siteFilterPath, contig, nchunks=50, snpfilter = "segregating"):
+def ZarrToVCF(vcf_file, genotypePath, positionsPath, siteFilterPath, contig, snpfilter = "segregating", threads=1):
     
     """
-    Converts genotype and POS arrays to vcf, using pd dataframes in chunks. 
-    Segregating sites only. Needs REF and ALT arrays.
+    Converts genotype and POS arrays to a bgzipped, indexed vcf, with regions of the contig written in 
+    parallel by probe.parallelWriteVCF(). Segregating sites only. Needs REF and ALT arrays.
     """
     
     #if file exists ignore and skip
-    myfile = Path(f"{vcf_file}.gz")
+    myfile = Path(vcf_file)
     if myfile.is_file():
-        print(f"File {vcf_file}.gz Exists...")
+        print(f"File {vcf_file} Exists...")
         return
     
     probe.log(f"Loading array for {contig}...")
 
-    geno, pos = probe.loadZarrArrays(genotypePath, positionsPath, siteFilterPath=siteFilterPath, cloud=cloud, contig=contig, sample_sets=ag3_sample_sets, haplotypes=False)
+    geno, pos = probe.loadZarrArrays(genotypePath, positionsPath, siteFilterPath=siteFilterPath, cloud=cloud, contig=contig, sample_sets=ag3_sample_sets, haplotypes=False, ag3=ag3 if cloud else None)
     allpos = allel.SortedIndex(zarr.open_array(positionsPath)[:])
     ref_alt_filter = allpos.locate_intersection(pos)[0]
     
@@ -84,77 +84,39 @@ def ZarrToPandasToVCF(vcf_file, genotypePath, positionsPath, siteFilterPath, con
     
     if snpfilter == "segregating":
         probe.log("Find segregating sites...")
-        flt = geno.count_alleles().is_segregating()
-        geno = geno.compress(flt, axis=0)
+        flt = np.asarray(probe.countAlleles(geno).is_segregating())
+        variants = np.nonzero(flt)[0]
+        mapping = None
         positions = pos[flt]
         refs = refs[flt].astype(str)
         alts = [a +"," + b + "," + c for a,b,c in alts[flt].astype(str)]
     elif snpfilter == 'biallelic':
         probe.log("Finding biallelic sites and recoding to 0 and 1...")
-        ac = geno.count_alleles()
+        ac = probe.countAlleles(geno)
         flt = ac.is_biallelic()
-        geno = geno.compress(flt, axis=0)
-        ac = ac.compress(flt, axis=0).compute()
+        ac = ac.compress(flt, axis=0)
         ref0 = ac[:,0] > 0                      # Make sure one of bialleles is 0
-        geno = geno.compress(ref0, axis=0)
         ac = ac.compress(ref0, axis=0)
 
         alt_idx = np.where(ac[:,1:] > 0)[1]     # Get alt idx (is it 0,1,2)
-        mapping = np.tile(np.array([0,1,1,1]), reps=geno.shape[0]).reshape(geno.shape[0], 4) # create mapping to recode bialleles to 1 
-        geno = geno.map_alleles(mapping)
+        variants = np.nonzero(flt)[0][ref0]
+        mapping = np.array([0,1,1,1])           # recode bialleles to 1 as each call is written
         positions = pos[flt][ref0]
         refs = refs[flt].astype(str)[ref0]
         alts = np.take_along_axis(alts[flt][ref0].astype(str), alt_idx[:, None], axis=-1).flatten() # select correct ALT allele
     else:
         assert np.isin(snpfilter, ['segregating', "biallelic01"]).any(), "incorrect snpfilter value"
-  
-    probe.log("calculating chunks sizes...")
-    chunks = np.round(np.arange(0, geno.shape[0], geno.shape[0]/nchunks)).astype(int).tolist()
-    chunks.append(geno.shape[0])
 
-    for idx, chunk in enumerate(chunks[:-1]):
+    header = io.StringIO()
+    write_vcf_header(header, contig)
+    print("\t".join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + metadata[sampleNameColumn].astype(str).to_list()), file=header)
 
-        gn = geno[chunks[idx]:chunks[idx+1]].compute()
-        pos = positions[chunks[idx]:chunks[idx+1]]
-        ref = refs[chunks[idx]:chunks[idx+1]]
-        alt = alts[chunks[idx]:chunks[idx+1]]
-        
-        # Contruct SNP info DF
-        vcf_df = pd.DataFrame({'#CHROM': contig,
-                 'POS': pos,
-                 'ID': '.',
-                 'REF': ref,
-                 'ALT': alt,
-                 'QUAL': '.',
-                 'FILTER': '.',
-                 'INFO':'.',
-                'FORMAT': 'GT'})
-
-        probe.log(f"Pandas SNP info DataFrame constructed...{idx}")
-
-        # Geno to VCF
-        vcf = pd.DataFrame(gn.to_gt().astype(str), columns=metadata[sampleNameColumn])
-        probe.log("Concatenating info and genotype dataframes...")
-        vcf = pd.concat([vcf_df, vcf], axis=1)
-
-        probe.log(f"Pandas Genotype data constructed...{idx}")
-
-        if (idx==0) is True:
-            with open(f"{vcf_file}", 'w') as vcfheader:
-                    write_vcf_header(vcfheader, contig)
-
-        probe.log("Writing to .vcf")
-
-        vcf.to_csv(vcf_file, 
-                   sep="\t", 
-                   index=False,
-                   mode='a',
-                  header=(idx==0), 
-                  line_terminator="\n")
+    probe.log(f"Writing {len(variants)} variants to {vcf_file} with {threads} processes...")
+    probe.parallelWriteVCF(vcf_file, header.getvalue(), contig, geno, positions, refs, alts, variants=variants, mapping=mapping, threads=threads)
 
 
 
 ### MAIN ####
 
-#ZarrToPandasToVCF(f"../resources/vcfs/ag3_gaardian_{contig}.multiallelic.vcf", genotypePath, positionsPath, siteFilterPath, contig, snpfilter="segregating")
-ZarrToPandasToVCF(f"resources/vcfs/{dataset}_{contig}.biallelic.vcf", genotypePath, positionsPath, siteFilterPath, contig, snpfilter="biallelic")
\ No newline at end of file
+#ZarrToVCF(f"resources/vcfs/ag3_gaardian_{contig}.multiallelic.vcf.gz", genotypePath, positionsPath, siteFilterPath, contig, snpfilter="segregating")
+ZarrToVCF(snakemake.output['biallelicVCF'], genotypePath, positionsPath, siteFilterPath, contig, snpfilter="biallelic", threads=snakemake.threads)
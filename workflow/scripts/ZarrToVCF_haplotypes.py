@@ -9,25 +9,28 @@ Zarr to VCF. Needs providing with REF and ALT and allpositions files.
 import sys
 #sys.stderr = open(snakemake.log[0], "w")
 
+import probetools as probe
 import numpy as np
 import zarr
 import pandas as pd
 import allel
 import dask.array as da
+import io
+import os
 from datetime import date
 from pathlib import Path
 
-def ZarrToPandasToHaplotypeVCF(vcf_file, metadata, sample_sets, contig, sample_query=None, analysis='gamb_colu', nchunks=50, sampleNameColumn = 'partner_sample_id'):
+def ZarrToHaplotypeVCF(vcf_file, metadata, sample_sets, contig, sample_query=None, analysis='gamb_colu', sampleNameColumn = 'partner_sample_id', threads=1):
     
     """
-    Converts genotype and POS arrays to vcf, using pd dataframes in chunks. 
-    Segregating sites only. Needs REF and ALT arrays.
+    Converts phased haplotypes to a bgzipped, indexed vcf, with regions of the contig written in 
+    parallel by probe.parallelWriteVCF(). 
     """
     
     #if file exists ignore and skip
-    myfile = Path(f"{vcf_file}.gz")
+    myfile = Path(vcf_file)
     if myfile.is_file():
-        print(f"File {vcf_file}.gz Exists...")
+        print(f"File {vcf_file} Exists...")
         return
     
     print(f"Loading array for {contig}...")
@@ -35,55 +38,17 @@ def ZarrToPandasToHaplotypeVCF(vcf_file, metadata, sample_sets, contig, sample_q
     ds_haps = ag3.haplotypes(contig, sample_sets=sample_sets, sample_query=sample_query, analysis=analysis)
     sample_ids = ds_haps['sample_id'].values
     metadata = metadata.set_index('sample_id').loc[sample_ids, :].reset_index()
-    positions = ds_haps['variant_position']
-    geno = allel.GenotypeDaskArray(ds_haps['call_genotype'])
+    positions = ds_haps['variant_position'].values
 
     refs = ds_haps['variant_allele'][:,0].compute().values.astype(str)
     alts = ds_haps['variant_allele'][:,1].compute().values.astype(str)
-  
-    print("calculating chunks sizes...")
-    chunks = np.round(np.arange(0, geno.shape[0], geno.shape[0]/nchunks)).astype(int).tolist()
-    chunks.append(geno.shape[0])
-
-    for idx, chunk in enumerate(chunks[:-1]):
-
-        gn = geno[chunks[idx]:chunks[idx+1]].compute()
-        pos = positions[chunks[idx]:chunks[idx+1]]
-        ref = refs[chunks[idx]:chunks[idx+1]]
-        alt = alts[chunks[idx]:chunks[idx+1]]
-        
-        # Contruct SNP info DF
-        vcf_df = pd.DataFrame({'#CHROM': contig,
-                 'POS': pos,
-                 'ID': '.',
-                 'REF': ref,
-                 'ALT': alt,
-                 'QUAL': '.',
-                 'FILTER': '.',
-                 'INFO':'.',
-                'FORMAT': 'GT'})
-
-        print(f"Pandas SNP info DataFrame constructed...{idx}")
-
-        # Geno to VCF
-        vcf = pd.DataFrame(np.char.replace(gn.to_gt().astype(str), "/", "|"), columns=metadata[sampleNameColumn])
-        print("Concatenating info and genotype dataframes...")
-        vcf = pd.concat([vcf_df, vcf], axis=1)
-
-        print(f"Pandas Genotype data constructed...{idx}")
-
-        if (idx==0) is True:
-            with open(f"{vcf_file}", 'w') as vcfheader:
-                    write_vcf_header(vcfheader, contig)
-
-        print("Writing to .vcf")
-
-        vcf.to_csv(vcf_file, 
-                   sep="\t", 
-                   index=False,
-                   mode='a',
-                  header=(idx==0), 
-                  lineterminator="\n")
+
+    header = io.StringIO()
+    write_vcf_header(header, contig)
+    print("\t".join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + metadata[sampleNameColumn].astype(str).to_list()), file=header)
+
+    print(f"Writing {len(positions)} haplotypes to {vcf_file} with {threads} processes...")
+    probe.parallelWriteVCF(vcf_file, header.getvalue(), contig, ds_haps['call_genotype'].data, positions, refs, alts, phased=True, threads=threads)
 
 def write_vcf_header(vcf_file, contig):
     """
@@ -115,18 +80,17 @@ dataset = 'llineup' #snakemake.params['dataset']
 sampleNameColumn = 'partner_sample_id'
 sample_query = 'taxon == "gambiae"'
 
-import malariagen_data
-ag3 = malariagen_data.Ag3(pre=True)
+ag3 = probe.connectAg3(snakemake.config['VObsCloud'])
 metadata = ag3.sample_metadata(sample_sets=ag3_sample_sets, sample_query=sample_query)
 
 print(f"Running for {contig}...")
 
 ### MAIN ####
-ZarrToPandasToHaplotypeVCF(
-     f"resources/vcfs/{dataset}_{contig}.haplotypes.vcf", 
+ZarrToHaplotypeVCF(
+     f"resources/vcfs/{dataset}_{contig}.haplotypes.vcf.gz", 
      metadata=metadata,
      sample_query=sample_query,
      contig=contig, 
-     nchunks=20, 
-     sample_sets=ag3_sample_sets
-    )
\ No newline at end of file
+     sample_sets=ag3_sample_sets,
+     threads=snakemake.threads
+    )
@@ -16,7 +16,7 @@ import allel
 import dask.array as da
 import seaborn as sns
 import matplotlib.pyplot as plt
-from numba import njit
+from numba import njit, prange
 
 cloud = snakemake.params['cloud']
 ag3_sample_sets = snakemake.params['ag3_sample_sets']
@@ -27,103 +27,96 @@ positionsPath = snakemake.params['positions']
 
 # Load metadata 
 if cloud:
-    import malariagen_data
-    ag3 = malariagen_data..Ag3(pre=True)
+    ag3 = probe.connectAg3(snakemake.config['VObsCloud'])
     metadata = ag3.sample_metadata(sample_sets=ag3_sample_sets)
 else:
     metadata = pd.read_csv(snakemake.params['metadata'], sep="\t")
 
 
 @njit()
-def scanRight(geno1, geno2, upperBreakpoint, max): 
-    # Reset position for next loop
-    gn1 = geno1[upperBreakpoint]
-    gn2 = geno2[upperBreakpoint]
-
-    # Scan right along genome, as long as two inds are not both homozygous but different
-    while not (gn1[0] == gn1[1]) & (gn2[0] == gn2[1]) & ((gn1 != gn2).all()) & (-1 not in gn1 and -1 not in gn2):
-
-        upperBreakpoint += 1
-        if upperBreakpoint == max-1: # limit the upper breakpoint at end of the contig
-            return(upperBreakpoint)
-
-        gn1 = geno1[upperBreakpoint]
-        gn2 = geno2[upperBreakpoint]
-        
-    return(upperBreakpoint)
+def opposingHomozygotes(planes, s, t, w):
+    # bits of the 64 variants in word w where samples s and t are both homozygous, for different alleles
+    hom_s = np.uint64(0)
+    hom_t = np.uint64(0)
+    same = np.uint64(0)
+    for allele in range(planes.shape[0]):
+        hom_s |= planes[allele, s, w]
+        hom_t |= planes[allele, t, w]
+        same |= planes[allele, s, w] & planes[allele, t, w]
+    return(hom_s & hom_t & ~same)
 
 @njit()
-def scanLeft(geno1, geno2, lowerBreakpoint): 
-
-    # subset genotypes to this position, because we need somethign to start the while loop?
-    gn1 = geno1[lowerBreakpoint]
-    gn2 = geno2[lowerBreakpoint]
-
-    # Scan left along genome
-    while not (gn1[0] == gn1[1]) & (gn2[0] == gn2[1]) & ((gn1 != gn2).all()) & (-1 not in gn1 and -1 not in gn2):
-
-        lowerBreakpoint -= 1
-        if lowerBreakpoint == 0: # limit lower breakpoint at zero, start of contig
-            return(lowerBreakpoint)
-
-        gn1 = geno1[lowerBreakpoint]
-        gn2 = geno2[lowerBreakpoint]
-        
-    return(lowerBreakpoint)
-
+def scanRight(planes, s, t, upperBreakpoint, max):
+    # Scan right along genome a word at a time, until the two inds are both homozygous but different
+    w = upperBreakpoint // 64
+    word = opposingHomozygotes(planes, s, t, w) & (~np.uint64(0) << np.uint64(upperBreakpoint % 64))
+    while word == 0:
+        w += 1
+        if w == planes.shape[2]: # limit the upper breakpoint at end of the contig
+            return(max - 1)
+        word = opposingHomozygotes(planes, s, t, w)
+
+    bit = 0
+    while (word >> np.uint64(bit)) & np.uint64(1) == 0:
+        bit += 1
+    return(min(w * 64 + bit, max - 1))
 
 @njit()
-def f2scans(dblton_arr, snps, pos):
-
-    starts = []# np.empty((len(dblton_arr)),dtype='uint8')
-    ends = []# np.empty((len(dblton_arr)),dtype='uint8')
-    dbltonpos = []
-
-    for idx in range(0, len(dblton_arr)):
-
-        geno1 = snps[:, dblton_arr[idx][0]]
-        geno2 = snps[:, dblton_arr[idx][1]]
-        # get boolean of dblton idx
-        #dblton_idx = bisect.bisect_left(pos, dblton_arr[idx][2])
-        dblton_idx = np.searchsorted(pos, dblton_arr[idx][2])
-
-        upperBreakpoint = scanRight(geno1, geno2, dblton_idx, len(pos))
-        # Scan left along genome
-        lowerBreakpoint = scanLeft(geno1, geno2, dblton_idx)
-
-        starts.append(pos[lowerBreakpoint])
-        ends.append(pos[upperBreakpoint])
-        dbltonpos.append(dblton_arr[idx][2])
+def scanLeft(planes, s, t, lowerBreakpoint):
+    # Scan left along genome a word at a time
+    w = lowerBreakpoint // 64
+    word = opposingHomozygotes(planes, s, t, w) & (~np.uint64(0) >> np.uint64(63 - lowerBreakpoint % 64))
+    while word == 0:
+        w -= 1
+        if w < 0: # limit lower breakpoint at zero, start of contig
+            return(0)
+        word = opposingHomozygotes(planes, s, t, w)
+
+    bit = 63
+    while (word >> np.uint64(bit)) & np.uint64(1) == 0:
+        bit -= 1
+    return(w * 64 + bit)
+
+
+@njit(parallel=True)
+def f2scans(pairs, dblton_idx, planes, n_variants):
+
+    # each doubleton is scanned independently, so spread them across threads
+    starts = np.empty(len(pairs), dtype=np.int64)
+    ends = np.empty(len(pairs), dtype=np.int64)
+    for idx in prange(len(pairs)):
+        ends[idx] = scanRight(planes, pairs[idx, 0], pairs[idx, 1], dblton_idx[idx], n_variants)
+        starts[idx] = scanLeft(planes, pairs[idx, 0], pairs[idx, 1], dblton_idx[idx])
     
-    return(np.array(starts), np.array(ends), np.array(dbltonpos))
+    return(starts, ends)
 
 
 
 ########## main #################
 
 
-snps = {}
-pos = {}
-
 # Load Arrays
 snps, pos = probe.loadZarrArrays(genotypePath=genotypePath, 
                                             positionsPath=positionsPath,
                                             siteFilterPath=None,
-                                            cloud=cloud)
-ac = snps.count_alleles()
-seg = ac.is_segregating()
-snps = snps.compress(seg, axis=0).compute(numworkers=12)
-pos = pos[seg]
+                                            cloud=cloud,
+                                            ag3=ag3 if cloud else None)
+seg = np.asarray(probe.countAlleles(snps).is_segregating())
+snps = snps.compress(seg, axis=0)
+pos = np.asarray(pos)[seg]
+
+# Bit-pack where each sample is homozygous for each allele, so scans can skip 64 SNPs at a time
+planes = probe.homozygotePlanes(snps)
 
 ### Load doubletons
 dblton = pd.read_csv(snakemake.input['f2variantPairs'], sep="\t")
 dblton = dblton.query("contig == @contig")
-dblton_arr = dblton[['idx1', 'idx2', 'pos']].to_numpy()
+pairs = dblton[['idx1', 'idx2']].to_numpy()
+dbltonpos = dblton['pos'].to_numpy()
+dblton_idx = np.searchsorted(pos, dbltonpos)
 
-# extract np array 
-snps = snps.values
 # Run F2 hap length scans
-starts, ends, dbltonpos = f2scans(dblton_arr, snps, pos)
+starts, ends = f2scans(pairs, dblton_idx, planes, len(pos))
 
-f2hapdf = pd.DataFrame({'start':starts, 'end':end, 'dbltonpos':dbltonpos})
-f2hapdf.to_csv(f"results/f2HapLengths_{contig}.tsv", sep="\t")
\ No newline at end of file
+f2hapdf = pd.DataFrame({'start':pos[starts], 'end':pos[ends], 'dbltonpos':dbltonpos})
+f2hapdf.to_csv(f"results/f2HapLengths_{contig}.tsv", sep="\t")
@@ -32,17 +32,16 @@ results_dir = snakemake.params['data']
 
 # Load metadata 
 if cloud:
-    import malariagen_data
-    ag3 = malariagen_data..Ag3(pre=True)
+    ag3 = probe.connectAg3(snakemake.config['VObsCloud'])
     metadata = ag3.sample_metadata(sample_sets=ag3_sample_sets)
 else:
     metadata = pd.read_csv(snakemake.params['metadata'], sep="\t")
 
 # Load Arrays
-snps, pos = probe.loadZarrArrays(genotypePath, positionsPath, siteFilterPath=siteFilterPath, cloud=cloud, haplotypes=False, contig=contig)
+snps, pos = probe.loadZarrArrays(genotypePath, positionsPath, siteFilterPath=siteFilterPath, cloud=cloud, haplotypes=False, contig=contig, ag3=ag3 if cloud else None)
 
 # Determine cohorts
-cohorts = probe.getCohorts(metadata, columns=pcaColumn)
+cohorts = probe.loadCohortManifest(*snakemake.input['cohorts'])
 
 
 # choose colours for species
@@ -56,10 +55,11 @@ species_color_map = {
 }
 
 
-# Run PCA on whole dataset together
+# Run PCA on whole dataset together, saving its Gram matrix for the whole genome PCA
 data, evr = probe.run_pca(contig=contig, gt=snps, pos=pos, df_samples=metadata,
-    sample_sets=dataset, results_dir=results_dir
+    sample_sets=dataset, results_dir=results_dir, gram_path=snakemake.output['gram'][0]
 )
+data.to_csv(snakemake.output['tsvAll'][0], sep="\t", index=False)
 evr = evr.astype("float").round(4) # round decimals for variance explained % 
 
 probe.plot_coords(data, evr, title=f" PCA | {dataset} | {contig}", filename=f"results/PCA/{dataset}.{contig}.html")
@@ -74,16 +74,13 @@ plt.savefig(f"results/PCA/{dataset}.{contig}.png")
 
 
 
-# Loop through each cohort, manipulate genotype arrays and calculate chosen Garuds Statistic
-for idx, cohort in cohorts.iterrows():
+# Run the PCA of every cohort in one pass, then plot each
+cohortResults = probe.run_pca_cohorts(contig=contig, gt=snps, pos=pos, df_samples=metadata,
+    cohorts=cohorts, results_dir=results_dir
+)
+
+for (idx, cohort), (data, evr) in zip(cohorts.iterrows(), cohortResults):
 
-    # filter to correct loc, year, species individuals
-    gt_cohort = snps.take(cohort['indices'], axis=1)
-    meta = metadata.take(cohort['indices'])
-    
-    data, evr = probe.run_pca(contig=contig, gt=gt_cohort, pos=pos, df_samples=meta,
-        sample_sets=cohort['cohortNoSpaceText'], results_dir=results_dir
-    )
     evr = evr.astype("float").round(4)
 
     probe.plot_coords(data, evr, title=f" PCA | {cohort['cohortText']} | {contig}", filename=f"results/PCA/{cohort['cohortNoSpaceText']}.{contig}.html")
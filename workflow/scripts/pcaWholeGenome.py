@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Whole genome pca, combining the Gram matrices of the per-contig PCAs
+"""
+
+import sys
+sys.stderr = open(snakemake.log[0], "w")
+
+import probetools as probe
+import pandas as pd
+import seaborn as sns
+import matplotlib.pyplot as plt
+
+
+cloud = snakemake.params['cloud']
+ag3_sample_sets = snakemake.params['ag3_sample_sets']
+dataset = snakemake.params['dataset']
+
+# Load metadata 
+if cloud:
+    ag3 = probe.connectAg3(snakemake.config['VObsCloud'])
+    metadata = ag3.sample_metadata(sample_sets=ag3_sample_sets)
+else:
+    metadata = pd.read_csv(snakemake.params['metadata'], sep="\t")
+
+# Sum the contigs' Gram matrices, one at a time
+coords, evr = probe.wholeGenomePCA(snakemake.input['grams'])
+
+data = metadata.copy()
+for i in range(coords.shape[1]):
+    data[f'PC{i+1}'] = coords[:, i]
+data.to_csv(snakemake.output['tsv'][0], sep="\t", index=False)
+evr = evr.astype("float").round(4) # round decimals for variance explained % 
+
+probe.plot_coords(data, evr, title=f" PCA | {dataset} | whole genome", filename=snakemake.output['html'][0])
+
+fig = plt.figure(figsize=(10, 10))
+fig = sns.scatterplot('PC1','PC2', data=data, hue="species_gambiae_coluzzii")
+fig.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+plt.title(f"PCA | {dataset} | whole genome", fontsize=14)
+plt.xlabel(f"PC1 ({evr[0]*100} % variance explained)", fontdict={"fontsize":14})
+plt.ylabel(f"PC2 ({evr[1]*100} % variance explained)", fontdict={"fontsize":14})
+plt.savefig(snakemake.output['png'][0])
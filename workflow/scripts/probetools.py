@@ -1,4 +1,5 @@
 import sys
+import os
 import pandas as pd
 import allel
 import matplotlib
@@ -14,6 +15,19 @@ import dask.array as da
 dask.config.set(**{'array.slicing.split_large_chunks': False})
 import bisect
 import hashlib
+import itertools
+import glob
+import io
+import fcntl
+import contextlib
+import functools
+import inspect
+import fsspec
+import struct
+import zlib
+import gzip
+import numcodecs
+from numba import njit
 # quieten dask warnings about large chunks
 import plotly.express as px
 
@@ -22,74 +36,2011 @@ def log(*msg):
     sys.stdout.flush()
 
 
-def getCohorts(metadata, columns=['species_gambiae_coluzzii', 'location'], comparatorColumn=None, minPopSize=15, excludepath=None):
+def getCohorts(metadata, columns=['species_gambiae_coluzzii', 'location'], comparatorColumn=None, minPopSize=15, excludepath=None, pivot=True):
     
     firstCol = columns[0]
-    # subset metadata dataFrame and find combinations of variables with more than minPopSize individuals
-    cohorts = metadata[columns]
-    cohorts = cohorts.groupby(columns).size().reset_index().rename(columns={0:'size'})
-    cohorts = cohorts[cohorts['size'] > minPopSize][columns]
+    # find combinations of variables and the positions of their individuals in one groupby pass
+    cohorts, idxs = cohortIndices(metadata, columns=columns, minPopSize=minPopSize, excludepath=excludepath)
     
     if comparatorColumn != None:
         cols = [i for i in columns if i != comparatorColumn]
     else:
         cols = columns
+    
+    cohorts['indices'] = idxs
+    cohorts['cohortText'] = cohorts[cols].astype(str).agg(' | '.join, axis=1)
+    cohorts['cohortNoSpaceText'] = cohorts['cohortText'].str.replace("|", ".", regex=False).str.replace(" ", "",regex=False)
+    colours = get_colour_dict(cohorts[firstCol], palette="Set1")
+    cohorts['colour'] = cohorts[firstCol].map(colours)
+    if comparatorColumn != None and pivot: 
+        return(pivotCohorts(cohorts, comparatorColumn))
+
+    return(cohorts.reset_index(drop=True))
+
+def pivotCohorts(cohorts, comparatorColumn):
+
+    """
+    Pivots a cohorts DataFrame so that there is one row per cohort, and one indices column per value of comparatorColumn
+    """
+
+    cols = [col for col in cohorts.columns if col not in ['indices', comparatorColumn]]
+    cohorts = cohorts.pivot(index=cols, columns=comparatorColumn)
+    return(cohorts.reset_index())
+
+def cohortIndices(metadata, columns, minPopSize=15, excludepath=None):
+
+    """
+    Groups metadata by the cohort columns in a single pass, returning a DataFrame of the cohorts with 
+    more than minPopSize individuals and a list of int32 arrays of the row positions of each cohort. 
+    If excludepath is given, sib samples (keep == False) and males are dropped from every cohort.
+    """
+
+    groups = metadata.groupby(columns).indices
+    keys = [key if isinstance(key, tuple) else (key,) for key in groups.keys()]
+    cohorts = pd.DataFrame(keys, columns=columns)
+    sizes = np.array([len(loc) for loc in groups.values()])
+    
+    keep = np.ones(metadata.shape[0], dtype=bool)
+    if excludepath is not None:
+        # read the sib exclusion table once, rather than once per cohort
+        exclude_df = pd.read_csv(excludepath, sep="\t")
+        exclude_samples = exclude_df.query("keep == False")['sample.name']
+        keep = (~metadata['partner_sample_id'].isin(exclude_samples) & (metadata['sex_call'] == 'F')).to_numpy()
+        print(f"Removing {len(exclude_samples)} sib samples from data")
+
+    idxs = [loc[keep[loc]].astype(np.int32) for loc, size in zip(groups.values(), sizes) if size > minPopSize]
+    cohorts = cohorts[sizes > minPopSize].reset_index(drop=True)
+    return(cohorts, idxs)
+
+def writeCohortManifest(cohorts, tablePath, indicesPath):
+
+    """
+    Writes an unpivoted cohorts DataFrame to disk as a cohort manifest. The cohort table is written
+    as a .tsv with start and stop offsets into a single flat .npy array holding every cohort's indices.
+    """
+
+    sizes = np.array([len(idx) for idx in cohorts['indices']], dtype=np.int64)
+    stops = np.cumsum(sizes)
+    table = cohorts.drop(columns='indices').assign(start=stops - sizes, stop=stops)
+    indices = np.concatenate([np.asarray(idx, dtype=np.int32) for idx in cohorts['indices']]) if len(sizes) else np.empty(0, dtype=np.int32)
+
+    table.to_csv(tablePath, sep="\t", index=False)
+    np.save(indicesPath, indices)
+
+def loadCohortManifest(tablePath, indicesPath, comparatorColumn=None):
+
+    """
+    Loads a cohort manifest written by writeCohortManifest(). The indices array is memory-mapped, and each
+    cohort's indices are a view into it. Returns the same DataFrame as getCohorts().
+    """
+
+    table = pd.read_csv(tablePath, sep="\t", keep_default_na=False)
+    indices = np.load(indicesPath, mmap_mode='r')
+    
+    cohorts = table.drop(columns=['start', 'stop'])
+    cohorts.insert(cohorts.columns.get_loc('cohortText'), 'indices', [indices[start:stop] for start, stop in zip(table['start'], table['stop'])])
+    if comparatorColumn != None:
+        return(pivotCohorts(cohorts, comparatorColumn))
+
+    return(cohorts)
+
+@contextlib.contextmanager
+def _storeLock(storage):
+    with open(os.path.join(storage, ".lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _evictLRU(storage, max_size):
+
+    """
+    Removes the least recently used files in the subdirectories of a store until it is under 80% of max_size. 
+    Must hold the store's lock.
+    """
+
+    entries = [entry for d in os.scandir(storage) if d.is_dir() for entry in os.scandir(d.path) if not entry.name.endswith('.tmp')]
+    entries = sorted(entries, key=lambda entry: entry.stat().st_mtime)
+    total = sum(entry.stat().st_size for entry in entries)
+    for entry in entries:
+        if total <= 0.8 * max_size:
+            break
+        with contextlib.suppress(FileNotFoundError):
+            total -= entry.stat().st_size
+            os.remove(entry.path)
+    return(total)
+
+def _accountLRU(storage, nbytes, max_size):
+
+    """
+    Adds nbytes to the size of a store, kept in its .size file, evicting the least recently used files 
+    if it is over max_size.
+    """
+
+    sizePath = os.path.join(storage, ".size")
+    with _storeLock(storage):
+        total = int(open(sizePath).read() or 0) + nbytes if os.path.exists(sizePath) else nbytes
+        if total > max_size:
+            total = _evictLRU(storage, max_size)
+        with open(sizePath, "w") as f:
+            f.write(str(total))
+
+class ChunkCacheFileSystem(fsspec.AbstractFileSystem):
+
+    """
+    A read-only fsspec filesystem that keeps whole files (i.e. Zarr chunks) of a target filesystem in a shared 
+    on-disk cache, keyed by a hash of each file's URL. The cache is bounded to max_size bytes by evicting the 
+    least recently used files. It is safe for concurrent processes: files are written atomically, and the size 
+    accounting and eviction are done under a file lock. Open it with the target protocol as an option, e.g. 
+    fsspec.filesystem("chunkcache", target_protocol="gs"), or target_protocol="file" to stand in a local copy of the release.
+    """
+
+    protocol = "chunkcache"
+
+    def __init__(self, target_protocol=None, target_options=None, fs=None, cache_storage="resources/chunkcache", max_size=50 * 2**30, **kwargs):
+        super().__init__(**kwargs)
+        self.fs = fs if fs is not None else fsspec.filesystem(target_protocol, **(target_options or {}))
+        self.storage = os.path.abspath(cache_storage)
+        self.max_size = max_size
+        os.makedirs(self.storage, exist_ok=True)
+
+    def _path(self, path):
+        key = hashlib.sha256(self.fs.unstrip_protocol(path).encode()).hexdigest()
+        return(os.path.join(self.storage, key[:2], key))
+
+    def _account(self, nbytes):
+        _accountLRU(self.storage, nbytes, self.max_size)
+
+    def _fetch(self, path):
+        cached = self._path(path)
+        try:
+            with open(cached, 'rb') as f:
+                data = f.read()
+            os.utime(cached) # mark as recently used
+            return(data)
+        except FileNotFoundError:
+            pass
+
+        data = self.fs.cat_file(path)
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        tmp = f"{cached}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, cached)
+        self._account(len(data))
+        return(data)
+
+    def cat_file(self, path, start=None, end=None, **kwargs):
+        return(self._fetch(path)[start:end])
+
+    def _open(self, path, mode='rb', **kwargs):
+        if mode != 'rb':
+            raise NotImplementedError("The chunk cache is read-only")
+        return(io.BytesIO(self._fetch(path)))
+
+    def ls(self, path, detail=True, **kwargs):
+        return(self.fs.ls(path, detail=detail, **kwargs))
+
+    def info(self, path, **kwargs):
+        return(self.fs.info(path, **kwargs))
+
+fsspec.register_implementation(ChunkCacheFileSystem.protocol, ChunkCacheFileSystem, clobber=True)
+
+_ag3Connections = {}
+
+def connectAg3(cloudConfig=None, pre=True):
+
+    """
+    Connects to the Ag3 release through the shared chunk cache, as configured under VObsCloud in the config 
+    (url, and cache path and maxSizeGB), so that concurrent jobs download each chunk only once. Connections are 
+    reused within a process.
+    """
+
+    cloudConfig = cloudConfig or {}
+    url = cloudConfig.get('url') or "gs://vo_agam_release"
+    cache = cloudConfig.get('cache') or {}
+    key = (url, json.dumps(cache, sort_keys=True), pre)
+
+    if key not in _ag3Connections:
+        protocol, path = fsspec.core.split_protocol(url)
+        _ag3Connections[key] = malariagen_data.Ag3(
+                    "chunkcache://" + path,
+                    pre=pre,
+                    chunkcache=dict(target_protocol=protocol or "file", cache_storage=cache.get('path', "resources/chunkcache"), 
+                                    max_size=int(cache.get('maxSizeGB', 50) * 2**30))
+                )
+    return(_ag3Connections[key])
+
+def loadZarrArrays(genotypePath, positionsPath, siteFilterPath, cloud=False, sample_sets=None, site_filter='gamb_colu', contig=None, haplotypes=False, ag3=None):
+
+    """
+    This function reads genotype arrays and applies provided site filter, or connects to Ag3 malariagen API.
+    siteFilterPath=None reads the arrays unfiltered. In cloud mode, ag3 is a connection from connectAg3(), which is made with the default cache if not given.
+    """
+
+    if cloud == False:
+        # use the cohort-chunked copy of the genotypes, if one has been written for this array
+        rechunked = findRechunkedGenotypes(genotypePath)
+        if rechunked is not None:
+            log(f"Reading genotypes from cohort-chunked copy {rechunked}")
+            snps = loadRechunkedGenotypes(rechunked)
+        else:
+            snps = zarr.open_array(genotypePath, mode = 'r')
+        snps = allel.GenotypeDaskArray(snps) if haplotypes == False else allel.GenotypeDaskArray(snps).to_haplotypes()
+        positions = zarr.open_array(positionsPath, mode='r')
+
+        if siteFilterPath is not None:
+            # read the site filter from the mask store, as packed bits, if it has been seen before
+            filters = cachedMask('siteFilter', lambda: zarr.open(siteFilterPath, mode="r")[:], contig=contig, siteFilter=dataIdentity(siteFilterPath))
+            positions = positions[:][filters]    
+            snps = snps.compress(filters, axis=0)
+
+    elif cloud == True:
+        ag3 = connectAg3() if ag3 is None else ag3
+        
+        if haplotypes == True:
+            snps = ag3.haplotypes(contig, sample_sets=sample_sets, analysis='gamb_colu')
+            positions = snps['variant_position']
+            snps = allel.GenotypeDaskArray(snps).to_haplotypes()
+        else:
+            snps = allel.GenotypeDaskArray(ag3.snp_genotypes(region=contig, sample_sets=sample_sets, site_mask=site_filter))
+            positions = ag3.snp_sites(region=contig, field='POS', site_mask=site_filter)
+            
+    return(snps, allel.SortedIndex(positions))
+
+def dataIdentity(path):
+
+    """
+    Identifies a Zarr array (or any file) on disk by its absolute path and modification time, for use in cache keys. 
+    """
+
+    if not path:
+        return(None)
+    path = os.path.abspath(path)
+    meta = os.path.join(path, '.zarray')
+    return({'path':path, 'mtime':os.path.getmtime(meta if os.path.exists(meta) else path)})
+
+def zarrIdentity(path):
+
+    """
+    Identifies a Zarr array on disk by its absolute path and a checksum of the names, sizes and modification times 
+    of all its chunk files, so that rewriting any chunk changes it, for use in cache keys. Other files are 
+    identified by dataIdentity().
+    """
+
+    if not path or not os.path.isdir(path):
+        return(dataIdentity(path))
+    path = os.path.abspath(path)
+    checksum = hashlib.md5()
+    for root, dirs, files in sorted(os.walk(path)):
+        dirs.sort()
+        for name in sorted(files):
+            stat = os.stat(os.path.join(root, name))
+            checksum.update(f"{os.path.relpath(os.path.join(root, name), path)}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return({'path':path, 'chunks':checksum.hexdigest()})
+
+def cohortSampleBlocks(indices, n_samples, min_block=32, max_block=256):
+
+    """
+    Splits the samples into contiguous blocks whose boundaries fall where cohort membership changes, so 
+    that a cohort's samples fill whole blocks wherever possible. indices is a list of cohort index arrays, which 
+    may come from several analyses (i.e. overlap). Runs of samples narrower than min_block are merged with the 
+    next run and runs wider than max_block are split. Returns the block boundaries, starting at 0 and ending at n_samples.
+    """
+
+    # samples with the same cohorts in every analysis share a membership code
+    membership = np.zeros((n_samples, len(indices)), dtype=bool)
+    for i, idx in enumerate(indices):
+        membership[np.asarray(idx, dtype=np.int64), i] = True
+    _, codes = np.unique(membership, axis=0, return_inverse=True)
+    codes = codes.reshape(-1)
+    runs = np.concatenate([[0], np.flatnonzero(np.diff(codes)) + 1, [n_samples]])
+
+    bounds = [0]
+    for stop in runs[1:]:
+        while stop - bounds[-1] > max_block:
+            bounds.append(bounds[-1] + max_block)
+        if stop - bounds[-1] >= min_block or stop == n_samples:
+            bounds.append(int(stop))
+    if len(bounds) > 2 and bounds[-1] - bounds[-2] < min_block:
+        del bounds[-2] # merge a narrow last block into the one before
+    return(np.array(bounds, dtype=np.int64))
+
+def rechunkGenotypes(genotypePath, out, indices, variant_chunk=65536, min_block=32, max_block=256):
+
+    """
+    Writes a copy of a genotype array chunked for cohort access, as a Zarr group holding one array per 
+    block of samples from cohortSampleBlocks(). Sample order is unchanged, so cohort indices are still valid, 
+    but taking a cohort's samples only reads the blocks that hold them. The source is read once, in blocks of variants. 
+    loadZarrArrays() finds the copy through the source's dataIdentity(), recorded in the group attributes.
+    """
+
+    source = zarr.open_array(genotypePath, mode='r')
+    bounds = cohortSampleBlocks(indices, source.shape[1], min_block=min_block, max_block=max_block)
+    variant_chunk = min(variant_chunk, source.shape[0]) if source.shape[0] else variant_chunk
+
+    root = zarr.open_group(out, mode='w')
+    blocks = [root.create_dataset(str(i), shape=(source.shape[0], stop - start) + source.shape[2:], 
+                                  chunks=(variant_chunk, stop - start) + source.shape[2:],
+                                  dtype=source.dtype, compressor=source.compressor, fill_value=source.fill_value)
+                    for i, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:]))]
+
+    for vstart, vstop, gt in iterBlocks(source, blen=variant_chunk):
+        for block, start, stop in zip(blocks, bounds[:-1], bounds[1:]):
+            block[vstart:vstop] = gt[:, start:stop]
+
+    # written last, so a partial copy is never picked up
+    root.attrs.update({'source':dataIdentity(genotypePath), 'bounds':bounds.tolist(), 'complete':True})
+    log(f"Wrote {len(blocks)} sample blocks to {out}")
+
+def findRechunkedGenotypes(genotypePath, store="resources/Zarr/rechunked"):
+
+    """
+    Returns the path of a complete cohort-chunked copy of genotypePath written by rechunkGenotypes(), 
+    or None if there is not one, or the source has been modified since it was written.
+    """
+
+    identity = dataIdentity(genotypePath)
+    for attrsPath in glob.glob(os.path.join(store, "*", "GT", ".zattrs")):
+        with open(attrsPath) as f:
+            attrs = json.load(f)
+        if attrs.get('complete') and attrs.get('source') == identity:
+            return(os.path.dirname(attrsPath))
+    return(None)
+
+def loadRechunkedGenotypes(path):
+
+    """
+    Loads a copy written by rechunkGenotypes() as a single dask array, with one chunk of samples per block.
+    """
+
+    root = zarr.open_group(path, mode='r')
+    n_blocks = len(root.attrs['bounds']) - 1
+    return(da.concatenate([da.from_zarr(root[str(i)]) for i in range(n_blocks)], axis=1))
+
+def sampleSetHash(indices):
+
+    """
+    Hashes a set of sample indices, for use in cache keys.
+    """
+
+    return(hashlib.md5(np.sort(np.asarray(indices, dtype=np.int64)).tobytes()).hexdigest())
+
+def cachedMask(name, compute, store="resources/masks", **params):
+
+    """
+    Looks up a boolean mask (e.g. a site filter or a cohort's biallelic sites) in the mask store, 
+    keyed by a hash of the name and params. If it is not there, the mask is computed with compute() 
+    and saved as packed bits. Params should identify the data, e.g. contig, dataIdentity() of the 
+    input arrays and sampleSetHash() of the cohort.
+    """
+
+    key = hash_params(name=name, **params)
+    path = f"{store}/{name}.{key}.npz"
+
+    if os.path.isfile(path):
+        cached = np.load(path)
+        return(np.unpackbits(cached['bits'], count=int(cached['n'])).astype(bool))
+
+    mask = np.asarray(compute(), dtype=bool)
+    # write to a temporary file and rename, so concurrent jobs never read a partial mask
+    os.makedirs(store, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(tmp, bits=np.packbits(mask), n=mask.shape[0])
+    os.replace(tmp, path)
+    return(mask)
+
+# alt counts of the four samples packed in each byte, with missing calls (code 3) read as 0, as to_n_alt() gives them
+_altCountLookup = np.array([[(byte >> (2 * i)) & 3 for i in range(4)] for byte in range(256)], dtype=np.int8)
+_altCountLookup[_altCountLookup == 3] = 0
+
+def packAltCounts(gn):
+
+    """
+    Packs alt counts (variants x samples, 0, 1 or 2, with -1 for missing) into 2 bits each, 
+    four samples per byte, for a quarter of the memory of int8. Missing calls are kept as code 3.
+    """
+
+    codes = np.where(gn < 0, 3, gn).astype(np.uint8)
+    codes = np.pad(codes, ((0, 0), (0, -codes.shape[1] % 4)))
+    return(codes[:, 0::4] | (codes[:, 1::4] << 2) | (codes[:, 2::4] << 4) | (codes[:, 3::4] << 6))
+
+def unpackAltCounts(packed, n_samples, samples=None, rows=None):
+
+    """
+    Unpacks 2-bit packed alt counts to an int8 array (variants x samples), equal to to_n_alt() of the 
+    genotypes, so missing calls are 0. Optionally only for some samples (e.g. a cohort's indices) and rows (a boolean mask or indices of variants). Only the 
+    selected rows are copied out of a memory-mapped cache.
+    """
+
+    samples = np.arange(n_samples) if samples is None else np.asarray(samples, dtype=np.int64)
+    block = packed if rows is None else packed[rows]
+    return(_altCountLookup[np.asarray(block[:, samples // 4]), samples % 4])
+
+def writeAltCountCache(gt, pos, path, blen=None):
+
+    """
+    Writes the alt counts of a diploid genotype array to a 2-bit packed, uncompressed altcounts.npy, with the 
+    positions in a sidecar pos.npy and the shape in meta.json, streaming the genotypes block by block. 
+    The cache is written to a temporary directory which is then renamed, so a partial cache is never read.
+    """
+
+    assert gt.shape[2] == 2, "The alt count cache holds diploid genotypes"
+    n_variants, n_samples = gt.shape[:2]
+    tmp = f"{path}.{os.getpid()}.tmp"
+    os.makedirs(tmp, exist_ok=True)
+
+    packed = np.lib.format.open_memmap(f"{tmp}/altcounts.npy", mode='w+', dtype=np.uint8, shape=(n_variants, (n_samples + 3) // 4))
+    for start, stop, block in iterBlocks(gt, blen=blen):
+        gn = (block > 0).sum(axis=2, dtype=np.int8)
+        gn[(block < 0).all(axis=2)] = -1
+        packed[start:stop] = packAltCounts(gn)
+    packed.flush()
+    del packed
+
+    np.save(f"{tmp}/pos.npy", np.asarray(pos))
+    with open(f"{tmp}/meta.json", "w") as f:
+        json.dump({'n_variants':int(n_variants), 'n_samples':int(n_samples)}, f)
+
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        # another job wrote the same cache first
+        import shutil
+        shutil.rmtree(tmp)
+
+def openAltCountCache(path):
+
+    """
+    Memory-maps an alt count cache written by writeAltCountCache(), without copying or decompressing it. 
+    Returns the packed alt counts, the positions and the number of samples.
+    """
+
+    with open(f"{path}/meta.json") as f:
+        meta = json.load(f)
+    packed = np.load(f"{path}/altcounts.npy", mmap_mode='r')
+    pos = np.load(f"{path}/pos.npy", mmap_mode='r')
+    return(packed, pos, meta['n_samples'])
+
+def cachedAltCounts(gt, pos, store="resources/altcounts", blen=None, **params):
+
+    """
+    Opens the alt count cache of a genotype array from the store, keyed by a hash of params, writing it 
+    first if this is the first time it is used. Params should identify the data as for cachedMask(), e.g. 
+    contig and dataIdentity() of the genotypes and site filter. Returns the same as openAltCountCache().
+    """
+
+    # version 2 packs half-missing calls as to_n_alt() counts them
+    path = f"{store}/{hash_params(name='altcounts', version=2, **params)}"
+    if not os.path.isfile(f"{path}/meta.json"):
+        log(f"Writing alt count cache {path}")
+        os.makedirs(store, exist_ok=True)
+        writeAltCountCache(gt, pos, path, blen=blen)
+    return(openAltCountCache(path))
+
+resultsCacheConfig = {'path':"resources/resultscache", 'maxSizeGB':20}
+
+def configureResultsCache(cacheConfig=None):
+
+    """
+    Sets where resultsCache() keeps results and its size cap, from the ResultsCache section of the config 
+    (path and maxSizeGB).
+    """
+
+    resultsCacheConfig.update(cacheConfig or {})
+
+def _cacheToken(value):
+
+    """
+    Converts a function argument to something JSON can hash for a cache key. Numpy arrays (and scikit-allel 
+    wrappers of them) and pandas objects are hashed by content, and Zarr arrays by zarrIdentity().
+    """
+
+    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+        return({'pandas':hashlib.md5(pd.util.hash_pandas_object(value).values.tobytes()).hexdigest()})
+    if isinstance(value, zarr.Array):
+        path = getattr(value.store, 'path', None)
+        if path is None:
+            raise TypeError("Only Zarr arrays in a directory store can be identified for the results cache")
+        return({'zarr':zarrIdentity(os.path.join(path, value.path))})
+    if isinstance(getattr(value, 'values', None), (np.ndarray, da.Array)):
+        value = value.values # scikit-allel wrappers
+    if isinstance(value, da.Array):
+        raise TypeError("Dask arrays cannot be hashed without computing them. Add the argument to ignore, and identify its source in cacheParams")
+    if isinstance(value, np.ndarray):
+        arr = np.ascontiguousarray(value)
+        return({'array':hashlib.md5(arr.reshape(-1).view(np.uint8)).hexdigest(), 'dtype':str(arr.dtype), 'shape':list(arr.shape)})
+    if isinstance(value, np.generic):
+        return(value.item())
+    if isinstance(value, dict):
+        return({str(k):_cacheToken(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return([_cacheToken(v) for v in value])
+    return(value)
+
+def _saveResult(result, path):
+
+    """
+    Writes a result under path (without extension), as parquet for a DataFrame, or otherwise as an npz of a 
+    numpy array or a tuple or dict of them. The file is written under a temporary name and renamed, so 
+    concurrent jobs never read a partial result. Returns the number of bytes written.
+    """
+
+    if isinstance(result, pd.DataFrame):
+        path = f"{path}.parquet"
+        tmp = f"{path}.{os.getpid()}.tmp"
+        result.to_parquet(tmp)
+    else:
+        if isinstance(result, dict):
+            arrays = {str(k):np.asarray(v) for k, v in result.items()}
+        elif isinstance(result, (tuple, list)):
+            arrays = {f"arr_{i}":np.asarray(v) for i, v in enumerate(result)}
+            arrays['__tuple__'] = np.array(len(result))
+        else:
+            arrays = {'__array__':np.asarray(result)}
+        path = f"{path}.npz"
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+    os.replace(tmp, path)
+    return(os.path.getsize(path))
+
+def _loadResult(path):
+
+    """
+    Reads a result written by _saveResult(). Raises FileNotFoundError if it is not in the cache.
+    """
+
+    if path.endswith('.parquet'):
+        if not os.path.isfile(path):
+            raise FileNotFoundError(path)
+        return(pd.read_parquet(path))
+
+    with np.load(path, allow_pickle=False) as cached:
+        if '__array__' in cached.files:
+            return(cached['__array__'])
+        elif '__tuple__' in cached.files:
+            return(tuple(cached[f"arr_{i}"] for i in range(int(cached['__tuple__']))))
+        return({k:cached[k] for k in cached.files})
+
+def resultsCache(name, version=1, ignore=()):
+
+    """
+    Decorates an analysis function so that its results are kept in a shared on-disk cache, and calls with the 
+    same inputs are read back instead of recomputed. 
+
+    Results are keyed by a hash of the name, version and source code of the function, and its arguments. 
+    Numpy arrays and pandas objects are hashed by content and Zarr arrays by zarrIdentity(). Arguments 
+    listed in ignore (e.g. dask arrays, or thread counts) are left out of the key. The inputs they 
+    hold should be identified in the cacheParams keyword of the call instead, e.g. with the contig and 
+    zarrIdentity() of the source arrays. Bump version when a function the decorated one calls changes 
+    what it returns.
+
+    Results can be numpy arrays, tuples or dicts of them, or a DataFrame. They are written under 
+    configureResultsCache()'s path in a subdirectory per name, atomically, and the least recently used 
+    results are evicted beyond maxSizeGB, as in the chunk cache. This is safe for concurrent jobs.
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+        try:
+            code = inspect.getsource(func)
+        except (OSError, TypeError):
+            code = func.__code__.co_code.hex()
+        code = hashlib.md5(code.encode()).hexdigest()
+
+        @functools.wraps(func)
+        def wrapper(*args, cacheParams=None, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            params = {k:_cacheToken(v) for k, v in bound.arguments.items() if k not in ignore}
+            key = hash_params(name=name, version=version, code=code, params=params, cacheParams=_cacheToken(cacheParams))
+
+            storage = os.path.abspath(resultsCacheConfig['path'])
+            path = os.path.join(storage, name, key)
+            for cached in (f"{path}.npz", f"{path}.parquet"):
+                try:
+                    result = _loadResult(cached)
+                except FileNotFoundError:
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    os.utime(cached) # mark as recently used
+                log(f"Read {name} results from the cache ({key})")
+                return(result)
+
+            result = func(*bound.args, **bound.kwargs)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            nbytes = _saveResult(result, path)
+            _accountLRU(storage, nbytes, int(resultsCacheConfig['maxSizeGB'] * 2**30))
+            return(result)
+        return(wrapper)
+    return(decorator)
+
+def _chunkLength(arr):
+
+    """
+    The chunk length of an array along the first axis, or its length if it is not chunked.
+    """
+
+    chunks = getattr(arr, 'chunks', None)
+    if chunks is None:
+        return(arr.shape[0])
+    elif isinstance(chunks[0], tuple):
+        return(max(chunks[0])) # dask
+    return(chunks[0]) # zarr
+
+def prefetchBlocks(read, args, prefetch=2):
+
+    """
+    Yields read(*a) for each a in args, in order, while the next prefetch reads run on a background thread pool, 
+    so that reading and decompressing chunks overlaps with computing on the current one. At most prefetch + 1 
+    blocks are held in memory at once. With prefetch=0 blocks are read in the calling thread.
+    """
+
+    args = iter(args)
+    if prefetch < 1:
+        for a in args:
+            yield read(*a)
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import deque
+    with ThreadPoolExecutor(max_workers=prefetch) as pool:
+        pending = deque(pool.submit(read, *a) for a in itertools.islice(args, prefetch))
+        while pending:
+            block = pending.popleft().result()
+            for a in itertools.islice(args, 1):
+                pending.append(pool.submit(read, *a))
+            yield block
+
+def _readBlock(arr, start, stop):
+    block = arr[start:stop]
+    if hasattr(block, 'compute'):
+        block = block.compute()
+    return(start, stop, np.asarray(block))
+
+def iterBlocks(arr, blen=None, prefetch=2):
+
+    """
+    Iterates over a genotype or haplotype array in blocks of variants, yielding the start and stop 
+    of each block along with the block as a numpy array. Each block is read from disk only once, and 
+    the next prefetch blocks are read in the background while the current one is used.
+    """
+
+    blen = _chunkLength(arr) if blen is None else blen
+    starts = range(0, arr.shape[0], blen)
+    return(prefetchBlocks(_readBlock, ((arr, start, min(start + blen, arr.shape[0])) for start in starts), prefetch=prefetch))
+
+def cohortLabels(indices, n_samples):
+
+    """
+    Builds a sample-to-cohort label vector from a list of cohort indices. Samples in no cohort are labelled -1.
+    """
+
+    labels = np.full(n_samples, -1, dtype=np.int32)
+    for i, idx in enumerate(indices):
+        idx = np.asarray(idx, dtype=np.int64)
+        assert (labels[idx] == -1).all(), "Cohorts overlap, each sample can only be assigned to one cohort"
+        labels[idx] = i
+    return(labels)
+
+def countAllelesCohorts(gt, labels, max_allele=3, blen=None):
+
+    """
+    Counts alleles for every cohort in a single pass over a genotype (or haplotype) array.
+
+    Parameters
+    ----------
+    gt : array_like, shape (n_variants, n_samples, ploidy) or (n_variants, n_haplotypes)
+        Genotype array, e.g. from loadZarrArrays(). Can be a zarr, dask or numpy array.
+    labels : array_like, int, shape (n_samples,)
+        Cohort label of each sample, as returned by cohortLabels(). Samples labelled -1 are ignored.
+    max_allele : int
+        Highest allele index to count.
+    blen : int, optional
+        Number of variants to read per block. Defaults to the chunk length of gt.
+
+    Returns
+    -------
+    ac : numpy array, shape (n_variants, n_cohorts, max_allele + 1)
+        Allele counts for each cohort. ac[:, i] is equivalent to gt.take(indices_i, axis=1).count_alleles().
+    """
+
+    labels = np.asarray(labels)
+    n_cohorts = labels.max() + 1
+    ploidy = gt.shape[2] if len(gt.shape) == 3 else 1
+    
+    # a one-hot sample x cohort matrix, so each block is summed into all cohorts with one matrix product
+    inCohort = labels >= 0
+    membership = np.zeros((gt.shape[1], n_cohorts), dtype=np.float32)
+    membership[np.nonzero(inCohort)[0], labels[inCohort]] = 1
+    dtype = np.int16 if membership.sum(axis=0).max() * ploidy < np.iinfo(np.int16).max else np.int32
+
+    ac = np.zeros((gt.shape[0], n_cohorts, max_allele + 1), dtype=dtype)
+    for start, stop, block in iterBlocks(gt, blen=blen):
+        block = block.reshape(block.shape[0], block.shape[1], -1)
+        for allele in range(max_allele + 1):
+            counts = np.sum(block == allele, axis=2, dtype=np.float32)
+            ac[start:stop, :, allele] = counts @ membership
+
+    return(ac)
+
+def countAlleles(gt, max_allele=3, blen=None):
+
+    """
+    Counts alleles over all samples of a genotype (or haplotype) array, streaming it block by block with 
+    iterBlocks(). Returns an allel.AlleleCountsArray, as gt.count_alleles(max_allele=max_allele) would.
+    """
+
+    labels = np.zeros(gt.shape[1], dtype=np.int32)
+    return(allel.AlleleCountsArray(countAllelesCohorts(gt, labels, max_allele=max_allele, blen=blen)[:, 0]))
+
+def homozygotePlanes(gt, max_allele=3, blen=None):
+
+    """
+    Bit-packs where each sample is homozygous for each allele, streaming a diploid genotype array block by block. 
+    Returns a uint64 array of shape (max_allele + 1, n_samples, n_words), where bit i of word w is set if the 
+    sample is homozygous for the allele at variant 64 * w + i. Two samples are opposing homozygotes wherever both 
+    are homozygous but in no plane together, which can be tested for 64 variants at once.
+    """
+
+    n_variants, n_samples = gt.shape[:2]
+    n_words = (n_variants + 63) // 64
+    blen = _chunkLength(gt) if blen is None else blen
+    blen = max(64, blen - blen % 64) # keep blocks word-aligned
+
+    planes = np.zeros((max_allele + 1, n_samples, n_words), dtype=np.uint64)
+    for start, stop, block in iterBlocks(gt, blen=blen):
+        hom = block[:, :, 0] == block[:, :, 1]
+        for allele in range(max_allele + 1):
+            bits = np.packbits(hom & (block[:, :, 0] == allele), axis=0, bitorder='little')
+            bits = np.pad(bits, ((0, -bits.shape[0] % 8), (0, 0)))
+            planes[allele, :, start // 64:(stop + 63) // 64] = np.ascontiguousarray(bits.T).view('<u8')
+    return(planes)
+
+def doubletonPairs(gt, max_allele=3, blen=None):
+
+    """
+    Finds the two carriers of every doubleton, i.e. every alt allele carried exactly twice, as heterozygotes 
+    in two different samples (doubletons carried by one homozygote are skipped), streaming a genotype array 
+    block by block. Every alt allele up to max_allele is checked, so a site can hold more than one doubleton. 
+    Returns the variant index, alt allele and the two carriers' sample indices of each doubleton, ordered by variant.
+    """
+
+    variants, alleles, carriers = [], [], []
+    for start, stop, block in iterBlocks(gt, blen=blen):
+        for allele in range(1, max_allele + 1):
+            counts = (block == allele).sum(axis=2, dtype=np.int8)
+            rows = np.flatnonzero(counts.sum(axis=1, dtype=np.int32) == 2)
+            r, sample = np.nonzero(counts[rows] > 0)
+            pair = np.bincount(r, minlength=rows.shape[0])[r] == 2
+            variants.append(start + rows[r[pair][::2]])
+            alleles.append(np.full(pair.sum() // 2, allele, dtype=np.int8))
+            carriers.append(sample[pair].reshape(-1, 2))
+
+    variants, alleles, carriers = np.concatenate(variants), np.concatenate(alleles), np.concatenate(carriers)
+    order = np.argsort(variants, kind='stable')
+    return(variants[order], alleles[order], carriers[order])
+
+def pairwiseDistances(gnalt, metric='euclidean'):
+
+    """
+    Computes the sample x sample distance matrix for a window of alt allele counts (variants x samples). 
+    Euclidean and hamming distances are computed with matrix products, other metrics fall back to scipy pdist. 
+    Hamming and jaccard distances are converted to a number of SNPs, as in clusterMultiLocusGenotypes.
+    """
+
+    n_snps = gnalt.shape[0]
+    if metric in additiveMetrics:
+        return(finaliseDistances(additiveDistances(gnalt, metric=metric), n_snps=n_snps, metric=metric))
+    
+    import scipy.spatial
+    dist = scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(np.asarray(gnalt).T, metric=metric))
+    if metric == 'jaccard':
+        dist *= n_snps
+
+    return(dist)
+
+# metrics which are sums over SNPs, so can be accumulated over blocks of SNPs
+additiveMetrics = ['euclidean', 'hamming']
+
+def additiveDistances(gnalt, metric='euclidean'):
+
+    """
+    Computes the part of the sample x sample distance matrix that sums over SNPs - squared euclidean 
+    distances or the number of mismatching SNPs. These are integers, so exact when summed over blocks of SNPs.
+    """
+
+    if metric == 'euclidean':
+        x = np.asarray(gnalt, dtype=np.float64).T
+        sq = np.einsum('ij,ij->i', x, x)
+        dist = sq[:, None] + sq[None, :] - 2 * (x @ x.T)
+    elif metric == 'hamming':
+        # mismatches = n_snps - number of SNPs where each pair carries the same alt count
+        dist = np.full((gnalt.shape[1], gnalt.shape[1]), gnalt.shape[0], dtype=np.float64)
+        for value in np.unique(gnalt):
+            x = (np.asarray(gnalt) == value).T.astype(np.float64)
+            dist -= x @ x.T
+    else:
+        raise ValueError(f"metric must be one of {additiveMetrics}")
+
+    return(dist)
+
+def finaliseDistances(dist, n_snps, metric='euclidean'):
+
+    """
+    Converts the output of additiveDistances(), summed over n_snps, to distances.
+    """
+
+    if metric == 'euclidean':
+        dist = np.sqrt(np.maximum(dist, 0))
+    elif metric == 'hamming':
+        dist = (dist / n_snps) * n_snps
+
+    np.fill_diagonal(dist, 0)
+    return(dist)
+
+@njit()
+def clusterSizes(adjacency):
+
+    """
+    Finds connected components of a boolean adjacency matrix with union-find, and returns the size of each component. 
+    Equivalent to single-linkage clustering cut at the threshold used to build the adjacency matrix.
+    """
+
+    n = adjacency.shape[0]
+    parent = np.arange(n)
+
+    for i in range(n):
+        for j in range(i + 1, n):
+            if adjacency[i, j]:
+                # find roots, halving paths as we go
+                a = i
+                while parent[a] != a:
+                    parent[a] = parent[parent[a]]
+                    a = parent[a]
+                b = j
+                while parent[b] != b:
+                    parent[b] = parent[parent[b]]
+                    b = parent[b]
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+
+    sizes = np.zeros(n, dtype=np.int64)
+    for i in range(n):
+        a = i
+        while parent[a] != a:
+            a = parent[a]
+        sizes[a] += 1
+
+    return(sizes[sizes > 0])
+
+def garudsG(gnalt, cut_height=0.1, metric='euclidean', g=2, dist=None):
+
+    """
+    Clusters multi-locus genotypes and calculates the G12 (g=2) or G123 (g=3) statistic. Gives the same result as 
+    single-linkage clustering with scipy and cut_tree at cut_height, without building a dendrogram. 
+    A precomputed distance matrix can be passed with dist.
+    """
+
+    if dist is None:
+        dist = pairwiseDistances(gnalt, metric=metric)
+    # cut_tree merges clusters strictly below cut_height
+    cluster_sizes = clusterSizes(dist < cut_height)
+
+    # get freq of clusters and sort by largest freq
+    freqs = np.sort(cluster_sizes / dist.shape[0])[::-1]
+    
+    # calculate garuds statistic
+    gStat = np.sum(freqs[:g])**2 + np.sum(freqs[g:]**2)
+    return(gStat)
+
+def movingGarudsG(gnalt, size, step, cut_height=0.1, metric='euclidean', g=2, incremental=True, start=0, stop=None):
+
+    """
+    Calculates G12/G123 in moving windows of SNPs, using the same windows as allel.moving_statistic.
+
+    With incremental=True and an additive metric (euclidean, hamming), a running distance matrix is kept and 
+    only the SNPs which enter or leave each window are added or subtracted, so overlapping windows share 
+    their distance computations, holding a single extra distance matrix. Results are identical to incremental=False.
+    Only windows within SNPs [start, stop) are calculated.
+    """
+
+    windows = list(allel.index_windows(gnalt, size=size, start=start, stop=stop, step=step))
+    if not incremental or metric not in additiveMetrics:
+        return(np.array([garudsG(gnalt[window_start:window_stop], cut_height=cut_height, metric=metric, g=g) for window_start, window_stop in windows]))
+
+    running = None
+    gStats = []
+    prev_start, prev_stop = start, start
+
+    for window_start, window_stop in windows:
+        if running is None or window_start >= prev_stop:
+            # no overlap with the previous window, start again
+            running = additiveDistances(gnalt[window_start:window_stop], metric=metric)
+        else:
+            # the sums are integers, so subtracting the SNPs leaving the window is exact
+            if window_start > prev_start:
+                running -= additiveDistances(gnalt[prev_start:window_start], metric=metric)
+            if window_stop > prev_stop:
+                running += additiveDistances(gnalt[prev_stop:window_stop], metric=metric)
+        
+        dist = finaliseDistances(running.copy(), n_snps=window_stop-window_start, metric=metric)
+        gStats.append(garudsG(None, cut_height=cut_height, g=g, dist=dist))
+        prev_start, prev_stop = window_start, window_stop
+
+    return(np.array(gStats))
+
+def packHaplotypes(ht, blen=None):
+
+    """
+    Bit-packs a biallelic haplotype array (variants x haplotypes) along the variants axis, 8 SNPs per byte, 
+    reading it from disk block by block so the dense array is never held in memory. The two alleles at 
+    each site are recoded to 0 and 1, which keeps identical haplotypes identical.
+    """
+
+    if blen is None:
+        chunks = getattr(ht, 'chunks', None)
+        blen = ht.shape[0] if chunks is None else (max(chunks[0]) if isinstance(chunks[0], tuple) else chunks[0])
+    blen = max(8, blen - blen % 8) # keep blocks byte-aligned
+
+    packed = np.empty(((ht.shape[0] + 7) // 8, ht.shape[1]), dtype=np.uint8)
+    for start, stop, block in iterBlocks(ht, blen=blen):
+        lo = block.min(axis=1, keepdims=True)
+        hi = block.max(axis=1, keepdims=True)
+        assert ((block == lo) | (block == hi)).all(), "Haplotypes must have at most two alleles at each site to be bit-packed"
+        packed[start // 8:(stop + 7) // 8] = np.packbits((block == hi) & (hi > lo), axis=0)
+    return(packed)
+
+def haplotypeBlockIDs(packed, start, stop):
+
+    """
+    Labels each haplotype in SNPs [start, stop) of a bit-packed haplotype array with an integer ID, 
+    where haplotypes share an ID if and only if they are identical over those SNPs.
+    """
+
+    block = packed[start // 8:(stop + 7) // 8]
+    if start % 8 or stop % 8:
+        # clear the bits of the first and last bytes outside [start, stop), bits are packed most significant first
+        block = block.copy()
+        block[0] &= np.uint8(0xFF >> start % 8)
+        block[-1] &= np.uint8((0xFF << (-stop % 8)) & 0xFF)
+
+    # view each haplotype's bytes as a single value so unique is a 1D sort
+    rows = np.ascontiguousarray(block.T)
+    rows = rows.view(np.dtype((np.void, rows.shape[1]))).ravel()
+    _, ids = np.unique(rows, return_inverse=True)
+    return(ids.ravel())
+
+def garudH(counts):
+
+    """
+    Calculates H1, H12, H123 and H2/H1 from the counts of each distinct haplotype, as allel.garud_h.
+    """
+
+    f = np.sort(counts)[::-1] / np.sum(counts)
+    h1 = np.sum(f**2)
+    h12 = np.sum(f[:2])**2 + np.sum(f[2:]**2)
+    h123 = np.sum(f[:3])**2 + np.sum(f[3:]**2)
+    h2_h1 = (h1 - f[0]**2) / h1
+    return(h1, h12, h123, h2_h1)
+
+def movingHaplotypeIDs(packed, n_variants, size, step=None, start=0, stop=None, maxBlocks=8):
+
+    """
+    Iterates over moving windows of SNPs in a bit-packed haplotype array, yielding an integer ID 
+    for each haplotype, where haplotypes share an ID if and only if they are identical in that window.
+
+    Each window is split into blocks of gcd(size, step) SNPs. Haplotypes are labelled within each block 
+    once, and overlapping windows reuse the block labels, combining them to label whole-window haplotypes.
+    When that would take more than maxBlocks blocks per window, each window is labelled whole instead, since 
+    combining many small blocks costs more than labelling the window once. Only windows within SNPs 
+    [start, stop) are labelled.
+    """
+
+    step = size if step is None else step
+    blen = np.gcd(size, step)
+    blocks = {}
+
+    windows = allel.index_windows(range(n_variants), size=size, start=start, stop=stop, step=step)
+    if size // blen > maxBlocks:
+        for window_start, window_stop in windows:
+            yield haplotypeBlockIDs(packed, window_start, window_stop)
+        return
+
+    for window_start, window_stop in windows:
+        # drop labels of blocks we have moved past
+        for block in [b for b in blocks if b < window_start]:
+            del blocks[block]
+
+        ids = None
+        for block in range(window_start, window_stop, blen):
+            if block not in blocks:
+                blocks[block] = haplotypeBlockIDs(packed, block, block + blen)
+            if ids is None:
+                ids = blocks[block]
+            else:
+                # combine with the next block and relabel densely, to keep the ids small
+                _, ids = np.unique(ids.astype(np.int64) * (blocks[block].max() + 1) + blocks[block], return_inverse=True)
+                ids = ids.ravel()
+        
+        yield ids
+
+def movingGarudH(packed, n_variants, size, step=None, start=0, stop=None):
+
+    """
+    Calculates H1, H12, H123 and H2/H1 in moving windows of SNPs from a bit-packed haplotype array 
+    (see packHaplotypes()). Gives identical results to allel.moving_garud_h, with haplotype 
+    frequencies counted with bincount over the window IDs from movingHaplotypeIDs().
+
+    Returns
+    -------
+    h1, h12, h123, h2_h1 : numpy arrays, shape (n_windows,)
+    """
+
+    gh = []
+    for ids in movingHaplotypeIDs(packed, n_variants, size=size, step=step, start=start, stop=stop):
+        counts = np.bincount(ids)
+        gh.append(garudH(counts[counts > 0]))
+
+    gh = np.array(gh).reshape(-1, 4)
+    return(gh[:, 0], gh[:, 1], gh[:, 2], gh[:, 3])
+
+def movingGarudH12Partitions(packed, n_variants, partitions, size, step=None):
+
+    """
+    Calculates H12 in moving windows for many partitions of the same haplotypes (e.g. phenotype randomisations), 
+    labelling haplotypes in each window only once. 
+
+    Parameters
+    ----------
+    packed : numpy array
+        Bit-packed haplotypes of all samples in the partitions (see packHaplotypes()).
+    n_variants : int
+        Number of SNPs in packed.
+    partitions : array_like, int, shape (n_partitions, n_haplotypes)
+        Group of each haplotype in each partition, e.g. 0 for alive and 1 for dead. Haplotypes labelled -1 are ignored.
+    size, step : int
+        Window size and step, in SNPs.
+
+    Returns
+    -------
+    h12 : numpy array, shape (n_partitions, n_groups, n_windows)
+    """
+
+    partitions = np.asarray(partitions)
+    n_partitions, n_groups = partitions.shape[0], partitions.max() + 1
+    # offset each partition/group pair so all of them are counted with a single bincount
+    offsets = np.where(partitions >= 0, np.arange(n_partitions)[:, None] * n_groups + partitions, -1)
+    included = offsets >= 0
+    
+    h12 = []
+    for ids in movingHaplotypeIDs(packed, n_variants, size=size, step=step):
+        n_ids = ids.max() + 1
+        keys = (offsets * n_ids + ids[None, :])[included]
+        counts = np.bincount(keys, minlength=n_partitions * n_groups * n_ids).reshape(n_partitions * n_groups, n_ids)
+        f = -np.sort(-counts, axis=1) / counts.sum(axis=1, keepdims=True)
+        h12.append(np.sum(f[:, :2], axis=1)**2 + np.sum(f[:, 2:]**2, axis=1))
+
+    return(np.array(h12).reshape(-1, n_partitions, n_groups).transpose(1, 2, 0))
+
+def movingPBS(ac1, ac2, ac3, size, step, start=0, stop=None, normed=True):
+
+    """
+    Calculates windowed PBS with allel.pbs, for the windows within SNPs [start, stop).
+    """
+
+    return(allel.pbs(ac1[start:stop], ac2[start:stop], ac3[start:stop], window_size=size, window_step=step, normed=normed))
+
+def _movingStatisticBlock(func, paths, size, step, start, stop, kwargs):
+    values = [np.load(path, mmap_mode='r') for path in paths]
+    return(func(*values, size=size, step=step, start=start, stop=stop, **kwargs))
+
+def parallelMovingStatistic(func, values, size, step, threads=1, tmpdir=None, **kwargs):
+
+    """
+    Runs a moving window function over a contig in parallel. The windows are split into contiguous blocks, 
+    which are run in a pool of worker processes, and the results are concatenated back in window order. 
+
+    Parameters
+    ----------
+    func : function
+        A moving window function, called as func(*values, size=size, step=step, start=start, stop=stop, **kwargs), 
+        returning results for the windows in [start, stop). e.g. movingGarudsG, movingGarudH, movingPBS 
+        or allel.moving_statistic. Must be defined at module level, so it can be sent to the workers.
+    values : numpy array or list of numpy arrays
+        Input arrays, windowed along the first axis. These are written once to .npy files in tmpdir, 
+        and memory-mapped by each worker, so they are not copied into each process.
+    size, step : int
+        Window size and step, in SNPs.
+    threads : int
+        Number of worker processes, e.g. snakemake.threads.
+    """
+
+    values = list(values) if isinstance(values, (list, tuple)) else [values]
+    n_variants = kwargs['n_variants'] if 'n_variants' in kwargs else len(values[0])
+    windows = list(allel.index_windows(range(n_variants), size=size, start=0, stop=None, step=step))
+    
+    if threads <= 1 or len(windows) < 2:
+        return(func(*values, size=size, step=step, start=0, stop=None, **kwargs))
+
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+
+    # a few blocks per worker to balance the load
+    blocks = [block for block in np.array_split(np.arange(len(windows)), min(threads * 4, len(windows))) if len(block) > 0]
+    with tempfile.TemporaryDirectory(dir=tmpdir) as tmp:
+        paths = []
+        for i, arr in enumerate(values):
+            paths.append(f"{tmp}/values{i}.npy")
+            np.save(paths[-1], np.asarray(arr))
+
+        with ProcessPoolExecutor(max_workers=threads) as pool:
+            futures = [pool.submit(_movingStatisticBlock, func, paths, size, step, windows[block[0]][0], windows[block[-1]][1], kwargs) for block in blocks]
+            results = [future.result() for future in futures]
+
+    if isinstance(results[0], tuple):
+        return(tuple(np.concatenate(result) for result in zip(*results)))
+    return(np.concatenate(results))
+
+BGZF_BLOCK_SIZE = 0xff00 # uncompressed bytes per BGZF block, as in htslib
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+def bgzfBlock(data, level=6):
+
+    """
+    Compresses up to BGZF_BLOCK_SIZE bytes into a single BGZF block.
+    """
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+    return(header + cdata + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+def bgzfCompress(data, level=6, threads=1):
+
+    """
+    Compresses bytes into a list of BGZF blocks, in parallel threads if threads > 1 (zlib releases the GIL).
+    """
+
+    chunks = [data[i:i + BGZF_BLOCK_SIZE] for i in range(0, len(data), BGZF_BLOCK_SIZE)]
+    if threads > 1 and len(chunks) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            return(list(pool.map(lambda chunk: bgzfBlock(chunk, level), chunks)))
+    return([bgzfBlock(chunk, level) for chunk in chunks])
+
+def genotypeLookup(ploidy=2, max_allele=3, phased=False):
+
+    """
+    Builds a lookup table of VCF GT byte strings (each followed by a tab) for every genotype, 
+    indexed by the genotype's code from genotypeCodes().
+    """
+
+    assert max_allele < 10, "genotypeLookup only supports single digit alleles"
+    alleles = np.frombuffer(b'.' + ''.join(str(a) for a in range(max_allele + 1)).encode(), dtype=np.uint8)
+    n_alleles = max_allele + 2
+    codes = np.arange(n_alleles ** ploidy)
+    lookup = np.empty((codes.shape[0], 2 * ploidy), dtype=np.uint8)
+    for i in range(ploidy):
+        lookup[:, 2 * i] = alleles[(codes // n_alleles ** (ploidy - i - 1)) % n_alleles]
+        lookup[:, 2 * i + 1] = ord('|') if phased else ord('/')
+    lookup[:, -1] = ord('\t')
+    return(lookup)
+
+def genotypeCodes(gt, max_allele=3):
+
+    """
+    Encodes each call of an int genotype array (n_variants, n_samples, ploidy) as an index into genotypeLookup().
+    """
+
+    gt = np.asarray(gt)
+    assert gt.max(initial=-1) <= max_allele, f"Genotypes contain alleles above max_allele ({max_allele})"
+    n_alleles = max_allele + 2
+    codes = np.zeros(gt.shape[:2], dtype=np.int32)
+    for i in range(gt.shape[2]):
+        codes = codes * n_alleles + (np.maximum(gt[:, :, i], -1) + 1)
+    return(codes)
+
+def formatVCFRecords(contig, pos, ref, alt, gt, lookup, max_allele=3):
+
+    """
+    Formats a block of variants as VCF lines, with GT fields taken straight from a lookup table 
+    rather than formatting each call as a string. Returns the bytes and the length of each line.
+    """
+
+    cells = lookup[genotypeCodes(gt, max_allele=max_allele)]
+    cells[:, -1, -1] = ord('\n')
+    calls = cells.reshape(cells.shape[0], -1)
+    width = calls.shape[1]
+    calls = calls.tobytes()
+
+    prefixes = [f"{contig}\t{p}\t.\t{r}\t{a}\t.\t.\t.\tGT\t".encode() for p, r, a in zip(pos, ref, alt)]
+    lines = [None] * (2 * len(prefixes))
+    lines[0::2] = prefixes
+    lines[1::2] = [calls[i * width:(i + 1) * width] for i in range(len(prefixes))]
+    lengths = np.array([len(prefix) for prefix in prefixes], dtype=np.int64) + width
+    return(b''.join(lines), lengths)
+
+def reg2bin(beg, end, min_shift=14, depth=5):
+
+    """
+    Vectorised htslib hts_reg2bin(), giving the index bin of each 0-based, half-open interval [beg, end).
+    """
+
+    beg, end = np.asarray(beg, dtype=np.int64), np.asarray(end, dtype=np.int64) - 1
+    bins = np.zeros(beg.shape[0], dtype=np.int64)
+    done = np.zeros(beg.shape[0], dtype=bool)
+    shift, first = min_shift, ((1 << 3 * depth) - 1) // 7
+    for level in range(depth, 0, -1):
+        same = ~done & ((beg >> shift) == (end >> shift))
+        bins[same] = first + (beg[same] >> shift)
+        done |= same
+        shift, first = shift + 3, first - (1 << 3 * (level - 1))
+    return(bins)
+
+def binLevel(b):
+
+    """
+    The level of an index bin, where bin 0 is level 0.
+    """
+
+    level = 0
+    while b:
+        level, b = level + 1, (b - 1) >> 3
+    return(level)
+
+def binBottom(b, depth=5):
+
+    """
+    The first linear index window covered by an index bin, as htslib hts_bin_bot().
+    """
+
+    level = binLevel(b)
+    return((b - ((1 << 3 * level) - 1) // 7) << (depth - level) * 3)
+
+def indexVCFRecords(index, beg, end, vstart, vend, min_shift=14):
+
+    """
+    Adds a block of VCF records to a tabix/CSI index under construction. beg and end are the 0-based 
+    half-open intervals of the records, vstart and vend the BGZF virtual offsets of the start and 
+    end of each line. The index is a dict, initialised as {}, which is written by writeVCFIndex().
+    """
+
+    if beg.shape[0] == 0:
+        return(index)
+    bins = reg2bin(beg, end, min_shift=min_shift)
+    # consecutive records in the same bin form one chunk of the index
+    runStarts = np.concatenate([[0], np.nonzero(np.diff(bins))[0] + 1])
+    runEnds = np.concatenate([runStarts[1:], [bins.shape[0]]]) - 1
+    index.setdefault('runs', []).append(np.stack([bins[runStarts], vstart[runStarts], vend[runEnds]]).astype(np.uint64))
+
+    # linear index: the lowest offset of any record overlapping each window
+    first, last = beg >> min_shift, (end - 1) >> min_shift
+    linear = index.get('linear', np.zeros(0, dtype=np.uint64))
+    if last.max() >= linear.shape[0]:
+        linear = np.concatenate([linear, np.full(last.max() + 1 - linear.shape[0], np.iinfo(np.uint64).max, dtype=np.uint64)])
+    for window in range(int((last - first).max()) + 1):
+        overlaps = first + window <= last
+        np.minimum.at(linear, first[overlaps] + window, vstart[overlaps].astype(np.uint64))
+    index['linear'] = linear
+
+    index['n_records'] = index.get('n_records', 0) + beg.shape[0]
+    index.setdefault('vstart', int(vstart[0]))
+    index['vend'] = int(vend[-1])
+    return(index)
+
+def _indexBins(index, depth=5):
+
+    """
+    Collects the chunks of each bin of an index built by indexVCFRecords(), and the filled linear index. 
+    As in htslib, bins spanning less than 64kb of compressed file are merged into their parent, and 
+    chunks that start in the BGZF block where the previous one ended are merged.
+    """
+
+    if not index:
+        return({}, np.zeros(0, dtype=np.uint64))
+
+    runs = np.concatenate(index['runs'], axis=1)
+    bins = {}
+    for bin, beg, end in runs.T.tolist():
+        if depth > 5:
+            # records are binned with 5 levels, move each bin down to the level of the same size
+            level = binLevel(bin)
+            bin += ((1 << 3 * (level + depth - 5)) - 1) // 7 - ((1 << 3 * level) - 1) // 7
+        bins.setdefault(bin, []).append([beg, end])
+
+    for level in range(depth, 0, -1):
+        first, last = ((1 << 3 * level) - 1) // 7, ((1 << 3 * level + 3) - 1) // 7
+        for bin in [bin for bin in bins if first <= bin < last]:
+            chunks = sorted(bins[bin]) if level < depth else bins[bin]
+            parent = (bin - 1) >> 3
+            if (chunks[-1][1] >> 16) - (chunks[0][0] >> 16) < 0x10000 and parent in bins:
+                bins[parent].extend(chunks)
+                del bins[bin]
+            else:
+                bins[bin] = chunks
+
+    for bin, chunks in bins.items():
+        merged = [sorted(chunks)[0]] if bin == 0 else [chunks[0]]
+        for beg, end in (sorted(chunks) if bin == 0 else chunks)[1:]:
+            if merged[-1][1] >> 16 >= beg >> 16:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([beg, end])
+        bins[bin] = merged
+
+    # empty windows take the offset of the next window, the last window is never empty
+    linear = index['linear']
+    missing = linear == np.iinfo(np.uint64).max
+    following = np.minimum.accumulate(np.where(missing, linear.shape[0], np.arange(linear.shape[0]))[::-1])[::-1]
+    linear = linear[following]
+
+    # pseudo-bin holding the span of the contig's records and the number of records
+    metaBin = ((1 << 3 * depth + 3) - 1) // 7 + 1
+    bins[metaBin] = [[index['vstart'], index['vend']], [index['n_records'], 0]]
+    return(bins, linear)
+
+def writeVCFIndex(index, path, contig, kind='tbi', min_shift=14):
+
+    """
+    Writes a tabix (.tbi) or CSI (.csi) index for a single contig VCF from an index built with 
+    indexVCFRecords(). The index is BGZF compressed, like those written by tabix and bcftools index. 
+    CSI indexes have 6 levels of bins, as bcftools index.
+    """
+
+    depth = 6 if kind == 'csi' else 5
+    bins, linear = _indexBins(index, depth=depth)
+    name = contig.encode() + b'\0'
+    # tabix configuration: VCF format, sequence column 1, start column 2, '#' comment lines
+    conf = struct.pack('<iiiiiii', 2, 1, 2, 0, ord('#'), 0, len(name)) + name
+    metaBin = ((1 << 3 * depth + 3) - 1) // 7 + 1
+
+    if kind == 'tbi':
+        data = [b'TBI\1', struct.pack('<i', 1), conf, struct.pack('<i', len(bins))]
+    elif kind == 'csi':
+        data = [b'CSI\1', struct.pack('<iii', min_shift, depth, len(conf)), conf, struct.pack('<i', 1), struct.pack('<i', len(bins))]
+    else:
+        raise ValueError(f"Unknown index type {kind}, should be 'tbi' or 'csi'")
+
+    for bin in sorted(bins):
+        chunks = bins[bin]
+        if kind == 'tbi':
+            data.append(struct.pack('<Ii', bin, len(chunks)))
+        else:
+            bottom = binBottom(bin, depth=depth) if bin != metaBin else linear.shape[0]
+            loffset = int(linear[bottom]) if bottom < linear.shape[0] else 0
+            data.append(struct.pack('<IQi', bin, loffset, len(chunks)))
+        data.append(np.asarray(chunks, dtype='<u8').tobytes())
+    if kind == 'tbi':
+        data.append(struct.pack('<i', linear.shape[0]) + linear.astype('<u8').tobytes())
+    data.append(struct.pack('<Q', 0)) # no unplaced records
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.writelines(bgzfCompress(b''.join(data)))
+        f.write(BGZF_EOF)
+    os.replace(tmp, path)
+
+def writeBGZFRecords(f, contig, blocks, header='', max_allele=3, phased=False, level=6, threads=1):
+
+    """
+    Formats blocks of variants as VCF lines and writes them to an open file as BGZF blocks, without 
+    the EOF marker, so the output can be a whole VCF or a segment of one. Returns the index of the 
+    records (see indexVCFRecords()), with virtual offsets relative to the start of the file.
+    """
+
+    lookup = None
+    index = {}
+    blockOffsets = [0] # compressed offset of each BGZF block
+    buffer = header.encode()
+    written = 0 # uncompressed bytes already compressed into blocks
+
+    for pos, ref, alt, gt in blocks:
+        gt = np.asarray(gt)
+        if gt.shape[0] == 0:
+            continue
+        if lookup is None:
+            lookup = genotypeLookup(ploidy=gt.shape[2], max_allele=max_allele, phased=phased)
+        data, lengths = formatVCFRecords(contig, pos, ref, alt, gt, lookup, max_allele=max_allele)
+        
+        ustart = written + len(buffer) + np.cumsum(lengths) - lengths
+        buffer += data
+
+        # compress whole blocks only, the remainder is carried into the next block of variants
+        n_full = len(buffer) // BGZF_BLOCK_SIZE * BGZF_BLOCK_SIZE
+        for block in bgzfCompress(buffer[:n_full], level=level, threads=threads):
+            f.write(block)
+            blockOffsets.append(blockOffsets[-1] + len(block))
+        buffer, written = buffer[n_full:], written + n_full
+
+        # virtual offsets of each line, i.e. the block's compressed offset << 16 | the offset within the block
+        firstBlock = int(ustart[0]) // BGZF_BLOCK_SIZE
+        offsets = np.array(blockOffsets[firstBlock:], dtype=np.int64)
+        toVirtual = lambda u: (offsets[u // BGZF_BLOCK_SIZE - firstBlock] << 16) | (u % BGZF_BLOCK_SIZE)
+        beg = np.asarray(pos, dtype=np.int64) - 1
+        end = beg + np.char.str_len(np.asarray(ref, dtype=str))
+        indexVCFRecords(index, beg, end, toVirtual(ustart), toVirtual(ustart + lengths))
+
+    if buffer:
+        f.write(bgzfBlock(buffer, level=level))
+        # as htslib, the end of the last record points to the start of the next block
+        last = (blockOffsets[-1] << 16) | len(buffer)
+        for runs in index.get('runs', []):
+            runs[2][runs[2] == last] = f.tell() << 16
+        if index.get('vend') == last:
+            index['vend'] = f.tell() << 16
+    return(index)
+
+def shiftIndex(index, offset):
+
+    """
+    Shifts the virtual offsets of an index built by indexVCFRecords() by a compressed offset, 
+    for a BGZF segment that is placed at that offset in a file.
+    """
 
-    idxs = []
-    for _, row in cohorts.iterrows():   
-        # create the pandas metadata query for each cohort
-        mycohortQuery = " & ".join([col + " == " + "'" + row.astype(str)[col] + "'" for col in cohorts.columns])
-        if excludepath is not None:
-            exclude_df = pd.read_csv(excludepath, sep="\t")
-            exclude_samples = exclude_df.query("keep == False")['sample.name']
-            mycohortQuery = " & ".join([mycohortQuery, "partner_sample_id not in @exclude_samples", "sex_call == 'F'"])
-            print(f"Removing {len(exclude_samples)} sib samples from data")
-        # get indices of individuals in each cohort
-        idxs.append(metadata.query(mycohortQuery).index.tolist())
-    
-    cohorts['indices'] = idxs
-    cohorts['cohortText'] = cohorts[cols].agg(' | '.join, axis=1)
-    cohorts['cohortNoSpaceText'] = cohorts['cohortText'].str.replace("|", ".", regex=False).str.replace(" ", "",regex=False)
-    colours = get_colour_dict(cohorts[firstCol], palette="Set1")
-    cohorts['colour'] = cohorts[firstCol].map(colours)
-    if comparatorColumn != None: 
-        cols = cols + ['cohortText', 'cohortNoSpaceText', 'colour']
-        cohorts = cohorts.pivot(index=cols, columns=comparatorColumn)
-        return(cohorts.reset_index())
+    if not index:
+        return(index)
+    shift = np.uint64(offset << 16)
+    linear = index['linear'].copy()
+    linear[linear != np.iinfo(np.uint64).max] += shift
+    return({'runs':[np.stack([runs[0], runs[1] + shift, runs[2] + shift]) for runs in index['runs']],
+            'linear':linear, 
+            'n_records':index['n_records'], 
+            'vstart':index['vstart'] + (offset << 16), 
+            'vend':index['vend'] + (offset << 16)})
 
-    return(cohorts.reset_index(drop=True))
+def mergeIndexes(indexes):
+
+    """
+    Merges the indexes of consecutive segments of a VCF, after shifting them with shiftIndex().
+    """
+
+    indexes = [index for index in indexes if index]
+    if not indexes:
+        return({})
+    linear = np.full(max(index['linear'].shape[0] for index in indexes), np.iinfo(np.uint64).max, dtype=np.uint64)
+    for index in indexes:
+        np.minimum(linear[:index['linear'].shape[0]], index['linear'], out=linear[:index['linear'].shape[0]])
+    return({'runs':[runs for index in indexes for runs in index['runs']],
+            'linear':linear, 
+            'n_records':sum(index['n_records'] for index in indexes), 
+            'vstart':indexes[0]['vstart'], 
+            'vend':indexes[-1]['vend']})
 
-def loadZarrArrays(genotypePath, positionsPath, siteFilterPath, cloud=False, sample_sets=None, site_filter='gamb_colu', contig=None, haplotypes=False):
+def writeVCF(path, header, contig, blocks, max_allele=3, phased=False, level=6, threads=1, indexes=['tbi', 'csi']):
 
     """
-    This function reads genotype arrays and applies provided site filter, or connects to Ag3 malariagen API
+    Streams blocks of variants straight to a BGZF compressed VCF, building the tabix and/or CSI 
+    index in the same pass, so no uncompressed VCF is written to disk.
+
+    Parameters
+    ----------
+    path : str
+        Output path, e.g. resources/vcfs/{dataset}_{contig}.biallelic.vcf.gz. Indexes are written to path.tbi and path.csi.
+    header : str
+        VCF header, including the #CHROM line.
+    contig : str
+        The contig. All records must be on this contig, in position order.
+    blocks : iterable
+        Blocks of variants as (pos, ref, alt, gt) tuples, where pos is an int array, ref and alt are 
+        arrays of strings (multiple ALTs comma separated), and gt is an int genotype array (n_variants, n_samples, ploidy).
+    threads : int
+        Number of threads to compress with.
+    indexes : list
+        Indexes to write, any of 'tbi' and 'csi'.
     """
 
-    if cloud == False:
-        snps = zarr.open_array(genotypePath, mode = 'r')
-        snps = allel.GenotypeDaskArray(snps) if haplotypes == False else allel.GenotypeDaskArray(snps).to_haplotypes()
-        positions = zarr.open_array(positionsPath, mode='r')
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        index = writeBGZFRecords(f, contig, blocks, header=header, max_allele=max_allele, phased=phased, level=level, threads=threads)
+        f.write(BGZF_EOF)
+    os.replace(tmp, path)
 
-        if siteFilterPath is not None:
-            filters = zarr.open(siteFilterPath, mode="r")
-            positions = positions[:][filters[:]]    
-            snps = snps.compress(filters, axis=0)
+    for kind in indexes:
+        writeVCFIndex(index, f"{path}.{kind}", contig, kind=kind)
+    return(index)
 
-    elif cloud == True:
-        ag3 = malariagen_data.Ag3(
-                    "simplecache::gs://vo_agam_release",
-                    simplecache=dict(cache_storage="gcs_cache", pre=True)
-                )
-        
-        if haplotypes == True:
-            snps = ag3.haplotypes(contig, sample_sets=sample_sets, analysis='gamb_colu')
-            positions = snps['variant_position']
-            snps = allel.GenotypeDaskArray(snps).to_haplotypes()
+def _exportBlocks(genotypes, paths, start, stop, blen):
+
+    """
+    Yields (pos, ref, alt, gt) blocks for the selected variants [start, stop) of an export, reading 
+    the genotypes one block at a time. paths are the .npy files of the selected variant indices, 
+    positions, REF, ALT and allele mapping, written by parallelWriteVCF().
+    """
+
+    variants, pos, ref, alt, mapping = [np.load(path, mmap_mode='r') if path else None for path in paths]
+
+    def read(a, b):
+        rows = np.asarray(variants[a:b])
+        gt = genotypes[rows[0]:rows[-1] + 1]
+        gt = np.asarray(gt.compute() if hasattr(gt, 'compute') else gt)[rows - rows[0]]
+        if mapping is not None:
+            gt = np.where(gt < 0, gt, mapping[np.maximum(gt, 0)])
+        return(pos[a:b], ref[a:b], alt[a:b], gt)
+
+    # format and compress the current block while the next ones are read
+    return(prefetchBlocks(read, ((a, min(a + blen, stop)) for a in range(start, stop, blen))))
+
+_exportGenotypes = None
+
+def _setExportGenotypes(genotypes):
+    global _exportGenotypes
+    _exportGenotypes = genotypes
+    dask.config.set(scheduler='synchronous') # one core per worker process
+
+def _writeVCFSegment(path, contig, paths, start, stop, blen, kwargs, genotypes=None):
+    genotypes = _exportGenotypes if genotypes is None else genotypes
+    with open(path, 'wb') as f:
+        return(writeBGZFRecords(f, contig, _exportBlocks(genotypes, paths, start, stop, blen), **kwargs))
+
+def _alleleStrings(alleles):
+
+    """
+    REF or ALT alleles as a fixed-width unicode array, which the export workers can memory-map. Bytes, as zarr 
+    and allel return them, are decoded rather than formatted as b'A'.
+    """
+
+    alleles = np.asarray(alleles)
+    if alleles.dtype.kind in 'SO':
+        alleles = np.char.decode(alleles.astype('S'), 'ascii')
+    return(alleles.astype('U'))
+
+def parallelWriteVCF(path, header, contig, genotypes, pos, ref, alt, variants=None, mapping=None, 
+                     phased=False, threads=1, blen=None, tmpdir=None, indexes=['tbi', 'csi']):
+
+    """
+    Exports genotypes to a BGZF compressed, indexed VCF, in parallel. The selected variants are split 
+    into contiguous regions, each of which is read, formatted and compressed by a worker process into 
+    an independent BGZF segment, one block of variants at a time. The segments are then concatenated in 
+    order (BGZF blocks can simply be concatenated) and their indexes merged into one.
+
+    Parameters
+    ----------
+    path : str
+        Output path, e.g. resources/vcfs/{dataset}_{contig}.biallelic.vcf.gz. Indexes are written to path.tbi and path.csi.
+    header : str
+        VCF header, including the #CHROM line.
+    contig : str
+        The contig.
+    genotypes : array_like, int, shape (n_variants, n_samples, ploidy)
+        Genotype array, e.g. from loadZarrArrays(). Can be a zarr, dask or numpy array, it is only read by the workers.
+    pos, ref, alt : array_like
+        Position, REF and ALT (multiple ALTs comma separated) of each selected variant. REF and ALT can be 
+        strings or bytes, in fixed-width or object arrays.
+    variants : array_like, int, optional
+        Indices of the selected variants in genotypes, in order. Defaults to all variants.
+    mapping : array_like, int, optional
+        Allele recoding applied to every call, e.g. [0, 1, 1, 1] to code all ALT alleles as 1.
+    phased : bool
+        Write phased (|) genotypes, e.g. for haplotypes.
+    threads : int
+        Number of worker processes.
+    blen : int, optional
+        Number of variants each worker reads at once. Defaults to the chunk length of genotypes.
+    """
+
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    import shutil
+
+    variants = np.arange(genotypes.shape[0]) if variants is None else np.asarray(variants)
+    ref, alt = _alleleStrings(ref), _alleleStrings(alt)
+    blen = _chunkLength(genotypes) if blen is None else blen
+    n_regions = min(max(threads * 4, 1), max(variants.shape[0] // blen, 1))
+    bounds = np.linspace(0, variants.shape[0], n_regions + 1).astype(int)
+    kwargs = {'phased':phased, 'max_allele':3 if mapping is None else int(np.max(mapping))}
+
+    with tempfile.TemporaryDirectory(dir=tmpdir) as tmp:
+        paths = []
+        for name, arr in zip(['variants', 'pos', 'ref', 'alt', 'mapping'], [variants, pos, ref, alt, mapping]):
+            paths.append(f"{tmp}/{name}.npy" if arr is not None else None)
+            if arr is not None:
+                np.save(paths[-1], np.asarray(arr))
+
+        segments = [f"{tmp}/segment{i}.bgz" for i in range(n_regions)]
+        if threads <= 1:
+            results = [_writeVCFSegment(segments[i], contig, paths, bounds[i], bounds[i+1], blen, kwargs, genotypes) for i in range(n_regions)]
         else:
-            snps = allel.GenotypeDaskArray(ag3.snp_genotypes(region=contig, sample_sets=sample_sets, site_mask=site_filter))
-            positions = ag3.snp_sites(region=contig, field='POS', site_mask=site_filter)
-            
-    return(snps, allel.SortedIndex(positions))
+            with ProcessPoolExecutor(max_workers=threads, initializer=_setExportGenotypes, initargs=(genotypes,)) as pool:
+                futures = [pool.submit(_writeVCFSegment, segments[i], contig, paths, bounds[i], bounds[i+1], blen, kwargs) for i in range(n_regions)]
+                results = [future.result() for future in futures]
+
+        tmpPath = f"{path}.{os.getpid()}.tmp"
+        with open(tmpPath, 'wb') as f:
+            f.writelines(bgzfCompress(header.encode()))
+            shifted = []
+            for segment, index in zip(segments, results):
+                shifted.append(shiftIndex(index, f.tell()))
+                with open(segment, 'rb') as seg:
+                    shutil.copyfileobj(seg, f)
+            f.write(BGZF_EOF)
+        os.replace(tmpPath, path)
+
+    index = mergeIndexes(shifted)
+    for kind in indexes:
+        writeVCFIndex(index, f"{path}.{kind}", contig, kind=kind)
+    return(index)
+
+def bgzfBlockOffsets(path):
+
+    """
+    Finds the compressed offset of every BGZF block in a file by reading the block headers, 
+    with the file size appended, so block i spans offsets[i]:offsets[i+1].
+    """
+
+    offsets = []
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset < size:
+            f.seek(offset)
+            header = f.read(18)
+            assert header[:4] == b'\x1f\x8b\x08\x04' and header[12:14] == b'BC', f"{path} is not BGZF compressed, compress it with bgzip"
+            offsets.append(offset)
+            offset += struct.unpack('<H', header[16:18])[0] + 1
+    return(np.array(offsets + [size], dtype=np.int64))
+
+def iterBGZFLines(path, blocks, first, last, batch=256):
+
+    """
+    Iterates over the lines of a BGZF file which start in blocks [first, last), yielding them as bytes 
+    in batches of complete lines, decompressing batch blocks at a time. Lines continuing from an 
+    earlier block are skipped, and the last line is completed from the following blocks, so 
+    consecutive ranges of blocks give each line exactly once.
+    """
+
+    with open(path, 'rb') as f:
+
+        def read(a, b):
+            f.seek(blocks[a])
+            return(gzip.decompress(f.read(blocks[b] - blocks[a])))
+
+        # does the first line start in an earlier block?
+        partial = False
+        for prev in range(first - 1, -1, -1):
+            tail = read(prev, prev + 1)
+            if tail:
+                partial = not tail.endswith(b'\n')
+                break
+
+        carry = b''
+        for a in range(first, last, batch):
+            data = carry + read(a, min(a + batch, last))
+            if partial:
+                newline = data.find(b'\n')
+                if newline < 0:
+                    continue
+                data, partial = data[newline + 1:], False
+            cut = data.rfind(b'\n') + 1
+            carry = data[cut:]
+            if cut:
+                yield data[:cut]
+
+        # finish the last line from the following blocks
+        end = last
+        while carry and not partial and end < blocks.shape[0] - 1:
+            more = read(end, end + 1)
+            end += 1
+            newline = more.find(b'\n')
+            carry += more if newline < 0 else more[:newline + 1]
+            if newline >= 0:
+                break
+        if carry and not partial:
+            yield carry if carry.endswith(b'\n') else carry + b'\n'
+
+def vcfSamples(path):
+
+    """
+    Reads the sample names from the #CHROM line of a bgzipped VCF header.
+    """
+
+    blocks = bgzfBlockOffsets(path)
+    for data in iterBGZFLines(path, blocks, 0, blocks.shape[0] - 1, batch=16):
+        for line in data.split(b'\n'):
+            if line.startswith(b'#CHROM'):
+                return([sample.decode() for sample in line.rstrip(b'\r').split(b'\t')[9:]])
+            if not line.startswith(b'#'):
+                break
+    raise ValueError(f"No #CHROM header line found in {path}")
+
+def _vcfLines(buf, contig=None):
+
+    """
+    The start and end (newline) of each line in a buffer of VCF lines, and whether it is a record on the contig.
+    """
+
+    ends = np.flatnonzero(buf == 10)
+    starts = np.concatenate([[0], ends[:-1] + 1]).astype(np.int64)
+    prefix = np.frombuffer(contig.encode() + b'\t', dtype=np.uint8) if contig else np.zeros(0, dtype=np.uint8)
+    keep = (buf[starts] != ord('#')) & (starts != ends)
+    for k, c in enumerate(prefix):
+        keep &= buf[np.minimum(starts + k, buf.shape[0] - 1)] == c
+    return(starts, ends, keep)
+
+@njit()
+def _scanVCFRecords(buf, starts, n_samples, gt, pos, fields):
+
+    """
+    Scans VCF record lines in a single pass, parsing POS and GT (the first FORMAT field) into pos and gt, 
+    and recording the start and end of the REF, ALT and FILTER columns in fields. Returns the index of 
+    the first line without n_samples sample columns, or -1.
+    """
+
+    ploidy = gt.shape[2]
+    slots = np.array([-1, -1, -1, 0, 2, -1, 4]) # columns of fields for REF, ALT and FILTER
+    for i in range(starts.shape[0]):
+        k = starts[i]
+        col = 0
+        hasGT = False
+        while True:
+            c = buf[k]
+            if col == 1 and c != 9:
+                pos[i] = pos[i] * 10 + c - 48
+            elif col == 8 and buf[k - 1] == 9:
+                hasGT = buf[k] == 71 and buf[k + 1] == 84 and (buf[k + 2] == 58 or buf[k + 2] == 9 or buf[k + 2] == 10) # GT
+            elif col >= 9 and hasGT and col < 9 + n_samples:
+                # a sample's GT, e.g. 0/1, 1|12, ., 0
+                j, a, allele = col - 9, 0, -1
+                while c != 9 and c != 10 and c != 58:
+                    if c == 47 or c == 124:
+                        if a < ploidy:
+                            gt[i, j, a] = allele
+                        a, allele = a + 1, -1
+                    elif c != 46:
+                        allele = c - 48 if allele < 0 else allele * 10 + c - 48
+                    k += 1
+                    c = buf[k]
+                if a < ploidy:
+                    gt[i, j, a] = allele
+                while c != 9 and c != 10:
+                    k += 1
+                    c = buf[k]
+
+            if c == 9 or c == 10:
+                if col < 7 and slots[col] >= 0:
+                    fields[i, slots[col] + 1] = k
+                col += 1
+                if col < 7 and slots[col] >= 0:
+                    fields[i, slots[col]] = k + 1
+                if c == 10:
+                    break
+            k += 1
+        if col != 9 + n_samples:
+            return(i)
+    return(-1)
+
+def parseVCFRecords(data, n_samples, contig=None, max_alt=3, ploidy=2):
+
+    """
+    Parses a batch of VCF lines, keeping the records on contig. POS and GT are parsed in a single 
+    numba pass over the raw bytes; REF, ALT and FILTER are then taken from the byte ranges it records.
+
+    Returns
+    -------
+    records : dict
+        POS, REF, ALT (n_variants, max_alt), FILTER_PASS and GT (n_variants, n_samples, ploidy) arrays, 
+        as allel.vcf_to_zarr() names them.
+    """
+
+    buf = np.frombuffer(data, dtype=np.uint8)
+    starts, ends, keep = _vcfLines(buf, contig)
+    starts = starts[keep]
+
+    gt = np.full((starts.shape[0], n_samples, ploidy), -1, dtype=np.int8)
+    pos = np.zeros(starts.shape[0], dtype=np.int32)
+    fields = np.zeros((starts.shape[0], 6), dtype=np.int64)
+    bad = _scanVCFRecords(buf, starts, n_samples, gt, pos, fields)
+    if bad >= 0:
+        raise ValueError(f"Records must have FORMAT and {n_samples} sample columns: {data[starts[bad]:starts[bad] + 100]}")
+
+    return({'POS':pos, 
+            'REF':_fieldStrings(data, buf, fields[:, 0], fields[:, 1]), 
+            'ALT':_altStrings(data, buf, fields[:, 2], fields[:, 3], max_alt=max_alt), 
+            'FILTER_PASS':(fields[:, 5] - fields[:, 4] == 4) & (buf[fields[:, 4]] == ord('P')) & (buf[fields[:, 4] + 1] == ord('A')) & (buf[fields[:, 4] + 2] == ord('S')) & (buf[fields[:, 4] + 3] == ord('S')), 
+            'GT':gt})
+
+_byteChars = np.array([chr(i) for i in range(256)], dtype=object)
+
+def _fieldStrings(data, buf, start, end):
+
+    """
+    Decodes byte ranges of data as strings, looking up single characters (e.g. SNP alleles) in a table.
+    """
+
+    out = np.empty(start.shape[0], dtype=object)
+    single = end - start == 1
+    out[single] = _byteChars[buf[start[single]]]
+    for i in np.flatnonzero(~single):
+        out[i] = data[start[i]:end[i]].decode()
+    return(out)
+
+def _altStrings(data, buf, start, end, max_alt=3):
+
+    """
+    Splits ALT columns into max_alt alleles, padded with ''. ALTs of up to max_alt single characters 
+    (e.g. G or A,T) are looked up in a table, any others are split one by one.
+    """
+
+    length = end - start
+    simple = (length % 2 == 1) & (length <= 2 * max_alt - 1)
+    for offset in range(1, 2 * max_alt - 1, 2):
+        simple &= (offset >= length) | (buf[np.minimum(start + offset, buf.shape[0] - 1)] == ord(','))
+
+    alt = np.full((start.shape[0], max_alt), '', dtype=object)
+    for a in range(max_alt):
+        rows = simple & (2 * a < length)
+        alt[rows, a] = _byteChars[buf[start[rows] + 2 * a]]
+    alt[simple & (alt[:, 0] == '.'), 0] = ''
+    for i in np.flatnonzero(~simple):
+        alleles = data[start[i]:end[i]].decode().split(',')
+        alt[i] = (alleles + [''] * max_alt)[:max_alt]
+    return(alt)
+
+def vcfIndexSpan(path, contig):
+
+    """
+    Reads where a contig's records are in a bgzipped VCF from its tabix (.tbi) or CSI (.csi) index, as 
+    compressed offsets within the BGZF blocks where the first of them starts and the last of them ends. Returns None if there is no 
+    index, or it is older than the VCF, and (0, 0) if the contig is not in the index.
+    """
+
+    for kind in ['tbi', 'csi']:
+        indexPath = f"{path}.{kind}"
+        if os.path.isfile(indexPath) and os.path.getmtime(indexPath) >= os.path.getmtime(path):
+            break
+    else:
+        return(None)
+
+    with open(indexPath, 'rb') as f:
+        data = gzip.decompress(f.read())
+
+    # the tabix configuration ends with the length of the NUL separated contig names, and the names
+    if kind == 'tbi':
+        depth, conf = 5, 8
+        n_ref = struct.unpack_from('<i', data, 4)[0]
+        offset = conf + 28 + struct.unpack_from('<i', data, conf + 24)[0]
+    else:
+        depth, l_aux = struct.unpack_from('<ii', data, 8)
+        conf = 16
+        if l_aux < 28:
+            return(None) # no contig names, e.g. a BCF index
+        n_ref = struct.unpack_from('<i', data, conf + l_aux)[0]
+        offset = conf + l_aux + 4
+    names = [name.decode() for name in data[conf + 28:conf + 28 + struct.unpack_from('<i', data, conf + 24)[0]].split(b'\0')]
+    if contig not in names[:n_ref]:
+        return((0, 0))
+    target = names.index(contig)
+
+    metaBin = ((1 << 3 * depth + 3) - 1) // 7 + 1
+    for ref in range(target + 1):
+        n_bin = struct.unpack_from('<i', data, offset)[0]
+        offset += 4
+        start, end = np.iinfo(np.uint64).max, 0
+        for _ in range(n_bin):
+            if kind == 'tbi':
+                bin, n_chunk = struct.unpack_from('<Ii', data, offset)
+                offset += 8
+            else:
+                bin, _, n_chunk = struct.unpack_from('<IQi', data, offset)
+                offset += 16
+            chunks = np.frombuffer(data, dtype='<u8', count=2 * n_chunk, offset=offset).reshape(-1, 2)
+            offset += 16 * n_chunk
+            if ref == target and bin != metaBin and n_chunk:
+                start, end = min(start, int(chunks[:, 0].min())), max(end, int(chunks[:, 1].max()))
+        if kind == 'tbi':
+            offset += 4 + 8 * struct.unpack_from('<i', data, offset)[0] # linear index
+    if end == 0:
+        return((0, 0))
+    # the end is a virtual offset just past the last record, which may be the start of the next block
+    return((int(start) >> 16, (end - 1) >> 16))
+
+vcfZarrFields = {'GT':'calldata/GT', 'POS':'variants/POS', 'REF':'variants/REF', 'ALT':'variants/ALT', 'FILTER_PASS':'variants/FILTER_PASS'}
+
+def _countVCFRegion(path, blocks, first, last, contig):
+    n = 0
+    for data in iterBGZFLines(path, blocks, first, last):
+        n += _vcfLines(np.frombuffer(data, dtype=np.uint8), contig)[2].sum()
+    return(int(n))
+
+def _ingestVCFRegion(path, blocks, first, last, contig, staging, offset, n_samples, max_alt, done):
+    sync = zarr.ProcessSynchronizer(f"{staging}.sync")
+    arrays = {name:zarr.open_array(f"{staging}/{field}", mode='r+', synchronizer=sync) for name, field in vcfZarrFields.items()}
+    for data in iterBGZFLines(path, blocks, first, last):
+        records = parseVCFRecords(data, n_samples, contig=contig, max_alt=max_alt)
+        n = records['POS'].shape[0]
+        for name, arr in arrays.items():
+            arr[offset:offset + n] = records[name]
+        offset += n
+    open(done, 'w').close()
+
+def vcfToZarr(path, out, contig, threads=1, chunks=(65536, 64), max_alt=3, staging=None):
+
+    """
+    Converts one contig of a bgzipped VCF to Zarr arrays, in the layout loadZarrArrays() reads, i.e. 
+    out/calldata/GT, out/variants/POS, REF, ALT and FILTER_PASS, and out/samples. 
+
+    The VCF is split into regions of BGZF blocks, so no index is needed, but if it has a tabix or CSI 
+    index only the blocks holding the contig's records are read, rather than every block of the file. 
+    Worker processes first count the records in each region, so each region's place in the arrays is known, then parse their regions 
+    and write straight into the arrays. The arrays are built in a staging directory, in which finished 
+    regions are recorded, so an interrupted conversion picks up where it stopped, and are moved to out 
+    once complete.
+
+    Parameters
+    ----------
+    path : str
+        Bgzipped VCF, of one or more contigs.
+    out : str
+        Output Zarr group, e.g. resources/Zarr/{dataset}/{contig}.
+    contig : str
+        Contig to convert.
+    threads : int
+        Number of worker processes.
+    chunks : tuple
+        Chunk shape of GT, in (variants, samples). Chunking samples as well as variants means cohorts, 
+        which are subsets of samples, can be read without decompressing every sample.
+    """
+
+    import shutil
+    from concurrent.futures import ProcessPoolExecutor
+
+    staging = f"{out.rstrip('/')}.ingest" if staging is None else staging
+    key = hash_params(vcf=dataIdentity(path), contig=contig, chunks=list(chunks), max_alt=max_alt)
+    blocks = bgzfBlockOffsets(path)
+
+    def run(func, tasks):
+        if threads <= 1:
+            return([func(*task) for task in tasks])
+        with ProcessPoolExecutor(max_workers=threads) as pool:
+            futures = [pool.submit(func, *task) for task in tasks]
+            return([future.result() for future in futures])
+
+    statePath = f"{staging}/regions.json"
+    state = {}
+    if os.path.isfile(statePath):
+        with open(statePath) as f:
+            state = json.load(f)
+    if state.get('key') != key:
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(f"{staging}/done")
+        first, last = 0, blocks.shape[0] - 1
+        span = vcfIndexSpan(path, contig)
+        if span is not None:
+            # the blocks from the one the contig's first record starts in to the one its last record ends in
+            first, last = int(np.searchsorted(blocks, span[0], side='right')) - 1, int(np.searchsorted(blocks, span[1], side='right'))
+            log(f"Reading blocks {first} to {last} of {blocks.shape[0] - 1}, from the index of {path}")
+        bounds = np.linspace(first, last, max(1, min(threads * 4, last - first)) + 1).astype(int).tolist()
+        log(f"Counting {contig} records in {len(bounds) - 1} regions of {path}")
+        counts = run(_countVCFRegion, [(path, blocks, bounds[i], bounds[i+1], contig) for i in range(len(bounds) - 1)])
+        
+        samples = vcfSamples(path)
+        n, s = sum(counts), len(samples)
+        zarr.array(np.array(samples, dtype=object), store=f"{staging}/samples", object_codec=numcodecs.VLenUTF8())
+        zarr.open_array(f"{staging}/calldata/GT", mode='w', shape=(n, s, 2), chunks=(chunks[0], chunks[1], 2), dtype=np.int8, fill_value=-1)
+        zarr.open_array(f"{staging}/variants/POS", mode='w', shape=(n,), chunks=(chunks[0],), dtype=np.int32)
+        zarr.open_array(f"{staging}/variants/REF", mode='w', shape=(n,), chunks=(chunks[0],), dtype=object, object_codec=numcodecs.VLenUTF8())
+        zarr.open_array(f"{staging}/variants/ALT", mode='w', shape=(n, max_alt), chunks=(chunks[0], max_alt), dtype=object, object_codec=numcodecs.VLenUTF8())
+        zarr.open_array(f"{staging}/variants/FILTER_PASS", mode='w', shape=(n,), chunks=(chunks[0],), dtype=bool)
+        state = {'key':key, 'bounds':bounds, 'counts':counts, 'n_samples':s}
+        with open(f"{statePath}.tmp", 'w') as f:
+            json.dump(state, f)
+        os.replace(f"{statePath}.tmp", statePath)
+
+    bounds, counts = state['bounds'], state['counts']
+    offsets = np.concatenate([[0], np.cumsum(counts)]).tolist()
+    todo = [i for i in range(len(counts)) if not os.path.exists(f"{staging}/done/{i}")]
+    log(f"Parsing {len(todo)} of {len(counts)} regions ({offsets[-1]} {contig} records) with {threads} processes")
+    run(_ingestVCFRegion, [(path, blocks, bounds[i], bounds[i+1], contig, staging, offsets[i], state['n_samples'], max_alt, f"{staging}/done/{i}") for i in todo])
+
+    for field in list(vcfZarrFields.values()) + ['samples']:
+        dest = f"{out}/{field}"
+        shutil.rmtree(dest, ignore_errors=True)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(f"{staging}/{field}", dest)
+    shutil.rmtree(staging)
+    shutil.rmtree(f"{staging}.sync", ignore_errors=True)
 
 def plotRectangular(voiFreqTable, path, annot="blank0", xlab="Sample", ylab="Variant Of Interest", title=None, figsize=[10,10], cbar=True, vmax=None, rotate=True, cmap=sns.cubehelix_palette(start=.5, rot=-.75, as_cmap=True), dpi=100):
     
@@ -286,11 +2237,13 @@ def fig_pca(coords, model, title, path, samples, pop_colours,sample_population=N
         
         fig.savefig(path, bbox_inches='tight', dpi=300)
 
-def pca(geno, contig, ploidy, dataset, populations, samples, pop_colours, prune=True, scaler=None):
+def pca(geno, contig, ploidy, dataset, populations, samples, pop_colours, prune=True, scaler=None, threads=1):
     if prune is True:
         if ploidy > 1:
             geno = geno.to_n_alt()
-        geno = ld_prune(geno, size=500, step=200,threshold=0.2)
+        # the keep-mask is persisted for this contig and set of samples, so later runs skip pruning
+        cacheParams = dict(contig=contig, dataset=dataset, samples=hash_params(np.asarray(samples).astype(str).tolist()), n_variants=int(geno.shape[0]))
+        geno = ld_prune(geno, size=500, step=200,threshold=0.2, threads=threads, cacheParams=cacheParams)
     else:
         if ploidy > 1:
             geno = geno.to_n_alt()
@@ -300,21 +2253,232 @@ def pca(geno, contig, ploidy, dataset, populations, samples, pop_colours, prune=
     fig_pca(coords1, model1, f"PCA {contig} {dataset}", f"gaardian/PCA/PCA-{contig}-{dataset}", samples, pop_colours, sample_population=populations)
 
 
+@njit(nogil=True)
+def _pruneWindow(r2, loc, members, threshold):
+    # greedily drop later variants in LD with each variant still kept, in order along the window
+    for a in range(members.shape[0]):
+        if loc[members[a]]:
+            for b in range(a + 1, members.shape[0]):
+                if loc[members[b]] and r2[a, b] > threshold:
+                    loc[members[b]] = False
+
+def _windowR2(x, called):
+
+    """
+    r² between every pair of variants in a window, excluding samples with a missing call in either variant as 
+    allel does, from four matrix products. x holds alt counts with missing calls set to 0, called is 1 where called.
+    """
+
+    n = called @ called.T
+    sums = x @ called.T
+    squares = (x ** 2) @ called.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m0, m1 = sums / n, sums.T / n
+        cov = (x @ x.T) / n - m0 * m1
+        r = cov / np.sqrt((squares / n - m0 ** 2) * (squares.T / n - m1 ** 2))
+        r[(n == 0) | (squares == 0) | (squares.T == 0)] = np.nan
+    return(r ** 2)
+
+def _readUnlinkedBlock(gn, rows):
+
+    """
+    Reads the alt counts of the given (sorted) rows for LD pruning. Without missing calls, genotypes are 
+    standardised, so r between two variants is a dot product; with them, missing calls are set to 0 and returned 
+    with a mask of called genotypes, to be excluded pairwise. Standardising is per variant, so it runs ahead of 
+    the pruning, on the prefetch threads.
+    """
+
+    gn = _readBlock(gn, rows[0], rows[-1] + 1)[2][rows - rows[0]]
+    called = gn >= 0
+    if not called.all():
+        return(np.where(called, gn, 0).astype(np.float64), called.astype(np.float64))
+    x = gn - gn.mean(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x /= np.sqrt((x ** 2).sum(axis=1, keepdims=True))
+    return(x, None)
+
+def _locateUnlinkedBlock(x, called, loc, size, step, threshold):
+
+    """
+    LD prunes one block in place in loc, its view of the keep-mask, as allel's gn_locate_unlinked_int8 does. 
+    Variants already dropped in loc, where the previous block overlaps this one, stay dropped. Each window's r² is 
+    one matrix product of standardised genotypes, or four products with missing calls.
+    """
+
+    for start in range(0, x.shape[0], step):
+        members = start + np.flatnonzero(loc[start:start + size])
+        if called is None:
+            r2 = (x[members] @ x[members].T) ** 2
+        else:
+            r2 = _windowR2(x[members], called[members])
+        _pruneWindow(r2, loc, members, threshold)
+
+def locateUnlinked(gn, size, step, threshold=.1, n_iter=1, threads=1, blen=None):
 
-def ld_prune(gn, size, step, threshold=.1, n_iter=1):
     """
-    Performs LD pruning, originally from Alistair Miles' blog. 
+    Locates variants in approximate linkage equilibrium, like allel.locate_unlinked() applied n_iter times, each 
+    round to the variants kept by the last. As in allel, the variants are split into blocks of at least 10 
+    windows, overlapping by one window, and each block starts from the decisions the previous block made on their 
+    overlap, so blocks are pruned in order; the next blocks are read and standardised on threads meanwhile.
     """
+
+    n_variants = gn.shape[0]
+    blen = max(_chunkLength(gn) if blen is None else blen, 10 * size)
+
+    keep = np.ones(n_variants, dtype=bool)
     for i in range(n_iter):
-        loc_unlinked = allel.locate_unlinked(gn, size=size, step=step, threshold=threshold)
-        n = np.count_nonzero(loc_unlinked)
-        n_remove = gn.shape[0] - n
-        print('iteration', i+1, 'retaining', n, 'removing', n_remove, 'variants')
-        gn = gn.compress(loc_unlinked, axis=0)
-    return gn
+        idx = np.flatnonzero(keep)
+        loc = np.ones(idx.shape[0], dtype=bool)
+        starts = range(0, idx.shape[0], blen)
+        blocks = prefetchBlocks(lambda rows: _readUnlinkedBlock(gn, rows), [(idx[start:start + blen + size],) for start in starts], prefetch=threads)
+        for start, (x, called) in zip(starts, blocks):
+            _locateUnlinkedBlock(x, called, loc[start:start + blen + size], size, step, threshold)
+        keep[idx[~loc]] = False
+    return(keep)
+
+def ld_prune(gn, size, step, threshold=.1, n_iter=1, threads=1, cacheParams=None):
+    """
+    Performs LD pruning, originally from Alistair Miles' blog. If cacheParams are given (identifying the 
+    contig and samples), the keep-mask is saved to the mask store, and later runs read it instead of pruning.
+    """
+    compute = lambda: locateUnlinked(gn, size=size, step=step, threshold=threshold, n_iter=n_iter, threads=threads)
+    if cacheParams is None:
+        loc_unlinked = compute()
+    else:
+        loc_unlinked = cachedMask('unlinked', compute, size=size, step=step, threshold=threshold, n_iter=n_iter, **cacheParams)
+    n = np.count_nonzero(loc_unlinked)
+    n_remove = gn.shape[0] - n
+    print('retaining', n, 'removing', n_remove, 'variants')
+    return gn.compress(loc_unlinked, axis=0)
+
+def iterSelectedBlocks(gt, variants, blen=None):
+
+    """
+    Iterates over the selected variants (sorted indices) of a genotype array, reading one chunk of the array 
+    at a time and yielding the start and stop into variants along with the selected rows of that chunk, so 
+    that thinned selections never read more than one chunk at once.
+    """
+
+    blen = _chunkLength(gt) if blen is None else blen
+    bounds = np.searchsorted(variants, np.arange(0, gt.shape[0] + blen, blen))
+    bounds = np.unique(np.clip(bounds, 0, variants.shape[0]))
+
+    def read(a, b):
+        rows = variants[a:b]
+        block = gt[rows[0]:rows[-1] + 1]
+        block = np.asarray(block.compute() if hasattr(block, 'compute') else block)
+        return(a, b, block[rows - rows[0]])
+
+    return(prefetchBlocks(read, zip(bounds[:-1], bounds[1:])))
+
+def _pattersonScale(gn, ploidy=2):
+
+    """
+    Drops variants where all samples have the same alt count, and scales the rest as allel.pca() does with the 
+    Patterson scaler.
+    """
+
+    gn = gn[np.any(gn != gn[:, 0, np.newaxis], axis=1)]
+    mean = gn.mean(axis=1, keepdims=True)
+    p = mean / ploidy
+    return((gn - mean) / np.sqrt(p * (1 - p)))
+
+def accumulateGram(gt, variants=None, blen=None, ploidy=2):
+
+    """
+    Accumulates the sample x sample Gram matrix of the Patterson-scaled alt counts of the selected variants 
+    (sorted indices, defaulting to all) of a genotype array, one block of variants at a time. Variants where all 
+    genotypes are identical are skipped. Gram matrices of the same samples sum over variants, so those of 
+    separate contigs can be added together.
+    """
+
+    variants = np.arange(gt.shape[0]) if variants is None else np.asarray(variants)
+    gram = np.zeros((gt.shape[1], gt.shape[1]), dtype=np.float64)
+
+    for start, stop, block in iterSelectedBlocks(gt, variants, blen=blen):
+        x = _pattersonScale((block > 0).sum(axis=2, dtype=np.int8), ploidy=ploidy)
+        gram += x.T @ x
+    return(gram)
+
+def accumulateCohortGrams(gt, variants, indices, blen=None, ploidy=2):
+
+    """
+    Accumulates the Gram matrix of every cohort in a single pass over a genotype array. Each cohort has its own 
+    sorted variant selection, and the pass reads the union of the selections, so each cohort's Gram matrix is 
+    the same as accumulateGram(gt.take(indices_i, axis=1), variants_i) would give. Alt counts are centred and 
+    scaled within each cohort.
+    """
 
+    union = np.unique(np.concatenate([np.asarray(v) for v in variants]))
+    selected = [np.isin(union, v) for v in variants]
+    indices = [np.asarray(idx) for idx in indices]
+    grams = [np.zeros((idx.shape[0], idx.shape[0]), dtype=np.float64) for idx in indices]
 
+    for start, stop, block in iterSelectedBlocks(gt, union, blen=blen):
+        gn = (block > 0).sum(axis=2, dtype=np.int8)
+        for gram, sel, idx in zip(grams, selected, indices):
+            x = _pattersonScale(gn[sel[start:stop]][:, idx], ploidy=ploidy)
+            gram += x.T @ x
+    return(grams)
 
+def gramPCA(gram, n_components=10):
+
+    """
+    Sample coordinates and explained variance ratios of the first n_components principal components, 
+    from the eigendecomposition of a Gram matrix from accumulateGram().
+    """
+
+    eigvals, eigvecs = np.linalg.eigh(gram)
+    eigvals, eigvecs = np.clip(eigvals[::-1], 0, None), eigvecs[:, ::-1]
+    coords = eigvecs[:, :n_components] * np.sqrt(eigvals[:n_components])
+    evr = eigvals[:n_components] / eigvals.sum()
+    return(coords, evr)
+
+def streamingPCA(gt, variants=None, n_components=10, blen=None, ploidy=2):
+
+    """
+    PCA of the alt counts of a genotype array, equivalent to allel.pca() with the Patterson scaler, that never 
+    holds more than one block of variants in memory. The sample x sample Gram matrix of the scaled alt counts is 
+    accumulated block by block, and its eigendecomposition gives the same coordinates and explained variance as 
+    the SVD of the full matrix, so memory is bounded by the number of samples squared. Variants where all 
+    genotypes are identical are skipped.
+
+    Parameters
+    ----------
+    gt : array_like, int, shape (n_variants, n_samples, ploidy)
+        Genotype array. Can be a zarr, dask or numpy array.
+    variants : array_like, int, optional
+        Sorted indices of the variants to use. Defaults to all variants.
+    n_components : int
+        Number of components to return.
+    blen : int, optional
+        Number of variants to read per block. Defaults to the chunk length of gt.
+
+    Returns
+    -------
+    coords : numpy array, shape (n_samples, n_components)
+        Sample coordinates on each component.
+    evr : numpy array, shape (n_components,)
+        Explained variance ratio of each component.
+    """
+
+    gram = accumulateGram(gt, variants=variants, blen=blen, ploidy=ploidy)
+    return(gramPCA(gram, n_components=n_components))
+
+def wholeGenomePCA(gramPaths, n_components=10):
+
+    """
+    Genome-wide PCA from the Gram matrices saved by run_pca() for each contig, each built from that contig's 
+    thinned SNP selection. The matrices are loaded and summed one at a time, so memory does not grow with the 
+    number of contigs, and the result equals a PCA of the selected SNPs of all contigs concatenated. 
+    Returns the same as streamingPCA().
+    """
+
+    gram = None
+    for path in gramPaths:
+        contigGram = np.load(path)
+        gram = contigGram if gram is None else gram + contigGram
+    return(gramPCA(gram, n_components=n_components))
 
 
 #####  PCA function from alistair ####
@@ -330,6 +2494,32 @@ def hash_params(*args, **kwargs):
     return h
 
 
+def selectPCASites(ac, n_samples, min_minor_ac=3, max_an_missing=0, n_snps=100000, snp_offset=0):
+
+    """
+    Indices of the sites run_pca() uses: biallelic sites involving the reference allele, within the allele 
+    count and missingness limits, thinned to approximately n_snps.
+    """
+
+    ac = allel.AlleleCountsArray(ac)
+    
+    # calculate some convenience variables
+    n_chroms = n_samples * 2
+    an_called = ac.sum(axis=1)
+    an_missing = n_chroms - an_called
+    min_ref_ac = min_minor_ac
+    max_ref_ac = n_chroms - min_minor_ac
+
+    # here we choose biallelic sites involving the reference allele
+    loc_seg = np.nonzero(ac.is_biallelic() & 
+                         (ac[:, 0] >= min_ref_ac) & 
+                         (ac[:, 0] <= max_ref_ac) & 
+                         (an_missing <= max_an_missing))[0]
+
+    # thin SNPs to approximately the desired number
+    snp_step = max(loc_seg.shape[0] // n_snps, 1) if n_snps else 1
+    return(loc_seg[snp_offset::snp_step])
+
 def run_pca(contig,
             gt,
             pos,
@@ -345,7 +2535,8 @@ def run_pca(contig,
     n_snps=100000,
     snp_offset=0,
     n_components=10,
-    results_dir=""):
+    results_dir="",
+    gram_path=None):
     """Main function to run a PCA.
     
     Parameters
@@ -366,12 +2557,16 @@ def run_pca(contig,
         Minimum minor allele count.
     max_an_missing : int
         Maximum number of missing allele calls.
-    n_snps : int
-        Approximate number of SNPs to use.
+    n_snps : int or None
+        Approximate number of SNPs to use, or None to use every SNP that passes the filters. 
+        The PCA is streamed, so memory is bounded by the number of samples squared either way.
     snp_offset : int
         Offset when thinning SNPs.
     n_components : int
         Number of PCA components to retain.
+    gram_path : str, optional
+        Where to save the sample Gram matrix of the selected SNPs, so that contigs 
+        can be combined by wholeGenomePCA().
 
     Returns
     -------
@@ -400,11 +2595,14 @@ def run_pca(contig,
     # define paths for results files
     data_path = f'{results_dir}/{results_key}-data.csv'
     evr_path = f'{results_dir}/{results_key}-evr.npy'
+    gram_cache_path = f'{results_dir}/{results_key}-gram.npy'
 
     try:
         # try to load previously generated results
         data = pd.read_csv(data_path)
         evr = np.load(evr_path)
+        if gram_path:
+            np.save(gram_path, np.load(gram_cache_path))
         return data, evr
     except FileNotFoundError:
         # no previous results available, need to run analysis
@@ -429,41 +2627,18 @@ def run_pca(contig,
     print('locating segregating sites within desired frequency range')
 
     # perform allele count
-    ac = gt.count_alleles(max_allele=3).compute()
-    
-    # calculate some convenience variables
-    n_chroms = gt.shape[1] * 2
-    an_called = ac.sum(axis=1)
-    an_missing = n_chroms - an_called
-    min_ref_ac = min_minor_ac
-    max_ref_ac = n_chroms - min_minor_ac
-
-    # here we choose biallelic sites involving the reference allele
-    loc_seg = np.nonzero(ac.is_biallelic() & 
-                         (ac[:, 0] >= min_ref_ac) & 
-                         (ac[:, 0] <= max_ref_ac) & 
-                         (an_missing <= max_an_missing))[0]
+    ac = countAlleles(gt, max_allele=3)
     
     print('preparing PCA input data')
 
-    # thin SNPs to approximately the desired number
-    snp_step = loc_seg.shape[0] // n_snps
-    loc_seg_ds = loc_seg[snp_offset::snp_step]
-
-    # subset genotypes to selected sites
-    gt_seg = da.take(gt, loc_seg_ds, axis=0)
-    
-    # convert to genotype alt counts
-    gn_seg = gt_seg.to_n_alt().compute()
-    
-    # remove any edge-case variants where all genotypes are identical
-    loc_var = np.any(gn_seg != gn_seg[:, 0, np.newaxis], axis=1)
-    gn_var = np.compress(loc_var, gn_seg, axis=0)
+    loc_seg_ds = selectPCASites(ac, gt.shape[1], min_minor_ac=min_minor_ac, max_an_missing=max_an_missing, 
+                                n_snps=n_snps, snp_offset=snp_offset)
 
     print('running PCA')
 
-    # run the PCA
-    coords, model = allel.pca(gn_var, n_components=n_components)
+    # run the PCA, streaming the selected sites' alt counts block by block
+    gram = accumulateGram(gt, variants=loc_seg_ds)
+    coords, evr = gramPCA(gram, n_components=n_components)
     
     # add PCs to dataframe
     data = df_samples.copy()
@@ -471,13 +2646,111 @@ def run_pca(contig,
         data[f'PC{i+1}'] = coords[:, i]
     
     # save results
-    evr = model.explained_variance_ratio_
     data.to_csv(data_path, index=False)
     np.save(evr_path, evr)
+    np.save(gram_cache_path, gram)
+    if gram_path:
+        np.save(gram_path, gram)
     print(f'saved results: {results_key}')
     
     return data, evr
     
+def run_pca_cohorts(contig,
+            gt,
+            pos,
+            df_samples,
+            cohorts,
+    region_start=None, 
+    region_stop=None,
+    site_mask="gamb_colu",
+    min_minor_ac=3,
+    max_an_missing=0,
+    n_snps=100000,
+    snp_offset=0,
+    n_components=10,
+    results_dir=""):
+    """Runs a PCA of each cohort, as run_pca() would with sample_sets set to the cohort name, but 
+    with one pass over the contig to count alleles in all cohorts and one pass over the union of 
+    the cohorts' thinned sites to accumulate their Gram matrices. Cohorts with saved results are 
+    loaded and skipped.
+    
+    Parameters
+    ----------
+    cohorts : pandas DataFrame
+        Cohorts from loadCohortManifest(), with 'indices' and 'cohortNoSpaceText' columns. 
+        Cohorts must not overlap.
+
+    The other parameters are as for run_pca().
+
+    Returns
+    -------
+    results : list of (data, evr) tuples
+        The run_pca() results of each cohort, in the order of cohorts.
+    
+    """
+
+    results, todo = [], []
+    for i, (idx, cohort) in enumerate(cohorts.iterrows()):
+        results_key = hash_params(
+            contig=contig,
+            region_start=region_start, 
+            region_stop=region_stop,
+            sample_sets=cohort['cohortNoSpaceText'],
+            sample_query=None,
+            site_mask=site_mask,
+            min_minor_ac=min_minor_ac,
+            max_an_missing=max_an_missing,
+            n_snps=n_snps,
+            snp_offset=snp_offset,
+            n_components=n_components
+        )
+        data_path = f'{results_dir}/{results_key}-data.csv'
+        evr_path = f'{results_dir}/{results_key}-evr.npy'
+        try:
+            results.append((pd.read_csv(data_path), np.load(evr_path)))
+        except FileNotFoundError:
+            print(f'running analysis: {results_key}')
+            results.append(None)
+            todo.append((i, cohort, results_key, data_path, evr_path))
+
+    if not todo:
+        return results
+
+    if region_start or region_stop:
+        # locate region within contig
+        loc_region = slice(
+            bisect.bisect_left(pos, region_start) if region_start else None,
+            bisect.bisect_right(pos, region_stop) if region_stop else None,
+        )
+        gt = gt[loc_region]
+
+    print('locating segregating sites within desired frequency range in each cohort')
+
+    indices = [np.asarray(cohort['indices']) for i, cohort, *_ in todo]
+    ac = countAllelesCohorts(gt, cohortLabels(indices, gt.shape[1]), max_allele=3)
+    variants = [selectPCASites(ac[:, j], idx.shape[0], min_minor_ac=min_minor_ac, max_an_missing=max_an_missing, 
+                               n_snps=n_snps, snp_offset=snp_offset) for j, idx in enumerate(indices)]
+
+    print('running PCA of each cohort')
+
+    grams = accumulateCohortGrams(gt, variants, indices)
+    for (i, cohort, results_key, data_path, evr_path), idx, gram in zip(todo, indices, grams):
+        coords, evr = gramPCA(gram, n_components=n_components)
+        
+        # add PCs to dataframe
+        data = df_samples.take(idx).copy()
+        for c in range(n_components):
+            data[f'PC{c+1}'] = coords[:, c]
+
+        # save results
+        data.to_csv(data_path, index=False)
+        np.save(evr_path, evr)
+        np.save(f'{results_dir}/{results_key}-gram.npy', gram)
+        print(f'saved results: {results_key}')
+        results[i] = (data, evr)
+
+    return results
+
 
 def plot_variance(evr, **kwargs):
     """Plot a bar chart showing variance explained by each principal
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Regression checks of probetools against the scikit-allel and scipy functions it replaces
+"""
+
+import gzip
+import os
+import struct
+import sys
+import tempfile
+import unittest
+import zlib
+
+import allel
+import numpy as np
+import scipy.cluster.hierarchy
+import scipy.spatial.distance
+import zarr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import probetools as probe
+
+
+def simulateGenotypes(n_variants=500, n_samples=30, missing=0.05, seed=42):
+
+    rng = np.random.default_rng(seed)
+    gt = rng.integers(0, 2, size=(n_variants, n_samples, 2)).astype(np.int8)
+    gt[rng.random((n_variants, n_samples)) < missing] = -1
+    # and some half-missing calls
+    gt[rng.random((n_variants, n_samples)) < missing / 5, 1] = -1
+    return(gt)
+
+class TestAltCountCache(unittest.TestCase):
+
+    def setUp(self):
+
+        self.gt = simulateGenotypes()
+        self.expected = allel.GenotypeArray(self.gt).to_n_alt()
+        self.dir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.dir.name, "altcounts")
+        probe.writeAltCountCache(self.gt, np.arange(self.gt.shape[0]), path, blen=64)
+        self.packed, self.pos, self.n_samples = probe.openAltCountCache(path)
+
+    def tearDown(self):
+
+        self.dir.cleanup()
+
+    def test_matches_to_n_alt(self):
+
+        np.testing.assert_array_equal(probe.unpackAltCounts(self.packed, self.n_samples), self.expected)
+
+    def test_cohort_rows(self):
+
+        samples = np.array([3, 0, 7, 29, 12])
+        rows = np.arange(self.gt.shape[0]) % 3 == 0
+        np.testing.assert_array_equal(probe.unpackAltCounts(self.packed, self.n_samples, samples=samples, rows=rows),
+                                      self.expected[rows][:, samples])
+
+    def test_identical_haplotypes_g12(self):
+
+        # identical homozygotes, with missing calls at sites where they are homozygous reference, are one cluster
+        gt = np.repeat(simulateGenotypes(n_samples=1, missing=0)[:, :, :1], 2, axis=2)
+        gt = np.repeat(gt, 30, axis=1)
+        gt[(np.random.default_rng(1).random(gt.shape[:2]) < 0.05) & (gt[:, :, 0] == 0)] = -1
+        gn = probe.unpackAltCounts(probe.packAltCounts(self.packCodes(gt)), gt.shape[1])
+        self.assertEqual(probe.garudsG(gn, cut_height=0.1, metric='euclidean', g=2), 1.0)
+
+    def test_g12_matches_to_n_alt(self):
+
+        gn = probe.unpackAltCounts(self.packed, self.n_samples)
+        for metric in ['euclidean', 'hamming']:
+            self.assertEqual(probe.garudsG(gn, cut_height=0.1, metric=metric, g=2),
+                             probe.garudsG(self.expected, cut_height=0.1, metric=metric, g=2))
+
+    @staticmethod
+    def packCodes(gt):
+
+        # alt counts as writeAltCountCache() packs them
+        gn = (gt > 0).sum(axis=2, dtype=np.int8)
+        gn[(gt < 0).all(axis=2)] = -1
+        return(gn)
+
+def clusterMultiLocusGenotypes(gnalt, cut_height=0.1, metric='euclidean', g=2):
+
+    # G12/G123 by single-linkage clustering with scipy, as GarudsStatistics.py computed it before garudsG()
+    dist = scipy.spatial.distance.pdist(gnalt.T, metric=metric)
+    if metric in {'hamming', 'jaccard'}:
+        dist *= gnalt.shape[0]
+    cut = scipy.cluster.hierarchy.cut_tree(scipy.cluster.hierarchy.linkage(dist, method='single'), height=cut_height)[:, 0]
+    freqs = np.sort(np.bincount(cut) / gnalt.shape[1])[::-1]
+    return(np.sum(freqs[:g])**2 + np.sum(freqs[g:]**2))
+
+def simulateMultiLocusGenotypes(n_variants=600, n_samples=40, seed=11):
+
+    # a few founder genotypes copied with some changed calls, so that clusters form at small cut heights
+    rng = np.random.default_rng(seed)
+    founders = rng.integers(0, 3, size=(n_variants, 4))
+    gnalt = founders[:, rng.integers(0, 4, size=n_samples)]
+    changed = rng.random(gnalt.shape) < 0.01
+    gnalt[changed] = rng.integers(0, 3, size=changed.sum())
+    return(gnalt.astype(np.int8))
+
+class TestGarudsG(unittest.TestCase):
+
+    def setUp(self):
+
+        self.gnalt = simulateMultiLocusGenotypes()
+
+    def test_matches_linkage(self):
+
+        for metric, cut_height in [('euclidean', 2), ('euclidean', 4.5), ('hamming', 3), ('cityblock', 5), ('jaccard', 3)]:
+            for g in [2, 3]:
+                with self.subTest(metric=metric, cut_height=cut_height, g=g):
+                    self.assertAlmostEqual(probe.garudsG(self.gnalt, cut_height=cut_height, metric=metric, g=g),
+                                           clusterMultiLocusGenotypes(self.gnalt, cut_height=cut_height, metric=metric, g=g))
+
+    def test_moving_matches_linkage(self):
+
+        # overlapping windows update the distances incrementally, including steps that share no factor with the size
+        for metric in ['euclidean', 'hamming']:
+            for size, step in [(200, 100), (200, 200), (150, 7), (120, 45)]:
+                with self.subTest(metric=metric, size=size, step=step):
+                    expected = allel.moving_statistic(self.gnalt, clusterMultiLocusGenotypes, size=size, step=step, metric=metric, cut_height=3, g=2)
+                    np.testing.assert_allclose(probe.movingGarudsG(self.gnalt, size=size, step=step, metric=metric, cut_height=3, g=2), expected)
+
+class TestGarudH(unittest.TestCase):
+
+    def setUp(self):
+
+        # half of the haplotypes copy the other half, with a few changed alleles, so that windows hold shared haplotypes
+        rng = np.random.default_rng(3)
+        self.ht = rng.integers(0, 2, size=(5003, 200)).astype(np.int8)
+        self.ht[:, 100:] = self.ht[:, :100]
+        self.ht[rng.random(self.ht.shape) < 0.001] ^= 1
+        self.packed = probe.packHaplotypes(self.ht)
+
+    def test_matches_moving_garud_h(self):
+
+        # blocks of gcd(size, step) SNPs, blocks not aligned to bytes, and whole windows
+        for size, step in [(1200, 600), (100, 20), (1200, 601), (37, 5)]:
+            with self.subTest(size=size, step=step):
+                for got, expected in zip(probe.movingGarudH(self.packed, self.ht.shape[0], size=size, step=step),
+                                         allel.moving_garud_h(self.ht, size=size, step=step)):
+                    np.testing.assert_allclose(got, expected)
+
+class TestStreamingPCA(unittest.TestCase):
+
+    def test_matches_svd(self):
+
+        # two populations with different allele frequencies, and some invariant sites, which are skipped
+        rng = np.random.default_rng(13)
+        freqs = rng.random((2000, 2)) * np.array([1, 0.5])
+        gt = (rng.random((2000, 60, 2)) < np.repeat(freqs, 30, axis=1)[:, :, None]).astype(np.int8)
+        gt[:100] = 0
+        coords, evr = probe.streamingPCA(gt, n_components=4, blen=256)
+
+        # the SVD of the Patterson scaled alt counts, as allel.pca() does, in float64 rather than allel's lower precision
+        gn = allel.GenotypeArray(gt[100:]).to_n_alt().astype(np.float64)
+        mean = gn.mean(axis=1, keepdims=True)
+        p = mean / 2
+        u, s, _ = np.linalg.svd(((gn - mean) / np.sqrt(p * (1 - p))).T, full_matrices=False)
+        expected = u[:, :4] * s[:4]
+        # components are only defined up to sign
+        signs = np.sign(np.sum(coords * expected, axis=0))
+        np.testing.assert_allclose(coords * signs, expected, atol=1e-8)
+        np.testing.assert_allclose(evr, (s ** 2 / np.sum(s ** 2))[:4], atol=1e-12)
+
+class TestLocateUnlinked(unittest.TestCase):
+
+    def setUp(self):
+
+        # runs of four identical variants, with some calls changed, so that windows hold variants in LD
+        rng = np.random.default_rng(7)
+        self.gn = np.repeat(rng.integers(0, 3, size=(900, 40)), 4, axis=0).astype(np.int8)
+        changed = rng.random(self.gn.shape) < 0.1
+        self.gn[changed] = rng.integers(0, 3, size=changed.sum())
+
+    def assertMatchesAllel(self, gn, n_iter=1):
+
+        expected = np.ones(gn.shape[0], dtype=bool)
+        for i in range(n_iter):
+            idx = np.flatnonzero(expected)
+            expected[idx[~allel.locate_unlinked(gn[idx], size=100, step=20, threshold=.1, blen=1000)]] = False
+        np.testing.assert_array_equal(probe.locateUnlinked(gn, size=100, step=20, threshold=.1, n_iter=n_iter, threads=2, blen=1000), expected)
+
+    def test_several_blocks(self):
+
+        self.assertMatchesAllel(self.gn)
+
+    def test_missing_calls(self):
+
+        self.gn[np.random.default_rng(8).random(self.gn.shape) < 0.03] = -1
+        self.assertMatchesAllel(self.gn)
+
+    def test_n_iter(self):
+
+        self.assertMatchesAllel(self.gn, n_iter=2)
+
+def readIndexChunks(path):
+
+    # the bins of a single contig .tbi or .csi index, with the tabix linear index, parsed from the spec rather than probetools
+    with gzip.open(path) as f:
+        data = f.read()
+    if data[:4] == b'TBI\1':
+        min_shift, depth, offset = 14, 5, 8
+        offset += 28 + struct.unpack_from('<i', data, offset + 24)[0]
+    else:
+        min_shift, depth, l_aux = struct.unpack_from('<iii', data, 4)
+        offset = 20 + l_aux
+    n_bins, = struct.unpack_from('<i', data, offset)
+    offset += 4
+    bins = {}
+    for i in range(n_bins):
+        if depth == 5:
+            bin, n_chunks = struct.unpack_from('<Ii', data, offset)
+            offset += 8
+        else:
+            bin, _, n_chunks = struct.unpack_from('<IQi', data, offset)
+            offset += 16
+        bins[bin] = np.frombuffer(data, dtype='<u8', count=2 * n_chunks, offset=offset).reshape(-1, 2)
+        offset += 16 * n_chunks
+    linear = np.zeros(0, dtype=np.uint64)
+    if depth == 5:
+        n_intervals, = struct.unpack_from('<i', data, offset)
+        linear = np.frombuffer(data, dtype='<u8', count=n_intervals, offset=offset + 4)
+    return(bins, linear, min_shift, depth)
+
+def queryVCF(path, index, beg, end):
+
+    # the (POS, REF) of the records that the index points to for the 0-based region [beg, end), as htslib queries it
+    bins, linear, min_shift, depth = index
+    candidates, first = [], 0
+    for level in range(depth + 1):
+        shift = min_shift + 3 * (depth - level)
+        candidates.extend(range(first + (beg >> shift), first + ((end - 1) >> shift) + 1))
+        first += 1 << 3 * level
+    min_offset = int(linear[beg >> min_shift]) if (beg >> min_shift) < linear.shape[0] else 0
+
+    # decompressed offset of each virtual offset
+    blocks = probe.bgzfBlockOffsets(path)
+    with open(path, 'rb') as f:
+        raw = f.read()
+    text = [zlib.decompress(raw[a:b][18:-8], -15) for a, b in zip(blocks[:-1], blocks[1:])]
+    starts = dict(zip(blocks[:-1].tolist(), np.cumsum([0] + [len(t) for t in text[:-1]]).tolist()))
+    text = b''.join(text)
+    virtual = lambda v: starts[int(v) >> 16] + (int(v) & 0xFFFF)
+
+    records = set()
+    for bin in candidates:
+        for chunk_beg, chunk_end in bins.get(bin, []):
+            if chunk_end <= min_offset:
+                continue
+            for line in text[virtual(chunk_beg):virtual(chunk_end)].splitlines():
+                fields = line.split(b'\t')
+                if int(fields[1]) - 1 < end and int(fields[1]) - 1 + len(fields[3]) > beg:
+                    records.add((int(fields[1]), fields[3].decode()))
+    return(records)
+
+def simulateVCF(n_variants=3000, n_samples=10, seed=5):
+
+    rng = np.random.default_rng(seed)
+    gt = simulateGenotypes(n_variants=n_variants, n_samples=n_samples, missing=0.02, seed=seed)
+    pos = np.sort(rng.choice(10**6, n_variants, replace=False)) + 1
+    ref, alt = rng.choice(list('ACGT'), n_variants), rng.choice(list('ACGT'), n_variants)
+    header = "##fileformat=VCFv4.2\n##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">\n" + "\t".join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + [f"s{i}" for i in range(n_samples)]) + "\n"
+    return(header, gt, pos, ref, alt)
+
+class TestWriteVCF(unittest.TestCase):
+
+    def setUp(self):
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.header, self.gt, self.pos, self.ref, self.alt = simulateVCF()
+        # some longer REF alleles, so that records span more than their position
+        self.ref[::50] = 'ACGTACGTAC'
+
+    def tearDown(self):
+
+        self.dir.cleanup()
+
+    def assertReadable(self, path):
+
+        callset = allel.read_vcf(path, fields=['POS', 'REF', 'ALT', 'GT'], alt_number=1)
+        np.testing.assert_array_equal(callset['variants/POS'], self.pos)
+        np.testing.assert_array_equal(callset['variants/REF'], self.ref)
+        np.testing.assert_array_equal(callset['variants/ALT'], self.alt)
+        np.testing.assert_array_equal(callset['calldata/GT'], self.gt)
+
+    def assertIndexed(self, path):
+
+        # every record overlapping a region is found from both indexes, as tabix and bcftools would query them
+        rng = np.random.default_rng(9)
+        for kind in ['tbi', 'csi']:
+            index = readIndexChunks(f"{path}.{kind}")
+            for beg in rng.integers(0, self.pos[-1], size=20):
+                end = beg + rng.integers(1, 50000)
+                overlaps = (self.pos - 1 < end) & (self.pos - 1 + np.char.str_len(self.ref) > beg)
+                self.assertEqual(queryVCF(path, index, beg, end), set(zip(self.pos[overlaps].tolist(), self.ref[overlaps])))
+
+    def test_write_vcf(self):
+
+        path = os.path.join(self.dir.name, "test.vcf.gz")
+        blocks = ((self.pos[i:i + 700], self.ref[i:i + 700], self.alt[i:i + 700], self.gt[i:i + 700]) for i in range(0, self.pos.shape[0], 700))
+        probe.writeVCF(path, self.header, '2L', blocks, threads=2)
+        self.assertReadable(path)
+        self.assertIndexed(path)
+
+    def test_parallel_write_vcf(self):
+
+        path = os.path.join(self.dir.name, "test.vcf.gz")
+        probe.parallelWriteVCF(path, self.header, '2L', self.gt, self.pos, self.ref, self.alt, threads=3, blen=500)
+        self.assertReadable(path)
+        self.assertIndexed(path)
+
+    def test_object_alleles(self):
+
+        # REF and ALT as zarr and allel return them, bytes in object arrays
+        path = os.path.join(self.dir.name, "test.vcf.gz")
+        probe.parallelWriteVCF(path, self.header, '2L', self.gt, self.pos, self.ref.astype('S').astype(object), 
+                               self.alt.astype('S').astype(object), threads=3, blen=500)
+        self.assertReadable(path)
+
+class TestVCFToZarr(unittest.TestCase):
+
+    def setUp(self):
+
+        self.dir = tempfile.TemporaryDirectory()
+        header, gt, pos, ref, alt = simulateVCF()
+        # some multiallelic sites
+        alt[::7] = 'C,TA'
+        gt[::7][gt[::7] == 1] = 2
+        self.path = os.path.join(self.dir.name, "test.vcf.gz")
+        blocks = ((pos[i:i + 700], ref[i:i + 700], alt[i:i + 700], gt[i:i + 700]) for i in range(0, pos.shape[0], 700))
+        probe.writeVCF(self.path, header, '2L', blocks, indexes=['tbi'])
+
+    def tearDown(self):
+
+        self.dir.cleanup()
+
+    def assertMatchesReadVCF(self):
+
+        out = os.path.join(self.dir.name, "zarr")
+        probe.vcfToZarr(self.path, out, '2L', threads=2, chunks=(1000, 4), staging=os.path.join(self.dir.name, "staging"))
+        callset = allel.read_vcf(self.path, fields=list(probe.vcfZarrFields) + ['samples'], alt_number=3)
+        for field in list(probe.vcfZarrFields.values()) + ['samples']:
+            with self.subTest(field=field):
+                np.testing.assert_array_equal(zarr.open_array(f"{out}/{field}", mode='r')[:].astype(callset[field].dtype), callset[field])
+
+    def test_indexed(self):
+
+        self.assertMatchesReadVCF()
+
+    def test_unindexed(self):
+
+        os.remove(f"{self.path}.tbi")
+        self.assertMatchesReadVCF()
+
+
+
+if __name__ == '__main__':
+    unittest.main()